@@ -0,0 +1,126 @@
+"""Benchmark emulator training, prediction and likelihood throughput on synthetic training sets.
+No simulations are needed: the flux power spectra are a smooth function of the parameters,
+like the MultiPower mocks in the tests, but at realistic sizes.
+Timed are:
+    MultiBinGP construction (GP training),
+    single and batched MultiBinGP prediction,
+    LikelihoodClass.likelihood calls per second,
+    maximinlhs generation,
+    saving and loading the flux vector store.
+Results are appended to a machine-readable history file (see history.py)."""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import numpy as np
+from history import append_record
+#Benchmark the source tree this file is in, rather than any installed version.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lyaemu import coarse_grid
+from lyaemu import gpemulator
+from lyaemu import latin_hypercube
+from lyaemu import likelihood
+from lyaemu import mean_flux as mflux
+from lyaemu.flux_vector_store import FluxVectorStore
+
+def synthetic_flux_power(params, kf, nz):
+    """A smooth flux power spectrum for each parameter vector (rows of params),
+    depending on every parameter. Returns shape (nparams, nz*nk)."""
+    params = np.array(params, ndmin=2)
+    #Map to the unit cube so all parameters matter similarly
+    punit = (params - np.min(params, axis=0))/(np.ptp(params, axis=0)+1e-30)
+    zfac = 1 + 0.1 * np.arange(nz)
+    amp = 0.1 * (1 + punit[:, 0:1]) * (1 + 0.3 * punit[:, 1:2]**2)
+    kcut = 2 + np.sum(punit[:, 2:], axis=1)[:, np.newaxis]
+    power = amp[:, np.newaxis, :] * zfac[np.newaxis, :, np.newaxis] * np.exp(-kf[np.newaxis, np.newaxis, :] * zfac[np.newaxis, :, np.newaxis] / kcut[:, np.newaxis, :])
+    return power.reshape(np.shape(params)[0], -1)
+
+def make_training_set(emulator, nsims, dense_samples, kf, nz):
+    """Build a training set: nsims latin hypercube samples, each with dense_samples mean flux values."""
+    plimits = emulator.get_param_limits(include_dense=True)
+    ndense = np.shape(plimits)[0] - np.shape(emulator.param_limits)[0]
+    sims = emulator.build_params(nsims)
+    dense = np.linspace(plimits[:ndense, 0], plimits[:ndense, 1], dense_samples)
+    aparams = np.array([np.concatenate([dd, ss]) for dd in dense for ss in sims])
+    return aparams, plimits, synthetic_flux_power(aparams, kf, nz)
+
+def best_time(func, repeats):
+    """Best of repeats wall-clock time for a function call, in seconds."""
+    best = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def bench_store(tmpdir, aparams, kf, flux_vectors, nz, repeats):
+    """Time saving every flux vector to a new store, and loading them all back."""
+    store = FluxVectorStore(os.path.join(tmpdir, "bench_flux_vectors.hdf5"), classname="Emulator")
+    simdirs = ["sim%d" % i for i in range(np.shape(aparams)[0])]
+    kfkms = np.tile(kf/100., (np.shape(aparams)[0], nz, 1))
+    def save():
+        store.clear()
+        store.append(simdirs, aparams, kf, kfkms, flux_vectors)
+    def load():
+        (rows, _) = store.find_rows(simdirs, aparams)
+        return store.read_rows(rows)
+    tsave = best_time(save, repeats)
+    tload = best_time(load, repeats)
+    assert np.all(load()[2] == flux_vectors)
+    return {"save_s": tsave, "load_s": tload, "nrows": len(simdirs)}
+
+def bench_likelihood(tmpdir, gpemu, ncalls):
+    """Likelihood evaluations per second, with the trained emulator and fake data."""
+    coarse_grid.Emulator(tmpdir).dump()
+    like = likelihood.LikelihoodClass(tmpdir, optimise_GP=False)
+    if np.size(like.zout) != gpemu.nz:
+        return None
+    like.gpemu = gpemu
+    params = np.mean(like.param_limits, axis=1)
+    okf, predicted, _ = like.get_predicted(params)
+    data = np.concatenate([np.interp(like.kf, okf[bb], predicted[bb]) for bb in range(len(okf))])
+    rng = np.random.default_rng(42)
+    samples = params + 0.1 * (like.param_limits[:, 1] - like.param_limits[:, 0]) * (rng.random((ncalls, like.ndim)) - 0.5)
+    start = time.perf_counter()
+    for pp in samples:
+        like.likelihood(pp, data_power=data)
+    return ncalls / (time.perf_counter() - start)
+
+def run_benchmarks(nsims=30, dense_samples=10, nz=11, nk=50, nbatch=1000, ncalls=200, nlhs=1000, repeats=3):
+    """Run all the benchmarks and return a dictionary of results."""
+    results = {"config": {"nsims": nsims, "dense_samples": dense_samples, "nz": nz, "nk": nk, "nbatch": nbatch, "ncalls": ncalls, "nlhs": nlhs}}
+    kf = np.linspace(0.05, 5, nk)
+    np.random.seed(42)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        mf = mflux.MeanFluxFactor()
+        emulator = coarse_grid.Emulator(tmpdir, mf=mf)
+        aparams, plimits, flux_vectors = make_training_set(emulator, nsims, dense_samples, kf, nz)
+        start = time.perf_counter()
+        gpemu = gpemulator.MultiBinGP(params=aparams, kf=kf, powers=flux_vectors, param_limits=plimits)
+        results["train_s"] = time.perf_counter() - start
+        test = latin_hypercube.get_hypercube_samples(plimits, nbatch)
+        results["predict_single_s"] = best_time(lambda: gpemu.predict(test[:1]), repeats)
+        results["predict_batch_s"] = best_time(lambda: gpemu.predict(test), repeats)
+        results["predict_batch_per_point_s"] = results["predict_batch_s"] / nbatch
+        results["likelihood_calls_per_s"] = bench_likelihood(tmpdir, gpemu, ncalls)
+        results["store"] = bench_store(tmpdir, aparams, kf, flux_vectors, nz, repeats)
+    results["maximinlhs_s"] = best_time(lambda: latin_hypercube.maximinlhs(np.shape(plimits)[0], nsims, maxlhs=nlhs), 1)
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--history', type=str, default="benchmark_history.jsonl", help='File to append results to')
+    parser.add_argument('--nsims', type=int, default=30, help='Number of simulations in the training set')
+    parser.add_argument('--dense-samples', type=int, default=10, help='Number of mean flux samples per simulation')
+    parser.add_argument('--nz', type=int, default=11, help='Number of redshift bins. The likelihood is only timed for 11.')
+    parser.add_argument('--nk', type=int, default=50, help='Number of k bins per redshift')
+    parser.add_argument('--nbatch', type=int, default=1000, help='Number of points for batched prediction')
+    parser.add_argument('--ncalls', type=int, default=200, help='Number of likelihood calls')
+    parser.add_argument('--nlhs', type=int, default=1000, help='Number of latin hypercubes for maximinlhs (generated in groups of 1000)')
+    parser.add_argument('--repeats', type=int, default=3, help='Repeats for each timing (the best is kept)')
+    args = parser.parse_args()
+    res = run_benchmarks(nsims=args.nsims, dense_samples=args.dense_samples, nz=args.nz, nk=args.nk, nbatch=args.nbatch, ncalls=args.ncalls, nlhs=args.nlhs, repeats=args.repeats)
+    for name, val in res.items():
+        print(name, ":", val)
+    append_record(args.history, "emulator", res)
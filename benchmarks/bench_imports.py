@@ -0,0 +1,41 @@
+"""Benchmark the import time of the main lyaemu entry points using python -X importtime.
+Also reports which heavy optional dependencies each entry point pulls in at import time:
+these should be deferred to first use."""
+import os
+import sys
+import argparse
+import subprocess
+from history import append_record
+
+#Modules which users import directly.
+ENTRY_POINTS = ["lyaemu.likelihood", "lyaemu.coarse_grid", "lyaemu.gpemulator", "lyaemu.flux_power", "lyaemu.quadratic_emulator"]
+#Dependencies which are slow to import and only needed for some tasks.
+HEAVY_MODULES = ["GPy", "emcee", "mpmath", "fake_spectra", "camb", "matplotlib", "lyaemu.SimulationRunner"]
+
+def import_time(module, repeats=5):
+    """Get the (best of repeats) cumulative import time of a module in microseconds,
+    in a fresh interpreter, and the heavy modules loaded by the import."""
+    code = "import sys; import %s; print(','.join(m for m in %s if m in sys.modules))" % (module, HEAVY_MODULES)
+    best = None
+    srcdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=srcdir+os.pathsep+os.environ.get("PYTHONPATH", ""))
+    for _ in range(repeats):
+        proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, env=env, check=True)
+        #The last line for a module is its cumulative time, as it completes after its dependencies.
+        cumulative = [int(line.split("|")[1]) for line in proc.stderr.decode().splitlines() if line.startswith("import time:") and line.split("|")[2].strip() == module]
+        if best is None or cumulative[-1] < best:
+            best = cumulative[-1]
+    heavy = [hh for hh in proc.stdout.decode().strip().split(",") if hh]
+    return best, heavy
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--history', type=str, default="benchmark_history.jsonl", help='File to append results to')
+    parser.add_argument('--repeats', type=int, default=5, help='Number of repeats for each import')
+    args = parser.parse_args()
+    results = {}
+    for entry in ENTRY_POINTS:
+        (usec, heavy) = import_time(entry, repeats=args.repeats)
+        results[entry] = {"import_time_us": usec, "heavy_modules": heavy}
+        print("%s: %.1f ms; heavy modules: %s" % (entry, usec/1e3, heavy))
+    append_record(args.history, "imports", results)
@@ -0,0 +1,41 @@
+"""Helpers to store benchmark results as a machine-readable history.
+Each benchmark run is one line of JSON, so that runs from different releases
+(or machines) can be appended to the same file and compared."""
+import os
+import json
+import platform
+import subprocess
+from datetime import datetime
+
+def get_git_revision():
+    """Get the git revision of the source tree, if we are in one."""
+    try:
+        rev = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return rev.decode().strip()
+
+def append_record(histfile, benchmark, results):
+    """Append the results of one benchmark run to the history file."""
+    record = {"benchmark": benchmark,
+              "date": datetime.now().isoformat(),
+              "revision": get_git_revision(),
+              "host": platform.node(),
+              "python": platform.python_version(),
+              "results": results}
+    with open(histfile, 'a') as hist:
+        hist.write(json.dumps(record)+"\n")
+    return record
+
+def load_records(histfile, benchmark=None):
+    """Load all records (optionally only those for a single benchmark) from the history file."""
+    records = []
+    with open(histfile, 'r') as hist:
+        for line in hist:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if benchmark is None or record["benchmark"] == benchmark:
+                records.append(record)
+    return records
@@ -0,0 +1,159 @@
+"""Track a campaign of simulations for an emulator, from IC generation to extracted spectra.
+Each simulation moves through the states:
+    pending -> ics -> submitted -> finished -> extracted
+(or failed, if IC generation or the job failed). The state of every simulation is written to
+a json file in the emulator directory whenever it changes, so an interrupted campaign can be resumed."""
+import os
+import os.path
+import json
+import subprocess
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from . import flux_power
+
+STATES = ("pending", "ics", "submitted", "finished", "extracted", "failed")
+
+def _generate_one(emulator, ev, npart, box):
+    """Generate ICs for one simulation. At module level so it can be run in a process pool."""
+    return emulator._do_ic_generation(ev, npart, box)
+
+class BatchScheduler:
+    """Submit simulations to a batch system and query their status.
+    The default commands are for slurm: the submission script written by
+    SimulationRunner is submitted from the simulation directory and the state
+    of a job is read from the accounting database with sacct, which also knows
+    about jobs which have left the queue. A job the query does not know about is
+    treated as finished: the campaign then checks its output."""
+    failed_states = ("FAILED", "CANCELLED", "TIMEOUT", "NODE_FAIL")
+    finished_states = ("COMPLETED",)
+    def __init__(self, submit_command="sbatch", script="mpi_submit", query_command="sacct -j {jobid} -n -X -o State"):
+        self.submit_command = submit_command
+        self.script = script
+        self.query_command = query_command
+
+    def submit(self, simdir):
+        """Submit the job in simdir, returning the job id."""
+        out = subprocess.check_output([self.submit_command, self.script], cwd=simdir)
+        return out.decode().split()[-1]
+
+    def status(self, jobid):
+        """Get the status of a job: one of 'queued', 'finished' or 'failed'."""
+        try:
+            out = subprocess.check_output(self.query_command.format(jobid=jobid).split(), stderr=subprocess.DEVNULL)
+        except (subprocess.CalledProcessError, OSError):
+            return "finished"
+        if not out.strip():
+            return "finished"
+        #States may have a suffix, eg 'CANCELLED by 1234'
+        state = out.decode().split()[0].rstrip("+")
+        if state in self.failed_states:
+            return "failed"
+        if state in self.finished_states:
+            return "finished"
+        return "queued"
+
+class SimulationCampaign:
+    """Generate, submit and track the simulations for an emulator.
+       emulator - the coarse_grid.Emulator whose simulations these are.
+       scheduler - an object with submit(simdir) -> jobid and status(jobid) -> 'queued', 'finished' or 'failed' methods.
+                   If None, simulations cannot be submitted (which was the old behaviour).
+       statefile - file in the emulator directory storing the state of each simulation."""
+    def __init__(self, emulator, scheduler=None, statefile="campaign_state.json", max_z=4.2):
+        self.emulator = emulator
+        self.scheduler = scheduler
+        self.statefile = os.path.join(emulator.basedir, statefile)
+        self.zout = flux_power.MySpectra(max_z=max_z).zout
+        self.sims = {}
+        if os.path.exists(self.statefile):
+            with open(self.statefile, 'r') as jsin:
+                self.sims = json.load(jsin)
+
+    def _save(self):
+        """Save the state of the campaign. Write to a temporary file first so an interruption cannot corrupt it."""
+        tmpfile = self.statefile + ".tmp"
+        with open(tmpfile, 'w') as jsout:
+            json.dump(self.sims, jsout, indent=1)
+        os.replace(tmpfile, self.statefile)
+
+    def _set_state(self, name, state, **kwargs):
+        """Change the state of one simulation and save."""
+        assert state in STATES
+        self.sims[name]["state"] = state
+        self.sims[name].update(kwargs)
+        self._save()
+
+    def add_samples(self, samples):
+        """Add simulations for some parameter vectors. Simulations already in the campaign are not changed."""
+        for ev in samples:
+            name = self.emulator.build_dirname(ev)
+            if name not in self.sims:
+                self.sims[name] = {"params": np.asarray(ev).tolist(), "state": "pending"}
+        self._save()
+
+    def get_names(self, state):
+        """Get the (sorted) names of the simulations in a given state."""
+        return sorted(name for name, sim in self.sims.items() if sim["state"] == state)
+
+    def status(self):
+        """Get the number of simulations in each state."""
+        return {state: len(self.get_names(state)) for state in STATES}
+
+    def generate_ics(self, npart=256., box=40, nworkers=1, retry_failed=False):
+        """Generate ICs for all pending simulations, with nworkers processes.
+        The state of each simulation is saved as soon as its ICs are done."""
+        todo = self.get_names("pending")
+        if retry_failed:
+            todo += [name for name in self.get_names("failed") if "jobid" not in self.sims[name]]
+        params = {name: np.array(self.sims[name]["params"]) for name in todo}
+        if nworkers <= 1:
+            for name in todo:
+                self._ics_done(name, self.emulator._do_ic_generation(params[name], npart, box))
+            return
+        with ProcessPoolExecutor(max_workers=nworkers) as pool:
+            futures = {pool.submit(_generate_one, self.emulator, params[name], npart, box): name for name in todo}
+            for fut in as_completed(futures):
+                try:
+                    success = fut.result()
+                except (RuntimeError, OSError) as e:
+                    print(str(e), " while building: ", futures[fut])
+                    success = False
+                self._ics_done(futures[fut], success)
+
+    def _ics_done(self, name, success):
+        """Record the result of IC generation."""
+        if success:
+            self._set_state(name, "ics")
+        else:
+            self._set_state(name, "failed")
+
+    def submit(self):
+        """Submit all simulations with generated ICs to the scheduler."""
+        if self.scheduler is None:
+            raise ValueError("No scheduler to submit to")
+        for name in self.get_names("ics"):
+            jobid = self.scheduler.submit(os.path.join(self.emulator.basedir, name))
+            self._set_state(name, "submitted", jobid=str(jobid))
+
+    def _have_spectra(self, name):
+        """Check whether spectra have been extracted for every output redshift."""
+        outdir = os.path.join(self.emulator.basedir, name, "output")
+        if not os.path.exists(outdir):
+            return False
+        manifest = flux_power.build_snapshot_manifest(outdir)
+        reds = np.array([mm["redshift"] for mm in manifest if mm["savefile"] and mm["redshift"] is not None])
+        if np.size(reds) == 0:
+            return False
+        return np.all([np.min(np.abs(reds - zz)) < 0.01 for zz in self.zout])
+
+    def update(self):
+        """Poll the scheduler and the filesystem, moving simulations to finished or extracted."""
+        for name in self.get_names("submitted"):
+            status = self.scheduler.status(self.sims[name]["jobid"])
+            if status == "finished":
+                self._set_state(name, "finished")
+            elif status == "failed":
+                self._set_state(name, "failed")
+        for name in self.get_names("finished"):
+            if self._have_spectra(name):
+                self._set_state(name, "extracted")
+        return self.status()
@@ -7,14 +7,23 @@ import glob
 import string
 import math
 import json
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import h5py
-from .SimulationRunner.SimulationRunner import lyasimulation
 from . import latin_hypercube
 from . import flux_power
 from . import lyman_data
 from . import gpemulator
+from .flux_vector_store import FluxVectorStore, simulation_identity, mean_flux_identity
 from .mean_flux import ConstMeanFlux
+from .campaign import SimulationCampaign
+from . import profiling
+
+def _import_lyasimulation():
+    """Import the IC generation code from SimulationRunner on first use.
+    It is only needed to make new simulations, not to build or sample an emulator."""
+    from .SimulationRunner.SimulationRunner import lyasimulation
+    return lyasimulation
 
 def get_latex(key):
     """Get a latex name if it exists, otherwise return the key."""
@@ -42,7 +51,7 @@ class Emulator:
         else:
             self.mf = mf
 
-        if kf or z is None:
+        if kf is None or z is None:
             data_instance = lyman_data.BOSSData()
             if kf is None:
                 kf = data_instance.get_kf()
@@ -130,11 +139,43 @@ class Emulator:
         ev[pn['As']] = wmap / conv
         return ev
 
-    def reconstruct(self):
-        """Reconstruct the parameters of an emulator by loading the parameters of each simulation in turn."""
-        dirs = glob.glob(os.path.join(self.basedir, "*"))
-        self.sample_params = np.array([self._recon_one(pdir) for pdir in dirs])
+    def _recon_cached(self, pdir, index):
+        """Get the parameters of a simulation from the index, if its SimulationICs.json
+        has not changed since it was indexed, and otherwise from the file itself."""
+        mtime = os.path.getmtime(os.path.join(pdir, "SimulationICs.json"))
+        cached = index.get(os.path.basename(pdir), None)
+        if cached is not None and cached["mtime"] == mtime:
+            return mtime, np.array(cached["params"])
+        return mtime, self._recon_one(pdir)
+
+    def reconstruct(self, nthreads=8, indexfile="reconstruct_index.json"):
+        """Reconstruct the parameters of an emulator by loading the parameters of each simulation in turn.
+        The SimulationICs.json files are read concurrently by nthreads threads, as on a parallel filesystem
+        the time is dominated by latency. The parsed parameters are saved to indexfile with the modification
+        time of each json file, so that later calls only re-read simulations which have changed.
+        Simulations are sorted by directory name, so the order is deterministic."""
+        dirs = sorted(pdir for pdir in glob.glob(os.path.join(self.basedir, "*")) if os.path.exists(os.path.join(pdir, "SimulationICs.json")))
+        findex = os.path.join(self.basedir, indexfile)
+        index = {}
+        try:
+            with open(findex, 'r') as jsin:
+                indict = json.load(jsin)
+            #Only use the index if the parameters are the same
+            if indict["param_names"] == self.param_names:
+                index = indict["simulations"]
+        except (OSError, ValueError, KeyError):
+            pass
+        with ThreadPoolExecutor(max_workers=nthreads) as pool:
+            recon = list(pool.map(lambda pdir: self._recon_cached(pdir, index), dirs))
+        self.sample_params = np.array([pp for (_, pp) in recon])
         assert np.shape(self.sample_params) == (len(dirs), np.size(self.param_limits[:,0]))
+        simulations = {os.path.basename(pdir) : {"mtime": mtime, "params": pp.tolist()} for pdir, (mtime, pp) in zip(dirs, recon)}
+        try:
+            with open(findex, 'w') as jsout:
+                json.dump({"param_names": self.param_names, "simulations": simulations}, jsout)
+        except OSError:
+            #Read-only emulator directory: the parameters are re-read each time.
+            pass
 
     def dump(self, dumpfile="emulator_params.json"):
         """Dump parameters to a textfile."""
@@ -193,21 +234,30 @@ class Emulator:
             prior_points = self.sample_params[ii]
         return latin_hypercube.get_hypercube_samples(limits, nsamples,prior_points=prior_points)
 
-    def gen_simulations(self, nsamples, npart=256.,box=40,samples=None):
-        """Initialise the emulator by generating simulations for various parameters."""
+    def gen_simulations(self, nsamples, npart=256.,box=40,samples=None, nworkers=1, scheduler=None):
+        """Initialise the emulator by generating simulations for various parameters.
+        Simulations are tracked by a SimulationCampaign, which saves the state of each simulation
+        as soon as it changes. If interrupted, calling this again (after load(), with samples=None)
+        only generates the ICs which are missing. ICs are generated by nworkers processes. If a scheduler is given,
+        the simulations are also submitted to it."""
         if len(self.sample_params) == 0:
             self.sample_params = self.build_params(nsamples)
         if samples is None:
             samples = self.sample_params
         else:
             self.sample_params = np.vstack([self.sample_params, samples])
-        #Generate ICs for each set of parameter inputs
-        for ev in samples:
-            self._do_ic_generation(ev, npart, box)
+        campaign = SimulationCampaign(self, scheduler=scheduler)
+        campaign.add_samples(samples)
+        #Save the parameters before the (slow) IC generation, so they are not lost.
         self.dump()
+        #Generate ICs for each set of parameter inputs
+        campaign.generate_ics(npart=npart, box=box, nworkers=nworkers)
+        if scheduler is not None:
+            campaign.submit()
+        return campaign
 
     def _do_ic_generation(self,ev,npart,box):
-        """Do the actual IC generation."""
+        """Do the actual IC generation. Returns True if successful."""
         outdir = os.path.join(self.basedir, self.build_dirname(ev))
         pn = self.param_names
         rescale_slope = ev[pn['heat_slope']]
@@ -217,6 +267,7 @@ class Emulator:
         #at 8 Mpc (k = 0.78) to pivot scale of 0.05
         ns = ev[pn['ns']]
         wmap = (0.05/(2*math.pi/8.))**(ns-1.) * ev[pn['As']]
+        lyasimulation = _import_lyasimulation()
         ss = lyasimulation.LymanAlphaSim(outdir=outdir, box=box,npart=npart, ns=ns, scalar_amp=wmap, rescale_gamma=True, rescale_slope = rescale_slope, redend=2.2, rescale_amp = rescale_amp, hubble=hub, omega0=self.omegamh2/hub**2, omegab=0.0483,unitary=True)
         try:
             ss.make_simulation()
@@ -225,6 +276,8 @@ class Emulator:
             ss._cluster.generate_spectra_submit(outdir)
         except RuntimeError as e:
             print(str(e), " while building: ",outdir)
+            return False
+        return True
 
     def get_param_limits(self, include_dense=True):
         """Get the reprocessed limits on the parameters for the likelihood."""
@@ -242,11 +295,16 @@ class Emulator:
         """Get the number of sparse parameters, those sampled by simulations."""
         return np.shape(self.param_limits)[0]
 
+    def _get_simdir(self, pp):
+        """Get the directory (relative to basedir) of the simulation with a given parameter set."""
+        name = self.build_dirname(pp, strsz=3)
+        if not os.path.exists(os.path.join(self.basedir, name, "output")):
+            name = self.build_dirname(pp, strsz=2)
+        return name
+
     def _get_fv(self, pp,myspec):
         """Helper function to get a single flux vector."""
-        di = self.get_outdir(pp, strsz=3)
-        if not os.path.exists(di):
-            di = self.get_outdir(pp, strsz=2)
+        di = os.path.join(self.basedir, self._get_simdir(pp), "output")
         powerspectra = myspec.get_snapshot_list(base=di)
         return powerspectra
 
@@ -261,8 +319,13 @@ class Emulator:
         gp = self._get_custom_emulator(emuobj=None, max_z=max_z)
         return gp
 
+    @profiling.profiled("Emulator.get_flux_vectors")
     def get_flux_vectors(self, max_z=4.2, kfunits="kms"):
-        """Get the desired flux vectors and their parameters"""
+        """Get the desired flux vectors and their parameters.
+        Flux vectors already in the store are read from it: only those for
+        new simulations (or new mean flux values) are extracted from disc and appended.
+        Stored flux vectors whose simulation ICs, spectra files or mean flux have changed
+        are extracted again and replaced."""
         pvals = self.get_parameters()
         nparams = np.shape(pvals)[1]
         nsims = np.shape(pvals)[0]
@@ -272,6 +335,10 @@ class Emulator:
         #Note this gets tau_0 as a linear scale factor from the observed power law
         dpvals = self.mf.get_params()
         nuggets = np.zeros_like(pvals[:,0])
+        simdirs = [self._get_simdir(pp) for pp in pvals]
+        #Index of the simulation and the mean flux parameters for each row.
+        rowsims = list(range(nsims))
+        rowdense = [dpvals,]*nsims
         #Savefile prefix
         mfc = "cc"
         if dpvals is not None:
@@ -282,25 +349,16 @@ class Emulator:
             assert (newdp[-1] + nuggets[-1] < dpvals[-1]) and (newdp[0] + nuggets[0] >= dpvals[0])
             dpvals = newdp
             aparams = np.array([np.concatenate([dp+nuggets[i],pvals[i]]) for dp in dpvals for i in range(nsims)])
+            rowsims = [i for _ in dpvals for i in range(nsims)]
+            rowdense = [dp+nuggets[i] for dp in dpvals for i in range(nsims)]
             mfc = "mf"
-        try:
-            kfmpc, kfkms, flux_vectors = self.load_flux_vectors(aparams, mfc=mfc)
-        except (AssertionError, OSError):
-            print("Could not load flux vectors, regenerating from disc")
-            powers = [self._get_fv(pp, myspec) for pp in pvals]
-            mef = lambda pp: self.mf.get_mean_flux(myspec.zout, params=pp)[0]
-            if dpvals is not None:
-                flux_vectors = np.array([powers[i].get_power_native_binning(mean_fluxes = mef(dp+nuggets[i])) for dp in dpvals for i in range(nsims)])
-                #'natively' binned k values in km/s units as a function of redshift
-                kfkms = [ps.get_kf_kms() for _ in dpvals for ps in powers]
-            else:
-                flux_vectors = np.array([powers[i].get_power_native_binning(mean_fluxes = mef(dpvals)) for i in range(nsims)])
-                #'natively' binned k values in km/s units as a function of redshift
-                kfkms = [ps.get_kf_kms() for ps in powers]
-            #Same in all boxes
-            kfmpc = powers[0].kf
-            assert np.all(np.abs(powers[0].kf/ powers[-1].kf-1) < 1e-6)
-            self.save_flux_vectors(aparams, kfmpc, kfkms, flux_vectors, mfc=mfc)
+        store = self._get_store(mfc=mfc)
+        #Identity of each row: if this changes the stored flux vector is stale.
+        simids = [simulation_identity(os.path.join(self.basedir, sd), spectra_file=myspec.savefile) for sd in simdirs]
+        mef = lambda pp: self.mf.get_mean_flux(myspec.zout, params=pp)[0]
+        rowmf = [mef(dp) for dp in rowdense]
+        rowids = [simids[rowsims[r]]+":"+mean_flux_identity(rowmf[r], myspec.zout) for r in range(len(rowsims))]
+        kfmpc, kfkms, flux_vectors = self._read_store_rows(store, pvals, myspec, aparams, rowsims, rowmf, rowids)
         assert np.shape(flux_vectors)[0] == np.shape(aparams)[0]
         if kfunits == "kms":
             kf = kfkms
@@ -308,36 +366,69 @@ class Emulator:
             kf = kfmpc
         return aparams, kf, flux_vectors
 
-    def save_flux_vectors(self, aparams, kfmpc, kfkms, flux_vectors, mfc="mf", savefile="emulator_flux_vectors.hdf5"):
-        """Save the flux vectors and parameters to a file, which is the only thing read on reload."""
-        save = h5py.File(os.path.join(self.basedir, mfc+"_"+savefile), 'w')
-        save.attrs["classname"] = str(self.__class__)
-        save["params"] = aparams
-        save["flux_vectors"] = flux_vectors
-        #Save in both km/s and Mpc/h units.
-        save["kfkms"] = kfkms
-        save["kfmpc"] = kfmpc
-        save.close()
-
-    def load_flux_vectors(self, aparams, mfc="mf", savefile="emulator_flux_vectors.hdf5"):
-        """Save the flux vectors and parameters to a file, which is the only thing read on reload."""
-        load = h5py.File(os.path.join(self.basedir, mfc+"_"+savefile), 'r')
-        inparams = np.array(load["params"])
-        flux_vectors = np.array(load["flux_vectors"])
-        kfkms = np.array(load["kfkms"])
-        kfmpc = np.array(load["kfmpc"])
-        name = str(load.attrs["classname"])
-        load.close()
-        assert name.split(".")[-1] == str(self.__class__).split(".")[-1]
-        assert np.shape(inparams) == np.shape(aparams)
-        assert np.all(inparams - aparams < 1e-3)
-        return kfmpc, kfkms, flux_vectors
+    def _read_store_rows(self, store, pvals, myspec, aparams, rowsims, rowmf, rowids):
+        """Read the flux vector of each row from the store. Row r is simulation pvals[rowsims[r]]
+        with mean flux rowmf[r], and has parameters aparams[r] and identity rowids[r].
+        Only rows which are missing or stale are extracted from disc: stale rows are replaced
+        in place and missing rows appended. The store is only cleared if its binning has changed."""
+        rowdirs = [self._get_simdir(pvals[i]) for i in rowsims]
+        rows, stale = store.find_rows(rowdirs, aparams, identities=rowids)
+        redo = np.where((rows < 0) + stale)[0]
+        if np.size(redo) > 0:
+            print("Extracting", np.size(redo), "of", np.size(rows), "flux vectors from disc")
+            powers = {}
+            for i in sorted(set(rowsims[mm] for mm in redo)):
+                powers[i] = self._get_fv(pvals[i], myspec)
+            flux_vectors = np.array([powers[rowsims[mm]].get_power_native_binning(mean_fluxes = rowmf[mm]) for mm in redo])
+            #'natively' binned k values in km/s units as a function of redshift
+            kfkms = np.array([powers[rowsims[mm]].get_kf_kms() for mm in redo])
+            #Same in all boxes
+            kfmpc = powers[rowsims[redo[0]]].kf
+            assert np.all([np.all(np.abs(kfmpc/ ps.kf-1) < 1e-6) for ps in powers.values()])
+            if store.exists() and not store.is_compatible(kfmpc=kfmpc, nfv=np.shape(flux_vectors)[1]):
+                #The binning has changed, so none of the stored rows can be reused.
+                store.clear()
+                return self._read_store_rows(store, pvals, myspec, aparams, rowsims, rowmf, rowids)
+            isstale = stale[redo]
+            if np.any(isstale):
+                store.update(rows[redo[isstale]], [rowids[mm] for mm in redo[isstale]], kfkms[isstale], flux_vectors[isstale])
+            new = redo[~isstale]
+            if np.size(new) > 0:
+                rows[new] = store.append([rowdirs[mm] for mm in new], aparams[new], kfmpc, kfkms[~isstale], flux_vectors[~isstale], identities=[rowids[mm] for mm in new])
+        return store.read_rows(rows)
+
+    def _get_store(self, mfc="mf", savefile="emulator_flux_vectors.hdf5"):
+        """Get the store holding the flux vectors for this emulator."""
+        return FluxVectorStore(os.path.join(self.basedir, mfc+"_"+savefile), classname=str(self.__class__))
+
+    def save_flux_vectors(self, aparams, kfmpc, kfkms, flux_vectors, mfc="mf", savefile="emulator_flux_vectors.hdf5", simdirs=None, identities=None):
+        """Save the flux vectors and parameters to a file, which is the only thing read on reload.
+        This replaces any existing file: use the store's append to add new rows."""
+        if simdirs is None:
+            simdirs = [self._get_simdir(pp[-len(self.param_names):]) for pp in aparams]
+        store = self._get_store(mfc=mfc, savefile=savefile)
+        store.clear()
+        store.append(simdirs, aparams, kfmpc, kfkms, flux_vectors, identities=identities)
+
+    def load_flux_vectors(self, aparams, mfc="mf", savefile="emulator_flux_vectors.hdf5", simdirs=None, identities=None):
+        """Load the flux vectors for the given parameters from a file.
+        Raises KeyError if any are missing or (if identities are given) stale."""
+        store = self._get_store(mfc=mfc, savefile=savefile)
+        if not store.exists():
+            raise OSError("No flux vector file: "+store.filename)
+        if simdirs is None:
+            simdirs = [self._get_simdir(pp[-len(self.param_names):]) for pp in aparams]
+        rows, stale = store.find_rows(simdirs, aparams, identities=identities)
+        if np.any(rows < 0) or np.any(stale):
+            raise KeyError("%d flux vectors missing and %d stale in %s" % (np.sum(rows < 0), np.sum(stale), store.filename))
+        return store.read_rows(rows)
 
     def _get_custom_emulator(self, *, emuobj, max_z=4.2):
         """Helper to allow supporting different emulators."""
         aparams, kf, flux_vectors = self.get_flux_vectors(max_z=max_z, kfunits="mpc")
         plimits = self.get_param_limits(include_dense=True)
-        gp = gpemulator.MultiBinGP(params=aparams, kf=kf, powers = flux_vectors, param_limits = plimits, singleGP=emuobj)
+        ndense = np.shape(plimits)[0] - np.shape(self.param_limits)[0]
+        gp = gpemulator.MultiBinGP(params=aparams, kf=kf, powers = flux_vectors, param_limits = plimits, singleGP=emuobj, ndense=ndense)
         return gp
 
 
@@ -365,11 +456,14 @@ class KnotEmulator(Emulator):
         rescale_slope = ev[pn['heat_slope']]
         rescale_amp = ev[pn['heat_amp']]
         hub = ev[pn['hub']]
+        lyasimulation = _import_lyasimulation()
         ss = lyasimulation.LymanAlphaKnotICs(outdir=outdir, box=box,npart=npart, knot_pos = self.knot_pos, knot_val=ev[0:self.nknots],hubble=hub, rescale_gamma=True, redend=2.2, rescale_slope = rescale_slope, rescale_amp = rescale_amp, omega0=self.omegamh2/hub**2, omegab=0.0483,unitary=True)
         try:
             ss.make_simulation()
         except RuntimeError as e:
             print(str(e), " while building: ",outdir)
+            return False
+        return True
 
 
 class nCDMEmulator(Emulator):
@@ -396,6 +490,7 @@ class nCDMEmulator(Emulator):
         # at 8 Mpc (k = 0.78) to pivot scale of 0.05
         ns = ev[pn['ns']]
         wmap = (0.05 / (2 * math.pi / 8.)) ** (ns - 1.) * ev[pn['As']]
+        lyasimulation = _import_lyasimulation()
         ss = lyasimulation.LymanAlphaSim(outdir=outdir, box=box, npart=npart, ns=ns, scalar_amp=wmap,
                                          rescale_gamma=True, rescale_slope=rescale_slope, redend=2.2,
                                          rescale_amp=rescale_amp, hubble=hub, omega0=self.omegamh2 / hub ** 2,
@@ -407,6 +502,8 @@ class nCDMEmulator(Emulator):
             ss._cluster.generate_spectra_submit(outdir)
         except RuntimeError as e:
             print(str(e), " while building: ", outdir)
+            return False
+        return True
 
 
 def get_simulation_parameters_knots(base):
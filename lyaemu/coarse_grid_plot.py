@@ -4,8 +4,10 @@ import os
 import os.path
 import re
 import math
+import multiprocessing
 from datetime import datetime
 import numpy as np
+import h5py
 from . import coarse_grid
 from . import matter_power
 from . import flux_power
@@ -58,8 +60,110 @@ def _plot_unit_Gaussians(xx, axis=None):
         axis = plt
     axis.plot(xx, np.exp(-xx ** 2 / 2) / np.sqrt(2 * np.pi), ls="-", color="black", label=r"Unit Gaussian")
 
-def plot_test_interpolate(emulatordir,testdir, savedir=None, plotname="", mean_flux=1, max_z=4.2, emuclass=None, showerr=True):
-    """Make a plot showing the interpolation error."""
+def validate_emulator(gp, test_par, test_flux, nz, xlim=6., nbins=100):
+    """Compare emulator predictions to exact flux power spectra for a set of test points.
+    All test points are predicted with one batched call, and the error statistics are computed for all at once.
+    Arguments:
+        gp - emulator with a batched predict method, such as MultiBinGP.
+        test_par - parameters of the test points, shape (N, nparams).
+        test_flux - exact flux vectors, shape (N, nz*nk).
+        nz - number of redshift bins.
+    Returns a dictionary of arrays:
+        predicted, std - emulator mean and error, shape (N, nz*nk).
+        ratio - predicted / exact.
+        err_norm - (predicted - exact) / std.
+        max_frac_err - maximum of |predicted / exact - 1| over k, shape (N, nz).
+        max_frac_err_z - maximum over the test points, shape (nz,).
+        rms_err_norm_z - root mean square of err_norm for each redshift, shape (nz,).
+        hist_edges - edges of the err_norm histograms, between -xlim and xlim.
+        hist, hist_z - normalised histograms of err_norm, for all redshifts and for each, shapes (nbins,) and (nz, nbins).
+    """
+    test_flux = np.array(test_flux, ndmin=2)
+    (predicted, std) = gp.predict(np.array(test_par, ndmin=2))
+    ratio = predicted / test_flux
+    err_norm = (predicted - test_flux) / std
+    nk = np.shape(test_flux)[1] // nz
+    max_frac_err = np.max(np.abs(ratio - 1).reshape(-1, nz, nk), axis=2)
+    errz = err_norm.reshape(-1, nz, nk)
+    #All the histograms at once: bin index offset by redshift, counted with bincount.
+    edges = np.linspace(-xlim, xlim, nbins+1)
+    width = edges[1] - edges[0]
+    ibin = np.floor((errz - edges[0]) / width)
+    #The last edge is included, as in np.histogram
+    ibin[errz == edges[-1]] = nbins - 1
+    inrange = np.isfinite(ibin) * (ibin >= 0) * (ibin < nbins)
+    zind = np.broadcast_to(np.arange(nz)[np.newaxis, :, np.newaxis], np.shape(errz))
+    counts = np.bincount((zind[inrange] * nbins + ibin[inrange]).astype(int), minlength=nz*nbins).reshape(nz, nbins)
+    hist_z = counts / np.maximum(np.sum(counts, axis=1), 1)[:, np.newaxis] / width
+    hist = np.sum(counts, axis=0) / max(np.sum(counts), 1) / width
+    return {"predicted": predicted, "std": std, "ratio": ratio, "err_norm": err_norm,
+            "max_frac_err": max_frac_err, "max_frac_err_z": np.max(max_frac_err, axis=0),
+            "rms_err_norm_z": np.sqrt(np.mean(errz**2, axis=(0, 2))),
+            "hist_edges": edges, "hist": hist, "hist_z": hist_z}
+
+def save_validation(filename, results, **extra):
+    """Save the results of validate_emulator, and any other arrays given as keywords, to an HDF5 file."""
+    with h5py.File(filename, 'w') as save:
+        for key, val in list(results.items()) + list(extra.items()):
+            if key == "names":
+                save[key] = np.array(val, dtype=h5py.string_dtype())
+            else:
+                save[key] = val
+
+def _plot_one_test(args):
+    """Plot the predicted/exact ratio and the error histogram for one test point.
+    Arguments are packed so this can be used with Pool.map."""
+    (savedir, name, okf, ratio, predicted, std, exact, errrr, zout, showerr) = args
+    nred = len(zout)
+    dist_col = dc.get_distinct(nred)
+    for i in range(nred):
+        nk = np.size(okf[i])
+        plt.semilogx(okf[i],ratio[i*nk:(i+1)*nk],label=round(zout[i],1), color=dist_col[i])
+    upper =  ((predicted + std)/exact).reshape(-1, nk)
+    lower =  ((predicted-std)/exact).reshape(-1, nk)
+    low = np.min(lower, axis=0)
+    low = np.concatenate([[low[0],], low])
+    upp = np.max(upper, axis=0)
+    upp = np.concatenate([[upp[0],], upp])
+    if showerr:
+        plt.fill_between(np.concatenate([[okf[0][0],], okf[-1]]),low, upp,alpha=0.3, color="grey")
+    plt.xlabel(r"$k_F$ (s/km)")
+    plt.ylabel(r"Predicted/Exact")
+    plt.ylim(0.95,1.05)
+    plt.xticks([1e-3, 1e-2, 0.05],[r"$10^{-3}$",r"$10^{-2}$","0.05"])
+    plt.xlim(1e-3, 0.052)
+    if np.max(ratio) > 1.035:
+        plt.legend(loc='lower left', ncol=4)
+    else:
+        plt.legend(loc='upper left', ncol=4)
+    plt.tight_layout()
+    #So we can use it in a latex document
+    plt.savefig(os.path.join(savedir, name))
+    plt.clf()
+    #Make plot of errors
+    _plot_error_histogram(savedir, name, errrr, xlim=5., nbins=50)
+    return name
+
+def plot_validation(savedir, names, test_kf, test_flux, results, zout, plotname="", showerr=True, nprocs=1):
+    """Make the plots for each test point from the results of validate_emulator,
+    in parallel over nprocs processes, and the histogram of all the errors."""
+    tasks = [(savedir, names[j], test_kf[j], results["ratio"][j], results["predicted"][j], results["std"][j], test_flux[j], results["err_norm"][j], zout, showerr) for j in range(len(names))]
+    if nprocs > 1:
+        with multiprocessing.Pool(nprocs) as pool:
+            done = pool.map(_plot_one_test, tasks)
+    else:
+        done = [_plot_one_test(task) for task in tasks]
+    for name in done:
+        print(name)
+    #Plot the distribution of errors, compared to a Gaussian
+    errlist = np.ravel(results["err_norm"])
+    if np.all(np.isfinite(errlist)):
+        _plot_error_histogram(savedir, plotname, errlist, xlim=6., nbins=100)
+
+def plot_test_interpolate(emulatordir,testdir, savedir=None, plotname="", mean_flux=1, max_z=4.2, emuclass=None, showerr=True, plot=True, nprocs=1, savefile="validation.hdf5"):
+    """Validate an emulator against a set of test simulations, and optionally plot the interpolation error.
+    The predictions and error statistics for all test points (see validate_emulator) are saved
+    to savefile in savedir. If plot is True, a plot is made for each test point, using nprocs processes."""
     if savedir is None:
         savedir = emulatordir
     if not os.path.exists(savedir):
@@ -83,64 +187,15 @@ def plot_test_interpolate(emulatordir,testdir, savedir=None, plotname="", mean_f
     gp = params.get_emulator(max_z=max_z)
     print('Finished generating emulator at', str(datetime.now()))
     myspec = flux_power.MySpectra(max_z=max_z, max_k=params.maxk)
-    errlist = np.array([])
-
-    nred = len(myspec.zout)
-    dist_col = dc.get_distinct(nred)
-    #print("Number of validation points =", params_test.get_parameters().shape[0])
     test_par, test_kf, test_flux = params_test.get_flux_vectors()
-
-    for pp, okf, exact in zip(test_par, test_kf, test_flux):
-        if mean_flux == 2:
-            pp = np.concatenate([[t0,], pp]) #In 'MeanFluxFactor' case: choose t0 point for fair comparison
-        predicted,std = gp.predict(pp.reshape(1,-1)) #.predict takes [{list of parameters: t0; cosmo.; thermal},]
-
-        #assert np.all(np.abs(gp.kf/okf - 1) < 1e-5)
-        ratio =  predicted[0]/exact
-        errrr =  (predicted[0]-exact)/std[0]
-        errlist = np.concatenate([errlist, errrr])
-        for i in range(nred):
-            nk = np.size(okf[i])
-            plt.semilogx(okf[i],ratio[i*nk:(i+1)*nk],label=round(myspec.zout[i],1), color=dist_col[i])
-
-        upper =  ((predicted[0] + std[0])/exact).reshape(-1, nk)
-        lower =  ((predicted[0]-std[0])/exact).reshape(-1, nk)
-        low = np.min(lower, axis=0)
-        low = np.concatenate([[low[0],], low])
-        upp = np.max(upper, axis=0)
-        upp = np.concatenate([[upp[0],], upp])
-        if showerr:
-            plt.fill_between(np.concatenate([[okf[0][0],], okf[-1]]),low, upp,alpha=0.3, color="grey")
-        #plt.yscale('log')
-        plt.xlabel(r"$k_F$ (s/km)")
-        plt.ylabel(r"Predicted/Exact")
-        plt.ylim(0.95,1.05)
-        plt.xticks([1e-3, 1e-2, 0.05],[r"$10^{-3}$",r"$10^{-2}$","0.05"])
-        name = params.build_dirname(pp, include_dense=True)
-#         plt.title(name)
-        plt.xlim(1e-3, 0.052)
-        if np.max(ratio) > 1.035:
-            plt.legend(loc='lower left', ncol=4)
-        else:
-            plt.legend(loc='upper left', ncol=4)
-        plt.tight_layout()
-        name_ending = ".pdf"
-        name = re.sub(r"\.","_",str(name))+plotname+name_ending
-        #So we can use it in a latex document
-        plt.savefig(os.path.join(savedir, name))
-        plt.clf()
-        #Make plot of errors
-        _plot_error_histogram(savedir, name, errrr, xlim=5., nbins=50)
-        print(name)
-
-        #Save output
-        array_savename = os.path.join(savedir, name[:-4] + '.npy')
-        np.save(array_savename, [okf, predicted[0], std[0], exact])
-
-    #Plot the distribution of errors, compared to a Gaussian
-    if np.all(np.isfinite(errlist)):
-        _plot_error_histogram(savedir, plotname, errlist, xlim=6., nbins=100)
-
+    if mean_flux == 2:
+        #In 'MeanFluxFactor' case: choose t0 point for fair comparison
+        test_par = np.concatenate([t0*np.ones((np.shape(test_par)[0], 1)), test_par], axis=1)
+    results = validate_emulator(gp, test_par, test_flux, len(myspec.zout))
+    names = [re.sub(r"\.","_",str(params.build_dirname(pp, include_dense=True)))+plotname+".pdf" for pp in test_par]
+    save_validation(os.path.join(savedir, savefile), results, params=test_par, kf=test_kf, exact=test_flux, zout=myspec.zout, names=names)
+    if plot:
+        plot_validation(savedir, names, test_kf, test_flux, results, myspec.zout, plotname=plotname, showerr=showerr, nprocs=nprocs)
     return gp, myspec.zout
 
 def plot_test_matter_interpolate(emulatordir,testdir, savedir=None, redshift=3.):
@@ -0,0 +1,137 @@
+"""Online convergence monitoring for MCMC chains.
+Statistics are updated from each new chunk of samples as it is produced,
+so checking convergence does not need the chain history.
+The chain itself is appended to a resizable HDF5 file in chunks."""
+import numpy as np
+import h5py
+
+class RunningMoments:
+    """Streaming (Welford) mean and variance, for an array of independent series.
+    Samples are along axis 1 of the data passed to update, so for a chain of shape
+    (nwalkers, nsteps, ndim) there is a separate mean and variance for each walker."""
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+
+    def update(self, data):
+        """Add a chunk of samples, merging its moments with the existing ones (Chan et al. 1979)."""
+        nnew = np.shape(data)[1]
+        if nnew == 0:
+            return
+        cmean = np.mean(data, axis=1)
+        cm2 = np.sum((data - cmean[:, np.newaxis])**2, axis=1)
+        if self.count == 0:
+            (self.count, self.mean, self.m2) = (nnew, cmean, cm2)
+            return
+        ntot = self.count + nnew
+        delta = cmean - self.mean
+        self.mean = self.mean + delta * nnew / ntot
+        self.m2 = self.m2 + cm2 + delta**2 * self.count * nnew / ntot
+        self.count = ntot
+
+    def var(self, ddof=1):
+        """Variance of each series."""
+        return self.m2 / (self.count - ddof)
+
+class OnlineConvergence:
+    """Incremental Gelman-Rubin and integrated autocorrelation time for an ensemble of walkers.
+    Each walker keeps running moments of its samples and of the means of batches of
+    batch_size consecutive samples. The autocorrelation time is estimated from the
+    batch means: tau = batch_size * var(batch means) / var(samples).
+    The chain is converged when R-hat < rtol and the chain is longer than ntau autocorrelation times,
+    for every parameter."""
+    def __init__(self, nwalkers, ndim, batch_size=50, rtol=1.01, ntau=50):
+        self.nwalkers = nwalkers
+        self.ndim = ndim
+        self.batch_size = batch_size
+        self.rtol = rtol
+        self.ntau = ntau
+        self.moments = RunningMoments()
+        self.batch_moments = RunningMoments()
+        #Samples not yet in a complete batch
+        self._partial = np.zeros((nwalkers, 0, ndim))
+
+    @property
+    def nsteps(self):
+        """Number of steps per walker seen so far."""
+        return self.moments.count
+
+    def update(self, chunk):
+        """Add a chunk of samples of shape (nwalkers, nsteps, ndim)."""
+        assert np.shape(chunk)[0] == self.nwalkers and np.shape(chunk)[2] == self.ndim
+        self.moments.update(chunk)
+        data = np.concatenate([self._partial, chunk], axis=1)
+        nbatch = np.shape(data)[1] // self.batch_size
+        nfull = nbatch * self.batch_size
+        if nbatch > 0:
+            bmeans = np.mean(np.reshape(data[:, :nfull], (self.nwalkers, nbatch, self.batch_size, self.ndim)), axis=2)
+            self.batch_moments.update(bmeans)
+        self._partial = data[:, nfull:]
+
+    def gelman_rubin(self):
+        """Gelman-Rubin statistic from the running moments. Same as likelihood.gelman_rubin on the full chain."""
+        n = self.moments.count
+        m = self.nwalkers
+        W = np.mean(self.moments.var(), axis=0)
+        tbb = np.mean(self.moments.mean, axis=0)
+        B = n / (m - 1) * np.sum((tbb - self.moments.mean)**2, axis=0)
+        var_t = (n - 1) / n * W + 1 / n * B
+        return np.sqrt(var_t / W)
+
+    def autocorr_time(self):
+        """Integrated autocorrelation time of each parameter, averaged over walkers.
+        Returns infinity until there are at least two batches."""
+        if self.batch_moments.count < 2:
+            return np.inf * np.ones(self.ndim)
+        tau = self.batch_size * self.batch_moments.var() / self.moments.var()
+        return np.mean(tau, axis=0)
+
+    def converged(self):
+        """Check the convergence criteria."""
+        if self.nsteps < 2:
+            return False
+        return np.all(self.gelman_rubin() < self.rtol) and np.all(self.nsteps > self.ntau * self.autocorr_time())
+
+class HDF5ChainBackend:
+    """Store an MCMC chain in a resizable HDF5 file, appending each chunk as it is produced.
+    The chain dataset has shape (nwalkers, nsteps, ndim), as emcee's chain attribute."""
+    def __init__(self, filename, nwalkers, ndim, pnames=None):
+        self.filename = filename
+        with h5py.File(filename, 'w') as save:
+            save.create_dataset("chain", shape=(nwalkers, 0, ndim), maxshape=(nwalkers, None, ndim), chunks=True, dtype=np.float64)
+            save.create_dataset("lnprob", shape=(nwalkers, 0), maxshape=(nwalkers, None), chunks=True, dtype=np.float64)
+            if pnames is not None:
+                save.attrs["pnames"] = [str(pp) for pp in pnames]
+
+    def append(self, chain, lnprob):
+        """Append a chunk of shape (nwalkers, nsteps, ndim) to the file."""
+        with h5py.File(self.filename, 'a') as save:
+            nold = np.shape(save["chain"])[1]
+            nnew = np.shape(chain)[1]
+            save["chain"].resize(nold + nnew, axis=1)
+            save["chain"][:, nold:] = chain
+            save["lnprob"].resize(nold + nnew, axis=1)
+            save["lnprob"][:, nold:] = lnprob
+
+    def get_flatchain(self):
+        """Get the chain with the walkers concatenated, as emcee's flatchain."""
+        chain = self.chain
+        return np.reshape(chain, (-1, np.shape(chain)[2]))
+
+    @property
+    def chain(self):
+        """The whole chain, read from the file, of shape (nwalkers, nsteps, ndim) as emcee's chain."""
+        with h5py.File(self.filename, 'r') as load:
+            return np.array(load["chain"])
+
+    @property
+    def flatchain(self):
+        """The whole chain with the walkers concatenated, as emcee's flatchain."""
+        return self.get_flatchain()
+
+    @property
+    def lnprobability(self):
+        """The log-likelihood of every sample, of shape (nwalkers, nsteps) as emcee's lnprobability."""
+        with h5py.File(self.filename, 'r') as load:
+            return np.array(load["lnprob"])
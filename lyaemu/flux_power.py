@@ -1,11 +1,13 @@
 """Modules to generate the flux power spectrum from a simulation box."""
 from __future__ import print_function
 import argparse
+import os
 import os.path
+import re
+import json
 import scipy.interpolate
 import numpy as np
-from fake_spectra import spectra
-from fake_spectra import abstractsnapshot as absn
+import h5py
 
 def rebin_power_to_kms(kfkms, kfmpc, flux_powers, zbins, omega_m, omega_l = None):
     """Rebins a power spectrum to constant km/s bins.
@@ -22,6 +24,31 @@ def rebin_power_to_kms(kfkms, kfmpc, flux_powers, zbins, omega_m, omega_l = None
     flux_rebinned = [rebinned[ii](okmsbins[ii]*velfac(zz)) for ii, zz in enumerate(zbins)]
     return okmsbins, flux_rebinned
 
+def rebin_power_to_kms_batch(kfkms, kfmpc, flux_powers, zbins, omega_m, omega_l = None):
+    """Rebin many power spectra to constant km/s bins at once, by linear interpolation as rebin_power_to_kms.
+    flux_powers has shape (N, nz*nk) and omega_m has shape (N,).
+    Returns the index of the first km/s bin inside the box, of shape (N, nz),
+    and the rebinned power, of shape (N, nz, nkfkms), which is NaN for bins larger than the box."""
+    omega_m = np.asarray(omega_m, dtype=np.float64)
+    if omega_l is None:
+        omega_l = 1 - omega_m
+    zbins = np.asarray(zbins)
+    nsamp = np.size(omega_m)
+    nz = np.size(zbins)
+    nk = np.size(kfmpc)
+    flux_powers = np.reshape(flux_powers, (nsamp, nz, nk))
+    velfac = 1./(1+zbins) * 100.0 * np.sqrt(omega_m[:, np.newaxis] * (1 + zbins)**3 + np.reshape(omega_l, (-1, 1)))
+    #k in Mpc/h units for each km/s bin: shape (N, nz, nkfkms)
+    kmpc = kfkms[np.newaxis, np.newaxis, :] * velfac[:, :, np.newaxis]
+    bindx = np.sum(kfkms[np.newaxis, np.newaxis, :] < np.min(kfmpc)/velfac[:, :, np.newaxis], axis=2)
+    ii = np.clip(np.searchsorted(kfmpc, kmpc) - 1, 0, nk - 2)
+    weight = (kmpc - kfmpc[ii]) / (kfmpc[ii+1] - kfmpc[ii])
+    lower = np.take_along_axis(flux_powers, ii, axis=2)
+    upper = np.take_along_axis(flux_powers, ii+1, axis=2)
+    rebinned = lower + weight * (upper - lower)
+    rebinned[np.arange(np.size(kfkms)) < bindx[:, :, np.newaxis]] = np.nan
+    return bindx, rebinned
+
 class FluxPower(object):
     """Class stores the flux power spectrum."""
     def __init__(self, maxk):
@@ -147,6 +174,7 @@ class MySpectra(object):
 
     def _get_spectra_snap(self, snap, base):
         """Get a snapshot with generated HI spectra"""
+        from fake_spectra import spectra
         #If savefile exists, reload. Otherwise do not.
         def mkspec(snap, base, cofm, axis, rf):
             """Helper function"""
@@ -180,23 +208,18 @@ class MySpectra(object):
         for a snapshot set."""
         #print('Looking for spectra in', base)
         powerspectra = FluxPower(maxk=self.max_k)
-        for snap in range(30):
-            snapdir = os.path.join(base,snappref+str(snap).rjust(3,'0'))
-            #We ran out of snapshots
-            if not os.path.exists(snapdir):
-                snapdir = os.path.join(base,"PART_"+str(snap).rjust(3,'0'))
-                if not os.path.exists(snapdir):
-                    snapdir = os.path.join(base, "snap_"+str(snap).rjust(3,'0'))
-                    if not os.path.exists(snapdir):
-                        continue
+        #The manifest knows the redshift of each snapshot, so we only open those we want.
+        for entry in get_snapshot_manifest(base, savefile=self.savefile, snappref=snappref):
             #We have all we need
             if powerspectra.len() == np.size(self.zout):
                 break
+            if entry["redshift"] is None or not self._check_redshift(entry["redshift"]):
+                continue
             try:
-                ss = self._get_spectra_snap(snap, base)
+                ss = self._get_spectra_snap(entry["snap"], base)
 #                 print('Found spectra in', ss)
                 if ss is not None:
-                    powerspectra.add_snapshot(snap,ss)
+                    powerspectra.add_snapshot(entry["snap"],ss)
             except IOError:
                 print("Didn't find any spectra because of IOError")
                 continue
@@ -205,8 +228,115 @@ class MySpectra(object):
             raise ValueError("Found only",powerspectra.len(),"of",np.size(self.zout),"from snaps:",powerspectra.snaps)
         return powerspectra
 
+def _spectra_savefile(base, snap, savefile):
+    """Path to the spectra savefile for a snapshot, following fake_spectra's choice of directory."""
+    savedir = os.path.join(base, "snapdir_"+str(snap).rjust(3,'0'))
+    if not os.path.exists(savedir):
+        savedir = os.path.join(base, "SPECTRA_"+str(snap).rjust(3,'0'))
+    return os.path.join(savedir, savefile)
+
+def _read_snapshot_redshift(base, snap, savefile):
+    """Get the redshift of a snapshot, from the header of the spectra savefile
+    if there is one (which is much smaller), and otherwise from the snapshot. None if neither can be read."""
+    sfile = _spectra_savefile(base, snap, savefile)
+    if os.path.exists(sfile):
+        try:
+            with h5py.File(sfile, 'r') as ff:
+                return float(ff["Header"].attrs["redshift"])
+        except (OSError, KeyError):
+            pass
+    try:
+        return 1./_get_header_attr_from_snap("Time", snap, base)-1.
+    except (IOError, KeyError, ValueError):
+        return None
+
+def _manifest_entry(base, snap, path, savefile):
+    """Make the manifest entry for one snapshot, reading its redshift."""
+    sfile = _spectra_savefile(base, snap, savefile)
+    hassave = os.path.exists(sfile)
+    return {"snap": snap, "path": path,
+            "redshift": _read_snapshot_redshift(base, snap, savefile),
+            "dirtime": os.path.getmtime(os.path.join(base, path)),
+            "savefile": hassave,
+            "savefile_mtime": os.path.getmtime(sfile) if hassave else None}
+
+def _entry_is_current(base, entry, savefile):
+    """Check a saved manifest entry still describes its snapshot: that the redshift could be read,
+    and neither the snapshot directory nor the spectra savefile has changed since."""
+    if entry.get("redshift") is None:
+        return False
+    sfile = _spectra_savefile(base, entry["snap"], savefile)
+    try:
+        if os.path.getmtime(os.path.join(base, entry["path"])) != entry.get("dirtime"):
+            return False
+        if os.path.exists(sfile):
+            return entry["savefile"] and os.path.getmtime(sfile) == entry["savefile_mtime"]
+    except OSError:
+        return False
+    return not entry["savefile"]
+
+def build_snapshot_manifest(base, savefile="lya_forest_spectra.hdf5", snappref="SPECTRA_", previous=None):
+    """Make a list of the snapshots in a simulation output directory with a single directory scan.
+    Each entry is a dictionary with the snapshot number, directory (and its modification time), redshift
+    and whether the spectra savefile exists (and its modification time). Sorted by snapshot number.
+    If the same snapshot is present with several prefixes, snappref is preferred, then PART_, then snap_.
+    Entries of a previous manifest which are still current are reused, rather than reading the redshift again."""
+    prefixes = [snappref, "PART_", "snap_"]
+    found = {}
+    with os.scandir(base) as entries:
+        for entry in entries:
+            mm = re.match(r"^(.+?)([0-9]{3})$", entry.name)
+            if mm is None or mm.group(1) not in prefixes:
+                continue
+            snap = int(mm.group(2))
+            rank = prefixes.index(mm.group(1))
+            if snap not in found or rank < found[snap][0]:
+                found[snap] = (rank, entry.name)
+    reuse = {entry["snap"]: entry for entry in (previous or []) if _entry_is_current(base, entry, savefile)}
+    manifest = []
+    for snap in sorted(found):
+        entry = reuse.get(snap)
+        if entry is None or entry["path"] != found[snap][1]:
+            entry = _manifest_entry(base, snap, found[snap][1], savefile)
+        manifest.append(entry)
+    return manifest
+
+def get_snapshot_manifest(base, savefile="lya_forest_spectra.hdf5", snappref="SPECTRA_", manifest_file="snapshot_manifest.json"):
+    """Get the snapshot manifest for a simulation, reusing the one saved in the output directory
+    if neither the directory nor any snapshot in it has changed since it was made.
+    Otherwise build and save a new one, reusing the entries of snapshots which have not changed.
+    Snapshots whose redshift could not be read are always checked again."""
+    fman = os.path.join(base, manifest_file)
+    try:
+        dirtime = os.path.getmtime(base)
+    except OSError:
+        return []
+    previous = None
+    try:
+        with open(fman, 'r') as jsin:
+            saved = json.load(jsin)
+        if saved["savefile"] == savefile and saved["snappref"] == snappref:
+            previous = saved["snapshots"]
+            if saved["dirtime"] == dirtime and all(_entry_is_current(base, entry, savefile) for entry in previous):
+                return previous
+    except (OSError, ValueError, KeyError, TypeError):
+        previous = None
+    manifest = build_snapshot_manifest(base, savefile=savefile, snappref=snappref, previous=previous)
+    try:
+        #Creating the manifest file changes the directory time, so do it before recording the time.
+        if not os.path.exists(fman):
+            open(fman, 'w').close()
+        saved = {"snapshots": manifest, "savefile": savefile, "snappref": snappref, "dirtime": os.path.getmtime(base)}
+        with open(fman, 'w') as jsout:
+            json.dump(saved, jsout)
+    except OSError:
+        #Read-only simulation directory: we just rebuild the manifest each time.
+        pass
+    return manifest
+
 def _get_header_attr_from_snap(attr, num, base):
     """Get a header attribute from a snapshot, if it exists."""
+    from fake_spectra import abstractsnapshot as absn
     f = absn.AbstractSnapshotFactory(num, base)
     value = f.get_header_attr(attr)
     del f
@@ -0,0 +1,175 @@
+"""Out-of-core storage for the flux vectors used to train an emulator.
+Flux vectors are kept in a chunked, resizable HDF5 file with one row per (simulation, mean flux) pair.
+Each row is keyed by the simulation directory it was extracted from and its parameter vector,
+so that new simulations can be appended without rewriting or recomputing the existing rows,
+and rows are only read from disc when they are requested.
+Each row also stores an identity string, built from the contents of the simulation's
+SimulationICs.json, the modification time of its spectra files and the mean flux values used.
+A row whose identity no longer matches is stale and is recomputed on its own."""
+import os.path
+import glob
+import hashlib
+import numpy as np
+import h5py
+
+def simulation_identity(simdir, spectra_file="lya_forest_spectra.hdf5"):
+    """Identity of a simulation directory: a hash of its SimulationICs.json
+    and the latest modification time of its spectra files."""
+    sha = hashlib.sha1()
+    try:
+        with open(os.path.join(simdir, "SimulationICs.json"), 'rb') as jsin:
+            sha.update(jsin.read())
+    except OSError:
+        pass
+    spectra = glob.glob(os.path.join(simdir, "output", "*", spectra_file))
+    mtime = max([os.path.getmtime(ss) for ss in spectra], default=0.)
+    return sha.hexdigest()[:16] + ":%.6f" % mtime
+
+def mean_flux_identity(mean_fluxes, zout):
+    """Identity of the mean flux values (as a function of redshift) used to generate a flux vector."""
+    sha = hashlib.sha1()
+    sha.update(np.array(zout, dtype=np.float64).round(6).tobytes())
+    if mean_fluxes is not None:
+        sha.update(np.array(mean_fluxes, dtype=np.float64).round(12).tobytes())
+    return sha.hexdigest()[:16]
+
+class FluxVectorStore:
+    """A resizable HDF5 store for flux vectors.
+       Datasets are:
+           params - the (dense and sparse) parameters of each row.
+           simdirs - the simulation directory (relative to the emulator base directory) of each row.
+           identities - the identity string of each row, from simulation_identity and mean_flux_identity.
+           flux_vectors - the flux power spectrum, in native binning, of each row.
+           kfkms - the k values of each row in km/s units, as a function of redshift.
+           kfmpc - the k values in comoving Mpc/h units, which are the same for every row.
+       classname is stored as an attribute and should match the emulator class which made the file."""
+    def __init__(self, filename, classname):
+        self.filename = filename
+        self.classname = classname
+        #Relative tolerance for two parameter vectors to be the same row
+        self.ptol = 1e-6
+
+    def exists(self):
+        """Does the store exist on disc?"""
+        return os.path.exists(self.filename)
+
+    def is_compatible(self, kfmpc=None, nfv=None):
+        """Check that the file on disc was written in this format by the same emulator class,
+        and (optionally) with the same k bins and flux vector length."""
+        if not self.exists():
+            return False
+        try:
+            with h5py.File(self.filename, 'r') as load:
+                name = str(load.attrs["classname"])
+                if "simdirs" not in load or "params" not in load or "identities" not in load:
+                    return False
+                if kfmpc is not None:
+                    stored = np.array(load["kfmpc"])
+                    if np.shape(stored) != np.shape(kfmpc) or np.any(np.abs(stored/kfmpc - 1) > 1e-5):
+                        return False
+                if nfv is not None and np.shape(load["flux_vectors"])[1] != nfv:
+                    return False
+        except (OSError, KeyError):
+            return False
+        return name.split(".")[-1] == self.classname.split(".")[-1]
+
+    def clear(self):
+        """Remove the store from disc."""
+        if self.exists():
+            os.remove(self.filename)
+
+    def nrows(self):
+        """Number of rows in the store."""
+        if not self.exists():
+            return 0
+        with h5py.File(self.filename, 'r') as load:
+            return np.shape(load["params"])[0]
+
+    def get_keys(self):
+        """Get the simulation directory, parameters and identity of every row.
+        These are small, so are read in full."""
+        _str = lambda ss: ss.decode() if isinstance(ss, bytes) else str(ss)
+        with h5py.File(self.filename, 'r') as load:
+            simdirs = [_str(ss) for ss in load["simdirs"][:]]
+            params = np.array(load["params"])
+            identities = [_str(ss) for ss in load["identities"][:]]
+        return simdirs, params, identities
+
+    def find_rows(self, simdirs, aparams, identities=None):
+        """Find the row of the store holding each (simulation directory, parameter vector) pair.
+        Returns an array of row indices, which is -1 for rows not in the store,
+        and a boolean array which is True for rows which are in the store
+        but whose identity does not match the one given (and so are stale)."""
+        rows = -1 * np.ones(len(simdirs), dtype=int)
+        stale = np.zeros(len(simdirs), dtype=bool)
+        if not self.is_compatible():
+            return rows, stale
+        (insims, inparams, inids) = self.get_keys()
+        if np.shape(inparams)[1:] != np.shape(aparams)[1:]:
+            return rows, stale
+        bysim = {}
+        for ii, ss in enumerate(insims):
+            bysim.setdefault(ss, []).append(ii)
+        for jj, (ss, pp) in enumerate(zip(simdirs, aparams)):
+            for ii in bysim.get(ss, []):
+                if np.all(np.abs(inparams[ii] - pp) <= self.ptol * np.abs(pp)):
+                    rows[jj] = ii
+                    stale[jj] = identities is not None and inids[ii] != identities[jj]
+        return rows, stale
+
+    def read_rows(self, rows):
+        """Read the flux vectors and k values for a list of rows, in the order given.
+        Only the requested rows are read from disc."""
+        rows = np.asarray(rows, dtype=int)
+        assert np.all(rows >= 0)
+        #h5py needs increasing indices for a selection
+        (uniq, inverse) = np.unique(rows, return_inverse=True)
+        with h5py.File(self.filename, 'r') as load:
+            flux_vectors = load["flux_vectors"][uniq, :][inverse]
+            kfkms = load["kfkms"][uniq][inverse]
+            kfmpc = np.array(load["kfmpc"])
+        return kfmpc, kfkms, flux_vectors
+
+    def update(self, rows, identities, kfkms, flux_vectors):
+        """Overwrite the flux vectors and identities of some (stale) rows in place."""
+        rows = np.asarray(rows, dtype=int)
+        with h5py.File(self.filename, 'a') as save:
+            for jj, ii in enumerate(rows):
+                save["flux_vectors"][ii] = flux_vectors[jj]
+                save["kfkms"][ii] = kfkms[jj]
+                save["identities"][ii] = identities[jj]
+
+    def append(self, simdirs, aparams, kfmpc, kfkms, flux_vectors, identities=None):
+        """Append new rows to the store, creating it if needed.
+        Existing rows are not modified. Returns the indices of the new rows."""
+        if identities is None:
+            identities = [""]*len(simdirs)
+        aparams = np.array(aparams, ndmin=2)
+        flux_vectors = np.array(flux_vectors, ndmin=2)
+        kfkms = np.array(kfkms)
+        nnew = np.shape(aparams)[0]
+        assert len(simdirs) == nnew
+        assert np.shape(flux_vectors)[0] == nnew and np.shape(kfkms)[0] == nnew
+        if self.exists() and not self.is_compatible(kfmpc=kfmpc, nfv=np.shape(flux_vectors)[1]):
+            self.clear()
+        if not self.exists():
+            with h5py.File(self.filename, 'w') as save:
+                save.attrs["classname"] = self.classname
+                save.create_dataset("params", data=aparams, maxshape=(None,)+np.shape(aparams)[1:], chunks=True)
+                save.create_dataset("simdirs", data=np.array(simdirs, dtype=object), dtype=h5py.string_dtype(), maxshape=(None,), chunks=True)
+                save.create_dataset("identities", data=np.array(identities, dtype=object), dtype=h5py.string_dtype(), maxshape=(None,), chunks=True)
+                #Chunk by row so that single rows can be read cheaply
+                save.create_dataset("flux_vectors", data=flux_vectors, maxshape=(None,)+np.shape(flux_vectors)[1:], chunks=(1,)+np.shape(flux_vectors)[1:])
+                save.create_dataset("kfkms", data=kfkms, maxshape=(None,)+np.shape(kfkms)[1:], chunks=(1,)+np.shape(kfkms)[1:])
+                save["kfmpc"] = kfmpc
+            return np.arange(nnew)
+        with h5py.File(self.filename, 'a') as save:
+            nold = np.shape(save["params"])[0]
+            for name, data in (("params", aparams), ("flux_vectors", flux_vectors), ("kfkms", kfkms)):
+                assert np.shape(save[name])[1:] == np.shape(data)[1:]
+                save[name].resize(nold + nnew, axis=0)
+                save[name][nold:] = data
+            for name, data in (("simdirs", simdirs), ("identities", identities)):
+                save[name].resize(nold + nnew, axis=0)
+                save[name][nold:] = np.array(data, dtype=object)
+        return np.arange(nold, nold+nnew)
@@ -1,5 +1,5 @@
+import os.path
 import numpy
-import asciitable
 #import scipy
 import scipy.interpolate as spi
 import scipy.special as sps
@@ -46,21 +46,13 @@ lowval=1E-5
 ### Auxiliary Functions ###
 ###########################
 
-# write TREECOOL file
+# write TREECOOL file: all rows at once
 def write_TREECOOL(fout,lz,photo_new,QDeltaT=False):
-    pf=open(fout,'w')
-    if QDeltaT==False: # standard out
-        for i in range(len(lz)):
-            pf.write("%f %e %e %e %e %e %e\n" %
-                (lz[i],photo_new[0,i],photo_new[1,i],photo_new[2,i],
-                    photo_new[3,i],photo_new[4,i],photo_new[5,i]) )
-    else: # Delta T format
+    cols=[lz]+[photo_new[i] for i in range(6)]
+    if QDeltaT!=False: # Delta T format
         dTHdz,dTHedz=QDeltaT
-        for i in range(len(lz)):
-            pf.write("%f %e %e %e %e %e %e %e %e\n" %
-                (lz[i],photo_new[0,i],photo_new[1,i],photo_new[2,i],
-                    photo_new[3,i],photo_new[4,i],photo_new[5,i],
-                    dTHdz[i],dTHedz[i]) )
+        cols+=[dTHdz,dTHedz]
+    numpy.savetxt(fout,numpy.column_stack(cols),fmt=["%f"]+["%e"]*(len(cols)-1))
     return
 
 def fzcut(z,zcut):
@@ -69,46 +61,72 @@ def fzcut(z,zcut):
     #return ncut
     return numpy.where(z == numpy.max(z[z <= zcut]))[0][0]
 
+# trapezium rule integral of y over z
 def fint(z,y):
-    yint=numpy.trapz(y,z)
+    yint=numpy.sum(0.5*(y[1:]+y[:-1])*numpy.diff(z))
     return yint
 
+# integral of y from each z to the last z: one reverse cumulative sum
 def fintarray(z,y):
     yinta=numpy.zeros(len(z))
-    for i in range(len(z)-1):
-        yinta[i]=numpy.trapz(y[i:],z[i:])
+    segs=0.5*(y[1:]+y[:-1])*numpy.diff(z)
+    yinta[:-1]=numpy.cumsum(segs[::-1])[::-1]
     return yinta
 
 def fdQdz(z,Q):
     dQdz=numpy.zeros(len(z))
-    fDQ=spi.interp1d(z,Q,kind='linear')
     # Create new bins to better define the derivate at our desired
     # values which are z values
     bz=(z[:-1]+z[1:])/2. #new z values; binning done so center are the z values
-    Q_new=fDQ(bz) # values of DeltaT at the new z values
+    Q_new=(Q[:-1]+Q[1:])/2. # values of Q at the new z values: linear interpolation to the midpoints
     dQ=numpy.abs(Q_new[1:]-Q_new[:-1]) # just interested in the absolute value
     dz=bz[1:]-bz[:-1] # bin sizes 
     # First and last value is always =0 
     dQdz[1:-1]=dQ/dz
     return dQdz
 
-def interpUVB(model):
-    if model=='HM12':
-        data=asciitable.read("FIXME")
-    elif model=="OHL16": # this is our corrected model to match observations
-        data=asciitable.read("FIXME")
-    elif model=="P18":
-        data=asciitable.read("data/TREECOOL_P18.txt")
+# TREECOOL files for the UVB models, in the package data directory.
+# Only P18 is shipped with the package: the others must be copied there.
+UVB_DATADIR=os.path.join(os.path.dirname(os.path.abspath(__file__)),"data")
+UVB_FILES={'HM12':"TREECOOL_HM12.txt",
+        'OHL16':"TREECOOL_OHL16.txt", # this is our corrected model to match observations
+        'P18':"TREECOOL_P18.txt"}
+
+# load a UVB model table: a model name from UVB_FILES or the path to a TREECOOL file.
+# A binary copy is saved next to the text file (if possible) and used while it is newer than the text.
+def loadUVB(model):
+    if model in UVB_FILES:
+        fname=os.path.join(UVB_DATADIR,UVB_FILES[model])
+    elif os.path.exists(model):
+        fname=model
     else:
-        print('ERROR, model not defined: %s'%(model))
-    lz = data['col1']
-    fpiHI=spi.interp1d(lz,data['col2'],kind='linear')
-    fpiHeI=spi.interp1d(lz,data['col3'],kind='linear')
-    fpiHeII=spi.interp1d(lz,data['col4'],kind='linear')
-    fphHI=spi.interp1d(lz,data['col5'],kind='linear')
-    fphHeI=spi.interp1d(lz,data['col6'],kind='linear')
-    fphHeII=spi.interp1d(lz,data['col7'],kind='linear')
-    return [lz,fpiHI,fpiHeI,fpiHeII,fphHI,fphHeI,fphHeII]
+        raise ValueError('ERROR, model not defined: %s'%(model))
+    fcache=os.path.splitext(fname)[0]+".npy"
+    if os.path.exists(fcache) and os.path.getmtime(fcache)>=os.path.getmtime(fname):
+        return numpy.load(fcache)
+    data=numpy.loadtxt(fname)
+    try:
+        numpy.save(fcache,data)
+    except OSError:
+        pass
+    return data
+
+# UVB model interpolators, built once per model
+_UVB_CACHE={}
+
+def interpUVB(model):
+    if model in _UVB_CACHE:
+        return _UVB_CACHE[model]
+    data=loadUVB(model)
+    lz = data[:,0]
+    fpiHI=spi.interp1d(lz,data[:,1],kind='linear')
+    fpiHeI=spi.interp1d(lz,data[:,2],kind='linear')
+    fpiHeII=spi.interp1d(lz,data[:,3],kind='linear')
+    fphHI=spi.interp1d(lz,data[:,4],kind='linear')
+    fphHeI=spi.interp1d(lz,data[:,5],kind='linear')
+    fphHeII=spi.interp1d(lz,data[:,6],kind='linear')
+    _UVB_CACHE[model]=[lz,fpiHI,fpiHeI,fpiHeII,fphHI,fphHeI,fphHeII]
+    return _UVB_CACHE[model]
 
 ####### COSMOLOGY
 #Find Hubble parameter
@@ -151,16 +169,11 @@ def calc_alphaB(T0=2E4,alpha='Nyx'):
 # calc case B HeII recombination coeff
 def calc_alphaBHeII(T0=2E4):
     ###### Nyx
-    if isinstance(T0, (float,int)): T0=numpy.array([T0]) #,long
-    alphaB_F=numpy.zeros(len(T0))
-    for i in range(len(T0)):
-        T=T0[i]
-        if T<= 1E6:
-            a=3.294E-11;b=0.6910;Tf0=15.54;Tf1=3.676E7
-        else:
-            a=9.356E-10;b=0.7892;Tf0=4.266E-2;Tf1=4.677E6
-        alphaB_F[i]=falpha(T,a,b,Tf0,Tf1) 
-        alphaB_F[i]=alphaB_F[i]*(cm2Mpc**3.)
+    T0=numpy.atleast_1d(numpy.asarray(T0,dtype=float))
+    low=T0<=1E6 # fits are different above and below 1E6 K
+    a=numpy.where(low,3.294E-11,9.356E-10);b=numpy.where(low,0.6910,0.7892)
+    Tf0=numpy.where(low,15.54,4.266E-2);Tf1=numpy.where(low,3.676E7,4.677E6)
+    alphaB_F=falpha(T0,a,b,Tf0,Tf1)*(cm2Mpc**3.)
     if len(T0)==1:
         alphaB_F=alphaB_F[0]
     return alphaB_F # in Mpc^3/s
@@ -400,25 +413,48 @@ def genQ2G_DeltaT(z,QHII,zcutH,QHeIII,zcutHe,
         write_TREECOOL(fout,lz,photo_new,QDeltaT=False)
     return z,photo_new
 
+# zzero may be an array with one value per row, for example zzero[:,None] with listz[None,:]
 def myfQHII_2(listz,zzero,n1=50.,n2=1.,norm=0.5):
-    QHII=numpy.zeros(len(listz))
-    for i in range(len(listz)):
-        z=listz[i]
-        x=numpy.abs(z-zzero)
-        sgn=numpy.sign(z-zzero)
-        if (z-zzero)<=0:
-            f=0.5+norm*sps.gammainc(1./n1,x**n1)
-        else:
-            f=0.5-norm*sps.gammainc(1./n2,x**n2)
-        if f>1.0:
-            f=1.0
-        elif f<0.0:
-            f=0.0
-        QHII[i]=f
-        QHII[0]=1.
-        QHII[-1]=0.
+    dz=listz-zzero
+    x=numpy.abs(dz)
+    flow=0.5+norm*sps.gammainc(1./n1,x**n1)
+    fhigh=0.5-norm*sps.gammainc(1./n2,x**n2)
+    QHII=numpy.clip(numpy.where(dz<=0,flow,fhigh),0.0,1.0)
+    QHII[...,0]=1.
+    QHII[...,-1]=0.
     return QHII
 
+# HeIII filling factor: arctan model, =1 for z below about zend
+def myfQHeIII(listz,zend):
+    return numpy.clip(1.-numpy.arctan(listz-zend),0.0,1.0)
+
+# redshift where HI reionization finishes (QHII=1)
+def fzendHII(listz,QHII):
+    return numpy.max(listz[QHII==1.])
+
+# Batch version of genQ2G_DeltaT, for many reionization histories on the same redshifts.
+# zmidHII, zHeIII, DeltaTHI, DeltaTHeII are arrays with one value per history:
+# midpoint of HI reionization (for myfQHII_2), end of HeII reionization (for myfQHeIII) and heat injections.
+# fouts is an optional list of TREECOOL file names, one per history.
+# Returns z and the rates, shape (nhistories,6,len(z))
+def genQ2G_DeltaT_batch(z,zmidHII,zHeIII,DeltaTHI,DeltaTHeII,
+        model='OHL16',
+        cosmo=[0.702,0.046,0.275,0.725,0.76],
+        Gthreshold=True,
+        n1=50.,n2=1.,
+        fouts=None):
+    zmidHII,zHeIII,DeltaTHI,DeltaTHeII=numpy.broadcast_arrays(numpy.atleast_1d(zmidHII),zHeIII,DeltaTHI,DeltaTHeII)
+    QHII=myfQHII_2(z[numpy.newaxis,:],zmidHII[:,numpy.newaxis],n1=n1,n2=n2)
+    QHeIII=myfQHeIII(z[numpy.newaxis,:],zHeIII[:,numpy.newaxis])
+    photo=numpy.zeros((len(zmidHII),6,len(z)))
+    for i in range(len(zmidHII)):
+        fout=None
+        if fouts is not None:
+            fout=fouts[i]
+        _,photo[i]=genQ2G_DeltaT(z,QHII[i],fzendHII(z,QHII[i]),QHeIII[i],zHeIII[i],
+                DeltaTHI[i],DeltaTHeII[i],model=model,cosmo=cosmo,Gthreshold=Gthreshold,fout=fout)
+    return z,photo
+
 ################
 # Example run  #
 ################
@@ -2,18 +2,33 @@
 # from datetime import datetime
 import copy as cp
 import numpy as np
+import scipy.linalg
 from .latin_hypercube import map_to_unit_cube_list
-#Make sure that we don't accidentally
-#get another backend when we import GPy.
-import matplotlib
-matplotlib.use('PDF')
-import GPy
+from . import profiling
+
+def _import_gpy():
+    """Import GPy on first use, as it is slow to import and
+    not needed by processes which never train an emulator."""
+    #Make sure that we don't accidentally
+    #get another backend when we import GPy.
+    import matplotlib
+    matplotlib.use('PDF')
+    import GPy
+    return GPy
+
+def simulation_folds(params, ndense=0):
+    """Label each training point with the simulation it came from, for cross-validation.
+    Points from the same simulation share all but the first ndense (mean flux) parameters."""
+    (_, labels) = np.unique(np.array(params)[:, ndense:], axis=0, return_inverse=True)
+    return np.ravel(labels)
 
 class MultiBinGP:
     """A wrapper around the emulator that constructs a separate emulator for each bin.
     Each one has a separate mean flux parameter.
-    The t0 parameter fed to the emulator should be constant factors."""
-    def __init__(self, *, params, kf, powers, param_limits, singleGP=None):
+    The t0 parameter fed to the emulator should be constant factors.
+    ndense is the number of leading (mean flux) parameters which vary between training points
+    from the same simulation: it is used to leave out whole simulations in cross_validate."""
+    def __init__(self, *, params, kf, powers, param_limits, singleGP=None, ndense=0):
         #Build an emulator for each redshift separately. This means that the
         #mean flux for each bin can be separated.
         if singleGP is None:
@@ -25,28 +40,49 @@ class MultiBinGP:
         gp = lambda i: singleGP(params=params, powers=powers[:,i*self.nk:(i+1)*self.nk], param_limits = param_limits)
         print('Number of redshifts for emulator generation =', self.nz)
         self.gps = [gp(i) for i in range(self.nz)]
+        self.simulation_folds = simulation_folds(params, ndense)
+        #Incremented when the updated training set changes, so cached predictions can be invalidated.
+        self.training_set_version = 0
 
+    @profiling.profiled("MultiBinGP.predict")
     def predict(self,params, tau0_factors = None, use_updated_training_set=False):
-        """Get the predicted flux at a parameter value (or list of parameter values)."""
-        std = np.zeros([1,self.nk*self.nz])
-        means = np.zeros([1,self.nk*self.nz])
+        """Get the predicted flux at a parameter value (or list of parameter values).
+        params has shape (N, nparams). tau0_factors has shape (nz,), or (N, nz) for a different
+        mean flux slope for each parameter vector. Returns means and std of shape (N, nz*nk)."""
+        params = np.array(params, ndmin=2)
+        nsamp = np.shape(params)[0]
+        std = np.zeros([nsamp,self.nk*self.nz])
+        means = np.zeros([nsamp,self.nk*self.nz])
+        if tau0_factors is not None:
+            tau0_factors = np.array(tau0_factors, ndmin=2)
         for i, gp in enumerate(self.gps): #Looping over redshifts
             #Adjust the slope of the mean flux for this bin
             zparams = np.array(params)
             if tau0_factors is not None:
-                zparams[0][0] *= tau0_factors[i] #Multiplying t0[z] by "tau0_factors"[z]
+                zparams[:,0] *= tau0_factors[:,i] #Multiplying t0[z] by "tau0_factors"[z]
             if not use_updated_training_set:
                 (m, s) = gp.predict(zparams)
             else:
                 (m, s) = gp.predict_from_updated_training_set(zparams)
-            means[0,i*self.nk:(i+1)*self.nk] = m
+            means[:,i*self.nk:(i+1)*self.nk] = m
             std[:,i*self.nk:(i+1)*self.nk] = s
         return means, std
 
+    def cross_validate(self, folds="simulation"):
+        """Cross-validate the emulator on its own training set, for all redshifts.
+        By default each simulation (with all its mean flux samples) is left out in turn.
+        folds=None leaves out one training point at a time; other values are as for SkLearnGP.cross_validate.
+        Returns means, std and normalised residuals, of shape (ntrain, nz*nk) in the same layout as predict."""
+        if isinstance(folds, str) and folds == "simulation":
+            folds = self.simulation_folds
+        results = [gp.cross_validate(folds=folds) for gp in self.gps]
+        return tuple(np.concatenate([res[j] for res in results], axis=1) for j in range(3))
+
     def add_to_training_set(self, new_params):
         """Add to training set and update emulator (without re-training) -- for all redshifts"""
         for i in range(self.nz): #Loop over redshifts
             self.gps[i].add_to_training_set(new_params)
+        self.training_set_version += 1
 
 class SkLearnGP:
     """An emulator wrapping a GP code.
@@ -86,6 +122,7 @@ class SkLearnGP:
         #Normalise by the median value
         normspectra = flux_vectors/self.scalefactors -1.
 
+        GPy = _import_gpy()
         #Standard squared-exponential kernel with a different length scale for each parameter, as
         #they may have very different physical properties.
         kernel = GPy.kern.Linear(nparams)
@@ -148,6 +185,41 @@ class SkLearnGP:
         (or list of parameter values) -- using updated training set"""
         return self._predict(params, GP_instance=self.gp_updated)
 
+    def cross_validate(self, folds=None):
+        """Leave-one-out or k-fold cross-validation on the training set, with the hyperparameters fixed.
+        For an exact GP the prediction for a left-out set I is known in closed form from
+        alpha = K^-1 y and the inverse kernel matrix (Rasmussen & Williams 5.4.2):
+            mean_I = y_I - [K^-1]_II^-1 alpha_I, cov_I = [K^-1]_II^-1
+        so no GP is re-fitted.
+        folds - None for leave-one-out. Otherwise an integer k, to leave out every k-th training point
+                in turn, or an array with the fold label of each training point, so that for example
+                all the mean flux samples of a simulation can be left out together.
+        Returns the predicted mean and std for each training point when it is left out,
+        and the normalised residual (predicted - exact)/std, all of shape (ntrain, nk)."""
+        gp = self.gp
+        ntrain = np.shape(gp.X)[0]
+        #Invert through the Cholesky factor, for stability
+        cinv = scipy.linalg.solve_triangular(gp.posterior.woodbury_chol, np.eye(ntrain), lower=True)
+        kinv = np.dot(cinv.T, cinv)
+        alpha = gp.posterior.woodbury_vector
+        if folds is None:
+            var = 1./np.diag(kinv)
+            resid = alpha * var[:, np.newaxis]
+        else:
+            if np.size(folds) == 1:
+                folds = np.arange(ntrain) % int(folds)
+            var = np.zeros(ntrain)
+            resid = np.zeros_like(alpha)
+            for label in np.unique(folds):
+                ind = np.where(folds == label)[0]
+                kcov = np.linalg.inv(kinv[np.ix_(ind, ind)])
+                resid[ind] = np.dot(kcov, alpha[ind])
+                var[ind] = np.diag(kcov)
+        exact = (gp.Y + 1) * self.scalefactors
+        mean = (gp.Y - resid + 1) * self.scalefactors
+        std = np.sqrt(var)[:, np.newaxis] * self.scalefactors
+        return mean, std, (mean - exact)/std
+
     def get_predict_error(self, test_params, test_exact):
         """Get the difference between the predicted GP
         interpolation and some exactly computed test parameters."""
@@ -1,21 +1,28 @@
 """Module for computing the likelihood function for the forest emulator."""
 import math
+import copy
+from collections import OrderedDict
 from datetime import datetime
-import mpmath as mmh
 import numpy as np
 import numpy.linalg as npl
 import numpy.random as npr
 import numpy.testing as npt
-import scipy.optimize as spo
-import scipy.interpolate
-import emcee
+import scipy.linalg
 from . import coarse_grid
+from . import convergence
 from . import flux_power
 from . import lyman_data
 from . import mean_flux as mflux
+from . import pools
+from . import profiling
+from . import shared_emulator
 from .latin_hypercube import map_to_unit_cube, map_from_unit_cube
 from .quadratic_emulator import QuadraticEmulator
 
+#flux_power.py is also run as a standalone script in each simulation directory,
+#so it cannot import profiling itself: time it here instead.
+_rebin_power_to_kms = profiling.profiled("rebin_power_to_kms")(flux_power.rebin_power_to_kms)
+
 def _siIIIcorr(kf):
     """For precomputing the shape of the SiIII correlation"""
     #Compute bin boundaries in logspace.
@@ -61,6 +68,29 @@ def invert_block_diagonal_covariance(full_covariance_matrix, n_blocks):
         inverse_covariance_matrix[start_index: end_index, start_index: end_index] = inverse_covariance_block
     return inverse_covariance_matrix
 
+#The likelihood object of a worker process, set once by _init_pool_worker
+_POOL_LIKE = None
+_POOL_INCLUDE_EMU = True
+
+def _init_pool_worker(like, include_emu):
+    """Initialise a worker process for parallel sampling with a LikelihoodClass, once."""
+    global _POOL_LIKE, _POOL_INCLUDE_EMU
+    _POOL_LIKE = like
+    _POOL_INCLUDE_EMU = include_emu
+
+def _init_pool_worker_shared(like, descriptor, include_emu):
+    """Initialise a worker process with a LikelihoodClass whose emulator and
+    data covariance are attached from shared memory."""
+    gpemu = shared_emulator.attach_emulator(descriptor)
+    like.gpemu = gpemu
+    like._BOSS_covar = dict(enumerate(gpemu.covariances))
+    _init_pool_worker(like, include_emu)
+
+def _pool_likelihood(params):
+    """Likelihood in a worker process. This is a module-level function so that
+    only the parameters and the result are sent between processes."""
+    return _POOL_LIKE.likelihood(params, include_emu=_POOL_INCLUDE_EMU)
+
 def load_data(datadir, *, kf, max_z=4.2, t0=1.):
     """Load and initialise a "fake data" flux power spectrum"""
     #Load the data directory
@@ -73,8 +103,12 @@ def load_data(datadir, *, kf, max_z=4.2, t0=1.):
 
 class LikelihoodClass:
     """Class to contain likelihood computations."""
-    def __init__(self, basedir, mean_flux='s', max_z = 4.2, emulator_class="standard", t0_training_value = 1., optimise_GP=True, emulator_json_file='emulator_params.json'):
-        """Initialise the emulator by loading the flux power spectra from the simulations."""
+    def __init__(self, basedir, mean_flux='s', max_z = 4.2, emulator_class="standard", t0_training_value = 1., optimise_GP=True, emulator_json_file='emulator_params.json', debug=False):
+        """Initialise the emulator by loading the flux power spectra from the simulations.
+        If debug is True, consistency checks are run on every likelihood evaluation."""
+        self.debug = debug
+        #Set by get_emulator below, unless optimise_GP is False
+        self.gpemu = None
 
         #Stored BOSS covariance matrix
         self._inverse_BOSS_covariance_full = None
@@ -130,28 +164,117 @@ class LikelihoodClass:
         assert np.shape(self.param_limits)[1] == 2
         print('Beginning to generate emulator at', str(datetime.now()))
         if optimise_GP:
-            self.gpemu = self.emulator.get_emulator(max_z=max_z)
+            with profiling.timed("LikelihoodClass.get_emulator"):
+                self.gpemu = self.emulator.get_emulator(max_z=max_z)
         print('Finished generating emulator at', str(datetime.now()))
+        self._setup_likelihood()
+
+    def _setup_likelihood(self):
+        """Check the data and emulator are consistent and cache what the likelihood needs,
+        so that these checks are done once rather than on every evaluation."""
+        #Redshifts
+        sdssz = self.sdss.get_redshifts()
+        #Fix maximum redshift bug
+        sdssz = sdssz[sdssz <= self.max_z]
+        #Important assertion
+        npt.assert_allclose(sdssz, self.zout, atol=1.e-16)
+        self._sdssz = sdssz
+        #Covariance matrix for each redshift bin. Not to be modified.
+        self._BOSS_covar = {}
+        for zbin in range(np.size(sdssz)):
+            self._BOSS_covar[zbin] = self.sdss.get_covar(sdssz[zbin])
+            self._BOSS_covar[zbin].setflags(write=False)
+        ndense = len(self.emulator.mf.dense_param_names)
+        self._hindex = ndense + self.emulator.param_names["hub"]
+        #The prior means the hubble parameter is always in range.
+        hlimits = self.param_limits[self._hindex + int(self.mf_slope)]
+        assert 0.5 <= hlimits[0] and hlimits[1] <= 1
+        nkf = np.size(self.kf)
+        #Work space for the covariance matrix
+        self._covar_work = np.empty((nkf, nkf))
+        #Cholesky factors of the data covariance for each (redshift bin, first k bin)
+        self._data_cholesky = {}
+        #LRU cache of emulator predictions
+        self.prediction_cache_size = 1000
+        self.clear_prediction_cache()
+
+    @property
+    def gpemu(self):
+        """The emulator. Replacing it empties the prediction cache."""
+        return self._gpemu
+
+    @gpemu.setter
+    def gpemu(self, gpemu):
+        self._gpemu = gpemu
+        #Part of the prediction cache key. Unlike id(gpemu) it is never reused by a new emulator.
+        self._emulator_generation = getattr(self, "_emulator_generation", 0) + 1
+        self.clear_prediction_cache()
+
+    def clear_prediction_cache(self):
+        """Empty the cache of emulator predictions. This is done when the emulator is replaced,
+        but must be called if it is retrained in place. Adding to the training set of a MultiBinGP
+        is detected automatically."""
+        self._prediction_cache = OrderedDict()
+        self._prediction_cache_hits = 0
+        self._prediction_cache_misses = 0
+
+    def prediction_cache_stats(self):
+        """Get the number of hits and misses of the prediction cache, and its hit rate."""
+        ncalls = self._prediction_cache_hits + self._prediction_cache_misses
+        return {"hits": self._prediction_cache_hits, "misses": self._prediction_cache_misses,
+                "hit_rate": self._prediction_cache_hits / max(ncalls, 1), "size": len(self._prediction_cache)}
+
+    def _prediction_key(self, params, use_updated_training_set):
+        """Key for the prediction cache: the parameters quantised to a fraction 1e-12 of the prior range.
+        The tau0 factors are a function of the parameters, so they are included.
+        Predictions from the updated training set also depend on its version,
+        and all predictions depend on the generation of the emulator."""
+        width = self.param_limits[:,1] - self.param_limits[:,0]
+        quantised = np.round((np.asarray(params, dtype=np.float64) - self.param_limits[:,0]) / width * 1e12)
+        version = getattr(self.gpemu, "training_set_version", 0) if use_updated_training_set else 0
+        return (quantised.tobytes(), bool(use_updated_training_set), version, self._emulator_generation)
 
     def get_predicted(self, params, use_updated_training_set=False):
-        """Helper function to get the predicted flux power spectrum and error, rebinned to match the desired kbins."""
+        """Helper function to get the predicted flux power spectrum and error, rebinned to match the desired kbins.
+        The most recent predictions are cached, and the arrays returned should not be modified."""
+        if self.prediction_cache_size <= 0:
+            return self._get_predicted(params, use_updated_training_set=use_updated_training_set)
+        key = self._prediction_key(params, use_updated_training_set)
+        cached = self._prediction_cache.get(key)
+        if cached is not None:
+            self._prediction_cache_hits += 1
+            self._prediction_cache.move_to_end(key)
+            return cached
+        self._prediction_cache_misses += 1
+        cached = self._get_predicted(params, use_updated_training_set=use_updated_training_set)
+        for arrays in cached:
+            for arr in arrays:
+                arr.setflags(write=False)
+        self._prediction_cache[key] = cached
+        if len(self._prediction_cache) > self.prediction_cache_size:
+            self._prediction_cache.popitem(last=False)
+        return cached
+
+    def _get_predicted(self, params, use_updated_training_set=False):
+        """Get the predicted flux power spectrum and error from the emulator, without caching."""
         nparams = params
         if self.mf_slope:
             # tau_0_i[z] @dtau_0 / tau_0_i[z] @[dtau_0 = 0]
             # Divided by lowest redshift case
-            tau0_fac = mflux.mean_flux_slope_to_factor(self.zout, params[0])
+            with profiling.timed("likelihood.tau0_factors"):
+                tau0_fac = mflux.mean_flux_slope_to_factor(self.zout, params[0])
             nparams = params[1:] #Keep only t0 sampling parameter (of mean flux parameters)
         else: #Otherwise bug if choose mean_flux = 'c'
             tau0_fac = None
         # .predict should take [{list of parameters: t0; cosmo.; thermal},]
         # Here: emulating @ cosmo.; thermal; sampled t0 * [tau0_fac from above]
         predicted_nat, std_nat = self.gpemu.predict(np.array(nparams).reshape(1,-1), tau0_factors = tau0_fac, use_updated_training_set=use_updated_training_set)
-        ndense = len(self.emulator.mf.dense_param_names)
-        hindex = ndense + self.emulator.param_names["hub"]
-        assert 0.5 < nparams[hindex] < 1
+        hindex = self._hindex
+        if self.debug:
+            assert 0.5 < nparams[hindex] < 1
         omega_m = self.emulator.omegamh2/nparams[hindex]**2
-        okf, predicted = flux_power.rebin_power_to_kms(kfkms=self.kf, kfmpc=self.gpemu.kf, flux_powers = predicted_nat[0], zbins=self.zout, omega_m = omega_m)
-        _, std= flux_power.rebin_power_to_kms(kfkms=self.kf, kfmpc=self.gpemu.kf, flux_powers = std_nat[0], zbins=self.zout, omega_m = omega_m)
+        okf, predicted = _rebin_power_to_kms(kfkms=self.kf, kfmpc=self.gpemu.kf, flux_powers = predicted_nat[0], zbins=self.zout, omega_m = omega_m)
+        _, std= _rebin_power_to_kms(kfkms=self.kf, kfmpc=self.gpemu.kf, flux_powers = std_nat[0], zbins=self.zout, omega_m = omega_m)
         return okf, predicted, std
 
     def likelihood(self, params, include_emu=True, data_power=None, use_updated_training_set=False):
@@ -165,35 +288,53 @@ class LikelihoodClass:
         #Set parameter limits as the hull of the original emulator.
         if np.any(params >= self.param_limits[:,1]) or np.any(params <= self.param_limits[:,0]):
             return -np.inf
+        profiling.count("likelihood.calls")
 
         okf, predicted, std = self.get_predicted(params, use_updated_training_set=use_updated_training_set)
 
         nkf = int(np.size(self.kf))
         nz = np.shape(predicted)[0]
-        assert nz == int(np.size(data_power)/nkf)
+        if self.debug:
+            assert nz == int(np.size(data_power)/nkf)
         #Likelihood using full covariance matrix
         chi2 = 0
 
         for bb in range(nz):
-            idp = np.where(self.kf >= okf[bb][0])
-            diff_bin = predicted[bb] - data_power[nkf*bb:nkf*(bb+1)][idp]
+            #self.kf is sorted, so the bins on the emulator k range are a contiguous block.
+            bindx = np.searchsorted(self.kf, okf[bb][0])
+            diff_bin = predicted[bb] - data_power[nkf*bb+bindx:nkf*(bb+1)]
             std_bin = std[bb]
-            bindx = np.min(idp)
-            covar_bin = self.get_BOSS_error(bb)[bindx:,bindx:]
-
-            assert np.shape(np.outer(std_bin,std_bin)) == np.shape(covar_bin)
-            if include_emu:
-                #Assume each k bin is independent
-#                 covar_emu = np.diag(std_bin**2)
-                #Assume completely correlated emulator errors within this bin
-                covar_emu = np.outer(std_bin, std_bin)
-                covar_bin += covar_emu
-            icov_bin = np.linalg.inv(covar_bin)
-            (_, cdet) = np.linalg.slogdet(covar_bin)
-            dcd = - np.dot(diff_bin, np.dot(icov_bin, diff_bin),)/2.
+            nbin = nkf - bindx
+            with profiling.timed("likelihood.covariance"):
+                covar_bin = self._covar_work[:nbin, :nbin]
+                if include_emu:
+                    #Assume each k bin is independent
+#                     covar_emu = np.diag(std_bin**2)
+                    #Assume completely correlated emulator errors within this bin
+                    np.outer(std_bin, std_bin, out=covar_bin)
+                    covar_bin += self._BOSS_covar[bb][bindx:,bindx:]
+                else:
+                    covar_bin[:] = self._BOSS_covar[bb][bindx:,bindx:]
+            if self.debug:
+                assert np.shape(std_bin) == np.shape(diff_bin) == (nbin,)
+            with profiling.timed("likelihood.linalg"):
+                try:
+                    #Cholesky factor gives both the inverse and the determinant
+                    cholesky = np.linalg.cholesky(covar_bin)
+                    icd = scipy.linalg.solve_triangular(cholesky, diff_bin, lower=True, check_finite=self.debug)
+                    cdet = 2 * np.sum(np.log(np.diag(cholesky)))
+                    dcd = - np.dot(icd, icd)/2.
+                except np.linalg.LinAlgError:
+                    #Not positive definite: use a general solver, so one bad point does not stop the chain.
+                    try:
+                        (_, cdet) = np.linalg.slogdet(covar_bin)
+                        dcd = - np.dot(diff_bin, np.linalg.solve(covar_bin, diff_bin))/2.
+                    except np.linalg.LinAlgError:
+                        return -np.inf
             chi2 += dcd -0.5* cdet
-            assert 0 > chi2 > -2**31
-            assert not np.isnan(chi2)
+            if self.debug:
+                assert 0 > chi2 > -2**31
+                assert not np.isnan(chi2)
         return chi2
 
     def load(self, savefile):
@@ -202,6 +343,7 @@ class LikelihoodClass:
 
     def log_likelihood_marginalised_mean_flux(self, params, include_emu=True, integration_bounds='default', integration_options='gauss-legendre', verbose=True, integration_method='Quadrature'): #marginalised_axes=(0, 1)
         """Evaluate (Gaussian) likelihood marginalised over mean flux parameter axes: (dtau0, tau0)"""
+        import mpmath as mmh
         #assert len(marginalised_axes) == 2
         assert self.mf_slope
         if integration_bounds == 'default':
@@ -225,23 +367,28 @@ class LikelihoodClass:
         volume_factor = (self.param_limits[0, 1] - self.param_limits[0, 0]) * (self.param_limits[1, 1] - self.param_limits[1, 0])
         return volume_factor * function_sum / n_samples
 
+    @profiling.profiled("get_BOSS_error")
     def get_BOSS_error(self, zbin):
-        """Get the BOSS covariance matrix error."""
-        #Redshifts
-        sdssz = self.sdss.get_redshifts()
-        #Fix maximum redshift bug
-        sdssz = sdssz[sdssz <= self.max_z]
-        #Important assertion
-        npt.assert_allclose(sdssz, self.zout, atol=1.e-16)
-        #print('SDSS redshifts are', sdssz)
-        if zbin < 0:
-            covar_bin = self.sdss.get_covar(sdssz)
-        else:
-            covar_bin = self.sdss.get_covar(sdssz[zbin])
-        return covar_bin
-
-    def do_sampling(self, savefile, datadir, nwalkers=150, burnin=3000, nsamples=3000, while_loop=True, include_emulator_error=True, maxsample=20):
-        """Initialise and run emcee."""
+        """Get the BOSS covariance matrix error. The matrices for each redshift bin are cached and should not be modified."""
+        if zbin not in self._BOSS_covar:
+            self._BOSS_covar[zbin] = self.sdss.get_covar(self._sdssz)
+        return self._BOSS_covar[zbin]
+
+    def do_sampling(self, savefile, datadir, nwalkers=150, burnin=3000, nsamples=3000, while_loop=True, include_emulator_error=True, maxsample=20, ntau=50, nprocs=1, pool_type="process", share_emulator=False):
+        """Initialise and run emcee.
+        If nprocs > 1 the likelihood is evaluated by a pool of nprocs processes, which is either
+        a multiprocessing.Pool (pool_type='process') or a local MPI-style pool (pool_type='mpi').
+        If share_emulator is True, the workers use the emulator and data covariance from shared memory,
+        rather than each having a copy.
+        Samples are generated in chunks of nsamples, which are appended to savefile+".hdf5" as they are made.
+        Convergence is checked after each chunk from running statistics, and sampling stops
+        when the Gelman-Rubin statistic is below 1.01 and the chain is longer than ntau autocorrelation times,
+        or after maxsample chunks. The flattened chain is saved as text to savefile at the end.
+        If profiling is enabled, the profile of the run is saved to savefile+"_profile.json".
+        The emcee sampler only holds one chunk at a time, so the result returned (and stored in cur_results)
+        is the convergence.HDF5ChainBackend holding the whole post burn-in chain, which has the chain,
+        flatchain and lnprobability attributes of an emcee sampler."""
+        import emcee
         pnames = self.emulator.print_pnames()
         #Load the data directory
         self.data_fluxpower = load_data(datadir, kf=self.kf, t0=self.t0_training_value)
@@ -257,24 +404,74 @@ class LikelihoodClass:
         cent = (self.param_limits[:,1]+self.param_limits[:,0])/2.
         p0 = [cent+2*pr/16.*np.random.rand(self.ndim)-pr/16. for _ in range(nwalkers)]
         assert np.all([np.isfinite(self.likelihood(pp, include_emu=include_emulator_error)) for pp in p0])
-        emcee_sampler = emcee.EnsembleSampler(nwalkers, self.ndim, self.likelihood, args=(include_emulator_error,))
-        pos, _, _ = emcee_sampler.run_mcmc(p0, burnin)
+        pool = None
+        shared = None
+        if nprocs > 1:
+            #Each worker gets a copy of this object once, at startup.
+            if share_emulator:
+                shared = self.share_emulator()
+                pool = pools.get_pool(nprocs, pool_type=pool_type, initializer=_init_pool_worker_shared, initargs=(self._worker_copy(), shared.descriptor, include_emulator_error))
+            else:
+                pool = pools.get_pool(nprocs, pool_type=pool_type, initializer=_init_pool_worker, initargs=(self, include_emulator_error))
+            emcee_sampler = emcee.EnsembleSampler(nwalkers, self.ndim, _pool_likelihood, pool=pool)
+        else:
+            emcee_sampler = emcee.EnsembleSampler(nwalkers, self.ndim, self.likelihood, args=(include_emulator_error,))
+        try:
+            backend = self._run_chains(emcee_sampler, savefile, p0, burnin, nsamples, maxsample, while_loop, ntau, pnames)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            if shared is not None:
+                shared.close()
+        if profiling.is_enabled():
+            profiling.save_profile(savefile+"_profile.json", nwalkers=nwalkers, nprocs=nprocs, pool_type=pool_type)
+        return backend
+
+    def _run_chains(self, emcee_sampler, savefile, p0, burnin, nsamples, maxsample, while_loop, ntau, pnames):
+        """Run burn-in and then sample in chunks until converged. Returns the backend holding the chain."""
+        nwalkers = np.shape(p0)[0]
+        with profiling.timed("sampling.burnin"):
+            pos, _, _ = emcee_sampler.run_mcmc(p0, burnin)
         #Check things are reasonable
         assert np.all(emcee_sampler.acceptance_fraction > 0.01)
         emcee_sampler.reset()
-        self.cur_results = emcee_sampler
-        gr = 10.
+        monitor = convergence.OnlineConvergence(nwalkers, self.ndim, ntau=ntau)
+        backend = convergence.HDF5ChainBackend(savefile+".hdf5", nwalkers, self.ndim, pnames=[pp[0] for pp in pnames])
+        self.cur_results = backend
         count = 0
-        while np.any(gr > 1.01) and count < maxsample:
-            emcee_sampler.run_mcmc(pos, nsamples)
-            gr = gelman_rubin(emcee_sampler.chain)
-            print("Total samples:",nsamples," Gelman-Rubin: ",gr)
-            np.savetxt(savefile, emcee_sampler.flatchain)
+        while count < maxsample:
+            with profiling.timed("sampling.run_mcmc"):
+                pos, _, _ = emcee_sampler.run_mcmc(pos, nsamples)
+            #Only the new chunk is kept in memory: it is added to the running statistics and the file.
+            with profiling.timed("sampling.bookkeeping"):
+                monitor.update(emcee_sampler.chain)
+                backend.append(emcee_sampler.chain, emcee_sampler.lnprobability)
+                emcee_sampler.reset()
+            print("Total samples:",monitor.nsteps," Gelman-Rubin: ",monitor.gelman_rubin()," Autocorrelation time: ",monitor.autocorr_time())
             count += 1
-            if while_loop is False:
+            if monitor.converged() or while_loop is False:
                 break
-        self.flatchain = emcee_sampler.flatchain
-        return emcee_sampler
+        self.flatchain = backend.get_flatchain()
+        np.savetxt(savefile, self.flatchain)
+        return backend
+
+    def share_emulator(self):
+        """Publish the emulator and the data covariance for each redshift bin into shared memory.
+        Returns a shared_emulator.SharedArrays, which should be closed when no longer needed."""
+        return shared_emulator.publish_emulator(self.gpemu, covariances=[self._BOSS_covar[bb] for bb in range(np.size(self.zout))])
+
+    def _worker_copy(self):
+        """A copy of this object without the emulator or data, to send to worker processes
+        which attach them from shared memory."""
+        like = copy.copy(self)
+        like.gpemu = None
+        like.sdss = None
+        like._BOSS_covar = None
+        like._data_cholesky = {}
+        like._inverse_BOSS_covariance_full = None
+        like.cur_results = None
+        return like
 
     def new_parameter_limits(self, confidence=0.99, include_dense=False):
         """Find a square region which includes coverage of the parameters in each direction, for refinement.
@@ -297,37 +494,90 @@ class LikelihoodClass:
         new_par = limits[ndense:,:]
         return new_par
 
-    def get_covar_det(self, params, include_emu):
-        """Get the determinant of the covariance matrix.for certain parameters"""
-        if np.any(params >= self.param_limits[:,1]) or np.any(params <= self.param_limits[:,0]):
-            return -np.inf
-        sdssz = self.sdss.get_redshifts()
-        #Fix maximum redshift bug
-        sdssz = sdssz[sdssz <= self.max_z]
-        nz = sdssz.size
-        if include_emu:
-            okf, _, std = self.get_predicted(params)
-        detc = 1
-        for bb in range(nz):
-            covar_bin = self.sdss.get_covar(sdssz[bb])
-            if include_emu:
-                idp = np.where(self.kf >= okf[bb][0])
-                std_bin = std[bb]
-                #Assume completely correlated emulator errors within this bin
-                covar_emu = np.outer(std_bin, std_bin)
-                covar_bin[idp,idp] += covar_emu
-            _, det_bin = np.linalg.slogdet(covar_bin)
-            #We have a block diagonal covariance
-            detc *= det_bin
-        return detc
+    def _get_data_cholesky(self, zbin):
+        """Cholesky factor and log-determinant of the data covariance for a redshift bin. Cached."""
+        if zbin not in self._data_cholesky:
+            cholesky = np.linalg.cholesky(self._BOSS_covar[zbin])
+            self._data_cholesky[zbin] = (cholesky, 2 * np.sum(np.log(np.diag(cholesky))))
+        return self._data_cholesky[zbin]
+
+    def _get_predicted_batch(self, params):
+        """Get the emulator error, rebinned to the data k bins, for many parameter vectors at once.
+        Returns the error, of shape (N, nz, nkf), which is zero for k bins larger than the box."""
+        nparams = params
+        tau0_fac = None
+        if self.mf_slope:
+            tau0_fac = mflux.mean_flux_slope_to_factor(self.zout, params[:,0:1])
+            nparams = params[:,1:]
+        _, std_nat = self.gpemu.predict(nparams, tau0_factors=tau0_fac)
+        omega_m = self.emulator.omegamh2/nparams[:,self._hindex]**2
+        _, std = flux_power.rebin_power_to_kms_batch(kfkms=self.kf, kfmpc=self.gpemu.kf, flux_powers=std_nat, zbins=self.zout, omega_m=omega_m)
+        return np.nan_to_num(std, nan=0.)
+
+    def _emulator_logdet(self, std):
+        """Change in the log-determinant of the covariance from the emulator error std, shape (N, nz, nkf).
+        The emulator term in each redshift bin is the rank one matrix s s^T, so by the
+        matrix determinant lemma log det(C + s s^T) = log det(C) + log(1 + s^T C^-1 s)."""
+        logdet = np.zeros(np.shape(std)[0])
+        for bb in range(np.size(self.zout)):
+            (cholesky, _) = self._get_data_cholesky(bb)
+            #C^-1/2 s for every vector
+            halfsolve = scipy.linalg.solve_triangular(cholesky, std[:, bb, :].T, lower=True)
+            logdet += np.log1p(np.sum(halfsolve**2, axis=0))
+        return logdet
+
+    def get_covar_det(self, params, include_emu, chunk_size=1000):
+        """Get the log-determinant of the (block diagonal) covariance matrix for certain parameters.
+        params may be a single parameter vector, or an array of shape (N, ndim), in which case an array is returned.
+        The log-determinants of the data covariance are cached and the emulator error is added as a rank one update.
+        The emulator is evaluated in chunks of chunk_size vectors. Parameters outside the prior give -inf."""
+        single = np.ndim(params) == 1
+        params = np.array(params, ndmin=2)
+        datalogdet = np.sum([self._get_data_cholesky(bb)[1] for bb in range(np.size(self.zout))])
+        logdet = datalogdet * np.ones(np.shape(params)[0])
+        inprior = self._in_prior(params)
+        logdet[~inprior] = -np.inf
+        if not include_emu:
+            return logdet[0] if single else logdet
+        if single:
+            if inprior[0]:
+                #Use the (cached) single prediction
+                okf, _, std = self.get_predicted(params[0])
+                std_bins = np.zeros((1, np.size(self.zout), np.size(self.kf)))
+                for bb in range(np.size(self.zout)):
+                    std_bins[0, bb, np.size(self.kf) - np.size(okf[bb]):] = std[bb]
+                logdet += self._emulator_logdet(std_bins)
+            return logdet[0]
+        good = np.where(inprior)[0]
+        for start in range(0, np.size(good), chunk_size):
+            chunk = good[start:start+chunk_size]
+            logdet[chunk] += self._emulator_logdet(self._get_predicted_batch(params[chunk]))
+        return logdet
+
+    def _in_prior(self, params):
+        """Which of an array of parameter vectors, shape (N, ndim), are strictly inside the prior volume."""
+        return np.all((params < self.param_limits[:,1]) * (params > self.param_limits[:,0]), axis=1)
 
     def refine_metric(self, params):
         """This evaluates the 'refinement metric':
            the extent to which the emulator error dominates the covariance.
-           The idea is that when it is > 1, refinement is necessary"""
+           The idea is that when it is > 1, refinement is necessary.
+           Parameters outside the prior give NaN."""
+        if not self._in_prior(np.array(params, ndmin=2))[0]:
+            return np.nan
         detnoemu = self.get_covar_det(params, False)
         detemu = self.get_covar_det(params, True)
-        return detemu/detnoemu
+        return np.exp(detemu - detnoemu)
+
+    def refine_metric_batch(self, params, chunk_size=1000):
+        """The refinement metric for an array of parameter vectors, shape (N, ndim).
+        Vectors outside the prior give NaN."""
+        params = np.array(params, ndmin=2)
+        metric = np.nan * np.ones(np.shape(params)[0])
+        inprior = np.where(self._in_prior(params))[0]
+        good = params[inprior]
+        metric[inprior] = np.exp(self.get_covar_det(good, True, chunk_size=chunk_size) - self.get_covar_det(good, False))
+        return metric
 
     def _get_emulator_error_averaged_mean_flux(self, params, use_updated_training_set=False):
         """Get the emulator error having averaged over the mean flux parameter axes: (dtau0, tau0)"""
@@ -379,6 +629,7 @@ class LikelihoodClass:
 
     def optimise_acquisition_function(self, starting_params, optimisation_bounds='default', optimisation_method=None, iteration_number=1, delta=0.5, nu=1., exploitation_weight=1., integration_bounds='default'):
         """Find parameter vector (marginalised over mean flux parameters) at maximum of (GP-UCB) acquisition function"""
+        import scipy.optimize as spo
         if optimisation_bounds == 'default': #Default to prior bounds
             #optimisation_bounds = [tuple(self.param_limits[2 + i]) for i in range(starting_params.shape[0])]
             optimisation_bounds = [(1.e-7, 1. - 1.e-7) for i in range(starting_params.shape[0])] #Might get away with 1.e-7
@@ -414,12 +665,13 @@ class LikelihoodClass:
         assert np.shape(new_samples)[0] == nsamples
         self.emulator.gen_simulations(nsamples=nsamples, samples=new_samples)
 
-    def make_err_grid(self, i, j, samples = 30000):
-        """Make an error grid"""
+    def make_err_grid(self, i, j, samples = 30000, chunk_size=1000):
+        """Make an error grid. The refinement metric is evaluated in chunks of chunk_size samples,
+        so memory use is bounded."""
+        import scipy.interpolate
         ndim = np.size(self.param_limits[:,0])
-        rr = lambda x : np.random.rand(ndim)*(self.param_limits[:,1]-self.param_limits[:,0]) + self.param_limits[:,0]
-        rsamples = np.array([rr(i) for i in range(samples)])
-        randscores = [self.refine_metric(rr) for rr in rsamples]
+        rsamples = np.random.rand(samples, ndim)*(self.param_limits[:,1]-self.param_limits[:,0]) + self.param_limits[:,0]
+        randscores = self.refine_metric_batch(rsamples, chunk_size=chunk_size)
         grid_x, grid_y = np.mgrid[0:1:200j, 0:1:200j]
         grid_x = grid_x * (self.param_limits[i,1] - self.param_limits[i,0]) + self.param_limits[i,0]
         grid_y = grid_y * (self.param_limits[j,1] - self.param_limits[j,0]) + self.param_limits[j,0]
@@ -1,10 +1,24 @@
 """A module for doing linear theory computations of the Lyman-alpha forest.
-This uses the 'biased tracer' formalism. It computes the 3D power spectrum and is intended only for testing!"""
+This uses the 'biased tracer' formalism. It computes the 3D power spectrum and is intended only for testing!
+CAMB is only run once for each background cosmology (hub, omega_b, omega_c and redshifts):
+the linear matter power for other values of As and ns is obtained by rescaling the primordial power.
+The CAMB results are cached in memory, and on disc only if a cache directory is given
+(by the cachedir argument or the LYAEMU_CAMB_CACHE environment variable)."""
 
+import os
+import os.path
 import math
+import hashlib
 import numpy as np
 import scipy.interpolate
-import camb
+
+#Directory for cached CAMB matter power spectra. None (the default) only caches in memory.
+CACHE_DIR = os.environ.get("LYAEMU_CAMB_CACHE")
+#The primordial power of the cached spectra and its pivot scale in 1/Mpc (CAMB's default).
+REF_AS = 2e-9
+REF_NS = 1.
+PIVOT_SCALAR = 0.05
+_MATTER_POWER_CACHE = {}
 
 def hubble(zz, omega_m, hub=0.7):
     """Hubble expansion at redshift zz"""
@@ -14,35 +28,93 @@ def flux_power_3d(matpow, mu, bias_flux=-0.14, beta_flux=-0.2):
     """The 3D flux power from the matter power, assuming the forest is a biased tracer."""
     return (bias_flux + (1+mu**2)*beta_flux )**2 * matpow
 
-def flux_power_1d(matpow, kvals, *, bias_flux=-0.14, beta_flux=-0.2):
-    """The 1D flux power spectrum from the matter power, the integral of the 3D.
+def tail_integrals(yy, xx):
+    """Integrals of yy from each xx to the largest xx, by the trapezium rule, along the last axis.
+    Computed for all starting points at once with a reverse cumulative sum."""
+    segments = 0.5 * (yy[..., 1:] + yy[..., :-1]) * np.diff(xx)
+    tails = np.zeros_like(yy, dtype=np.float64)
+    tails[..., :-1] = np.cumsum(segments[..., ::-1], axis=-1)[..., ::-1]
+    return tails
+
+def flux_power_1d(matpow, kvals, *, bias_flux=-0.14, beta_flux=-0.2, mu_dependent=False):
+    """The 1D flux power spectrum from the matter power, the integral of the 3D:
+        P_1D(k_par) = 1/2pi int_{k_par}^inf P_3D(k, mu = k_par/k) k dk
+    matpow may have shape (nk,) or (nz, nk), in which case bias_flux may be an array of length nz.
+    If mu_dependent is False, P_3D is evaluated at mu = 1, as it was originally.
+    Otherwise, the full mu dependence is included: P_3D is a polynomial in mu^2, so the integral
+    is a sum of tail integrals of P k, P / k and P / k^3.
     Result has units of L."""
-    P3D = flux_power_3d(matpow, 1, bias_flux=bias_flux, beta_flux=beta_flux)
-    return kvals, np.array([np.trapz(P3D[i:]*kvals[i:], kvals[i:]) for i in range(np.size(kvals))])/math.pi/2
+    matpow = np.asarray(matpow)
+    bias_flux = np.asarray(bias_flux, dtype=np.float64)
+    if np.ndim(matpow) == 2 and np.ndim(bias_flux) == 1:
+        bias_flux = bias_flux[:, np.newaxis]
+    if not mu_dependent:
+        P3D = flux_power_3d(matpow, 1, bias_flux=bias_flux, beta_flux=beta_flux)
+        return kvals, tail_integrals(P3D*kvals, kvals)/math.pi/2
+    #(b + (1+mu^2) beta)^2 = A + B mu^2 + C mu^4
+    aa = (bias_flux + beta_flux)**2
+    bb = 2 * (bias_flux + beta_flux) * beta_flux
+    cc = beta_flux**2
+    pf = aa * tail_integrals(matpow*kvals, kvals)
+    pf += bb * kvals**2 * tail_integrals(matpow/kvals, kvals)
+    pf += cc * kvals**4 * tail_integrals(matpow/kvals**3, kvals)
+    return kvals, pf/math.pi/2
 
-def matter_power(*, hub = 0.7, omega_b = 0.049, omega_c = 0.25, ns=0.965, As = 2.41e-9, zz=3.):
+def _camb_matter_power(*, hub, omega_b, omega_c, ns, As, zz):
     """Get a matter power spectrum using CAMB's python interface."""
+    import camb
     #Set up a new set of parameters for CAMB
     pars = camb.CAMBparams()
     #This function sets up CosmoMC-like settings, with one massive neutrino and helium set using BBN consistency
     pars.set_cosmology(H0=hub*100, ombh2=omega_b*hub**2, omch2=omega_c*hub**2, mnu=0., omk=0, tau=0.06)
-    pars.InitPower.set_params(As=As, ns=ns, r=0)
-    if len(zz) == 1:
-        zz = [zz,]
-    pars.set_matter_power(redshifts=zz, kmax=10)
+    pars.InitPower.set_params(As=As, ns=ns, r=0, pivot_scalar=PIVOT_SCALAR)
+    pars.set_matter_power(redshifts=list(zz), kmax=10)
     assert pars.validate()
     pars.NonLinear = camb.model.NonLinear_none
     results = camb.get_results(pars)
     kh, _, pk = results.get_matter_power_spectrum(minkh=1e-2, maxkh=10, npoints = 200)
     return kh, pk
 
-def get_flux_power(*, kf, zz, hub = 0.7, omega_b = 0.049, omega_c = 0.25, ns=0.965, As = 2.41e-9, bias_flux=-0.14, beta_flux=-0.2):
+def reference_matter_power(*, hub = 0.7, omega_b = 0.049, omega_c = 0.25, zz=3., cachedir=None):
+    """Get the linear matter power spectrum with As = REF_AS and ns = REF_NS for a background cosmology,
+    running CAMB only if it is not already cached in memory or in cachedir (default CACHE_DIR)."""
+    if cachedir is None:
+        cachedir = CACHE_DIR
+    zz = tuple(np.atleast_1d(zz).astype(float))
+    key = (float(hub), float(omega_b), float(omega_c), zz)
+    if key in _MATTER_POWER_CACHE:
+        return _MATTER_POWER_CACHE[key]
+    cfile = None
+    if cachedir is not None:
+        cfile = os.path.join(cachedir, "matter_power_"+hashlib.sha1(repr(key).encode()).hexdigest()[:16]+".npz")
+        if os.path.exists(cfile):
+            with np.load(cfile) as cached:
+                _MATTER_POWER_CACHE[key] = (cached["kh"], cached["pk"])
+            return _MATTER_POWER_CACHE[key]
+    (kh, pk) = _camb_matter_power(hub=hub, omega_b=omega_b, omega_c=omega_c, ns=REF_NS, As=REF_AS, zz=zz)
+    _MATTER_POWER_CACHE[key] = (kh, pk)
+    if cfile is not None:
+        try:
+            os.makedirs(cachedir, exist_ok=True)
+            np.savez(cfile, kh=kh, pk=pk)
+        except OSError:
+            pass
+    return kh, pk
+
+def matter_power(*, hub = 0.7, omega_b = 0.049, omega_c = 0.25, ns=0.965, As = 2.41e-9, zz=3., cachedir=None):
+    """Get a linear matter power spectrum, by rescaling the (cached) CAMB power for this background cosmology
+    by the primordial power: P(k) = P_ref(k) As/REF_AS (k / k_pivot)^(ns - REF_NS)."""
+    (kh, pk) = reference_matter_power(hub=hub, omega_b=omega_b, omega_c=omega_c, zz=zz, cachedir=cachedir)
+    #kh is in h/Mpc and the pivot is in 1/Mpc.
+    return kh, pk * As / REF_AS * (kh * hub / PIVOT_SCALAR)**(ns - REF_NS)
+
+def get_flux_power(*, kf, zz, hub = 0.7, omega_b = 0.049, omega_c = 0.25, ns=0.965, As = 2.41e-9, bias_flux=-0.14, beta_flux=-0.2, mu_dependent=False):
     """Get a flux power spectrum from cosmology."""
     (kh, pks) = matter_power(hub = hub, omega_b = omega_b, omega_c = omega_c, ns=ns, As = As, zz=zz)
-    results = np.array([flux_power_1d(pk[::10], kh[::10], bias_flux=bias_flux[i], beta_flux=beta_flux) for (i,pk) in enumerate(pks)])
     zz = np.array(zz)
-    kvals = results[0,0,:]
-    pf = results[:,1,:]
+    bias_flux = bias_flux * np.ones(np.shape(pks)[0])
+    #All redshifts are projected at once, at the full k resolution
+    (kvals, pf) = flux_power_1d(pks, kh, bias_flux=bias_flux, beta_flux=beta_flux, mu_dependent=mu_dependent)
     newpf = [scipy.interpolate.interp1d(kvals, ppf) for ppf in pf]
     #Convert units from comoving Mpc to km/s:
     convert = hubble(zz, hub=hub, omega_m = omega_b+omega_c) / (1+zz)
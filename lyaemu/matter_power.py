@@ -1,6 +1,9 @@
 """Modules to get the matter power spectrum from a simulation box and build a simple test emulator."""
 from __future__ import print_function
 import os.path
+import glob
+import json
+import math
 import numpy as np
 import scipy.interpolate
 from .coarse_grid import Emulator
@@ -19,31 +22,74 @@ class MatterPowerEmulator(Emulator):
         fv = get_matter_power(di,kk=self.kf, redshift = 3.)
         return fv
 
+def snapshot_redshifts(base, indexfile="powerspec_index.json"):
+    """Get the power spectrum files in a directory and their redshifts, sorted by snapshot number.
+    The redshift of each file is saved to indexfile with its modification time,
+    so later calls only read the headers of new or changed files."""
+    files = sorted(glob.glob(os.path.join(base, "powerspec_[0-9][0-9][0-9].txt")))
+    findex = os.path.join(base, indexfile)
+    index = {}
+    try:
+        with open(findex, 'r') as jsin:
+            index = json.load(jsin)
+    except (OSError, ValueError):
+        pass
+    newindex = {}
+    for fname in files:
+        mtime = os.path.getmtime(fname)
+        cached = index.get(os.path.basename(fname), None)
+        if cached is None or cached["mtime"] != mtime:
+            with open(fname, 'r') as fin:
+                #The first number in the file is the scale factor
+                time = float(fin.readline().split()[0])
+            cached = {"mtime": mtime, "redshift": 1/time - 1}
+        newindex[os.path.basename(fname)] = cached
+    if newindex != index:
+        try:
+            with open(findex, 'w') as jsout:
+                json.dump(newindex, jsout)
+        except OSError:
+            pass
+    return files, np.array([newindex[os.path.basename(fname)]["redshift"] for fname in files])
+
 def get_matter_power(base, kk, redshift = 3.):
     """Gets the matter power spectrum at a single redshift, rebinned onto the given k."""
-    for snap in range(1000):
-        snapdir = os.path.join(base,"powerspec_"+str(snap).rjust(3,'0')+".txt")
-        if not os.path.exists(snapdir):
-            #We ran out of snapshots
-            print(snapdir)
-            break
-        (time, kk_sim, pk_sim) = get_folded_power(snapdir)
-        assert len(kk_sim) > len(kk)
-        if np.abs(1/time - 1 - redshift) < 0.01:
-            #Rebin flux power to have desired k bins
-            rebinned=scipy.interpolate.interpolate.interp1d(kk_sim,pk_sim)
-            pk = rebinned(kk)
-            return pk
-    raise IOError("No power spectra found")
+    (files, redshifts) = snapshot_redshifts(base)
+    match = np.where(np.abs(redshifts - redshift) < 0.01)[0]
+    if np.size(match) == 0:
+        raise IOError("No power spectra found at z="+str(redshift)+" in "+base)
+    (_, kk_sim, pk_sim) = get_folded_power(files[match[0]])
+    assert len(kk_sim) > len(kk)
+    #Rebin flux power to have desired k bins
+    rebinned=scipy.interpolate.interp1d(kk_sim,pk_sim)
+    return rebinned(kk)
 
-def get_folded_power(fname1):
-    """Get the matter power spectrum from the internal Gadget estimator"""
+def get_folded_power(fname1, cache=True):
+    """Get the matter power spectrum from the internal Gadget estimator.
+    If cache is True, the result is saved next to the text file in binary form,
+    and reused while the text file is unchanged."""
+    cachefile = os.path.splitext(fname1)[0]+"_folded.npz"
+    mtime = os.path.getmtime(fname1)
+    if cache:
+        try:
+            with np.load(cachefile) as cached:
+                if cached["mtime"] == mtime:
+                    return (float(cached["time"]), cached["kk"], cached["pk"])
+        except (OSError, ValueError, KeyError):
+            pass
     (time, kk_a1,pk_a1,kk_b1,pk_b1)=loadfolded(fname1)
     ind = np.where(kk_a1 > kk_b1[-1])
     kk_aa1 = np.ravel(kk_a1[ind])
     pk_aa = np.ravel(pk_a1[ind])/kk_a1[ind]**3
     pk_b1 = pk_b1/kk_b1**3
-    return (time, np.concatenate([kk_b1,kk_aa1]), np.concatenate([pk_b1, pk_aa]))
+    kk = np.concatenate([kk_b1,kk_aa1])
+    pk = np.concatenate([pk_b1, pk_aa])
+    if cache:
+        try:
+            np.savez(cachefile, mtime=mtime, time=time, kk=kk, pk=pk)
+        except OSError:
+            pass
+    return (time, kk, pk)
 
 def loadfolded(fname):
     """Load the folded power spectrum file"""
@@ -75,44 +121,50 @@ def loadfolded(fname):
     return (time, scale*kk_a, pk_a, scale*kk_b, pk_b)
 
 def GetFoldedPower(adata, bins):
-    """Returns the dimensionless Delta parameter"""
+    """Returns the dimensionless Delta parameter.
+    Input bins are merged, in order of increasing k, until each merged bin has at least MinModeCount modes
+    and spans at least 1/TargetBins of the log k range. Trailing bins which do not meet this are dropped.
+    The end of each merged bin is found with a binary search on cumulative sums, so the cost
+    scales with the number of output bins."""
     #Set up variables
     # k
-    K_A = adata[:,0]
+    K_A = adata[:bins,0]
     #Number of modes in a bin
-    ModeCount_A = adata[:,4]
-    ModePowUncorrected_A = adata[:,6]
+    ModeCount_A = adata[:bins,4]
+    ModePowUncorrected_A = adata[:bins,6]
     # This is a volume conversion factor# 4 M_PI : [k/[2M_PI:Box]]::3
-    ConvFac_A =  adata[:,9]
+    ConvFac_A =  adata[:bins,9]
     MinModeCount = 50
     TargetBins = 200
     assert np.all(K_A) > 0
     logK_A=np.log10(K_A)
     MinDlogK = (np.max(logK_A) - np.min(logK_A))/TargetBins
-    istart=0
-    iend=0
-    k_list_A = []#np.array([])
-    Pk_list = []#np.array([])
-#     count_list_A =[]# np.array([])
-    count=0
-    targetlogK=MinDlogK+logK_A[istart]
-    while iend < bins:
-        count+=ModeCount_A[iend]
-        iend+=1
-        if count >= MinModeCount and logK_A[iend-1] >= targetlogK:
-            pk = np.sum(ModeCount_A[istart:iend]*ModePowUncorrected_A[istart:iend]*ConvFac_A[istart:iend])/count
-            kk = np.sum(ModeCount_A[istart:iend]*K_A[istart:iend])/count
-            #Earlier versions did: (ConvFac_A[b]*Specshape_A[b])
-            #This is a correction from what is done in pm_periodic.
-            #I think it is some sort of bin weighted average.
-            #In pm_periodic he divides each mode by Specshape_A(k_mode)
-            #, and then sums them. So we can use the Corrected powers and multiply by Specshape,
-            #or we can just use the uncorrected versions. They give the same answer.
-            k_list_A.append(kk)
-            Pk_list.append(pk)
-#             count_list_A.append(count)
-            istart=iend
-            targetlogK=logK_A[istart]+MinDlogK
-            count=0
-            assert pk >= 0
-    return (np.array(k_list_A), np.array(Pk_list))
+    #Cumulative sums, with a leading zero, so the sum over [istart, iend) is cum[iend] - cum[istart].
+    cumcount = np.concatenate([[0], np.cumsum(ModeCount_A)])
+    #Earlier versions did: (ConvFac_A[b]*Specshape_A[b])
+    #This is a correction from what is done in pm_periodic.
+    #I think it is some sort of bin weighted average.
+    #In pm_periodic he divides each mode by Specshape_A(k_mode)
+    #, and then sums them. So we can use the Corrected powers and multiply by Specshape,
+    #or we can just use the uncorrected versions. They give the same answer.
+    cumpow = np.concatenate([[0], np.cumsum(ModeCount_A*ModePowUncorrected_A*ConvFac_A)])
+    cumk = np.concatenate([[0], np.cumsum(ModeCount_A*K_A)])
+    #Non-decreasing, so it can be searched. Equal to logK_A when k is sorted.
+    maxlogK = np.maximum.accumulate(logK_A)
+    edges = [0]
+    istart = 0
+    while istart < bins:
+        #First bin with enough modes and first bin far enough in k: the merged bin ends at the later of the two.
+        icount = np.searchsorted(cumcount, cumcount[istart] + MinModeCount, side='left')
+        ilogk = np.searchsorted(maxlogK, logK_A[istart] + MinDlogK, side='left') + 1
+        iend = max(icount, ilogk, istart+1)
+        if iend > bins:
+            break
+        edges.append(iend)
+        istart = iend
+    edges = np.array(edges)
+    count = np.diff(cumcount[edges])
+    Pk_list = np.diff(cumpow[edges])/count
+    k_list_A = np.diff(cumk[edges])/count
+    assert np.all(Pk_list >= 0)
+    return (k_list_A, Pk_list)
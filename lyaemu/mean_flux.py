@@ -80,9 +80,10 @@ class MeanFluxFactor(ConstMeanFlux):
         return self.dense_param_limits
 
 def mean_flux_slope_to_factor(zzs, slope):
-    """Convert a mean flux slope into a list of mean flux amplitudes."""
+    """Convert a mean flux slope into a list of mean flux amplitudes.
+    slope may also be an array of shape (N,1), giving amplitudes of shape (N, nz)."""
     #tau_0_i[z] @dtau_0 / tau_0_i[z] @[dtau_0 = 0]
     taus = obs_mean_tau(zzs, amp=0, slope=slope)/obs_mean_tau(zzs, amp=0, slope=0)
     ii = np.argmin(np.abs(zzs-3.))
     #Divide by redshift 3 bin
-    return taus / taus[ii]
+    return taus / taus[..., ii:ii+1]
@@ -0,0 +1,105 @@
+"""Pools of worker processes for evaluating the likelihood in parallel.
+Each worker runs an initializer once, which should set up any expensive state
+(the emulator and covariance matrices), so that only the function arguments
+and results are sent between processes on each call.
+Both pools have the map method emcee needs, and close and join methods as multiprocessing.Pool."""
+import pickle
+import queue
+import multiprocessing
+
+def _local_mpi_worker(tasks, results, initializer, initargs):
+    """Worker loop for LocalMPIPool: run the initializer, then evaluate tasks until told to stop.
+    An exception raised by a task is sent back to the master in place of its result."""
+    if initializer is not None:
+        initializer(*initargs)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        (index, func, arg) = task
+        try:
+            result = func(arg)
+        except Exception as exc:
+            #The exception is pickled to be sent back, so make sure that is possible.
+            try:
+                pickle.dumps(exc)
+            except Exception:
+                exc = RuntimeError(repr(exc))
+            result = _TaskError(exc)
+        results.put((index, result))
+
+class _TaskError:
+    """Wraps an exception raised by a task in a worker, so the master can tell it from a result."""
+    def __init__(self, exc):
+        self.exc = exc
+
+class LocalMPIPool:
+    """A stand-in for an MPI pool (like schwimmbad.MPIPool) using local processes.
+    As with MPI, there is one master and nprocs workers which are started once, each initialised
+    once, and which receive tasks from and send results to the master over queues.
+    Useful for testing MPI-style sampling on a single machine.
+    If a task raises an exception, map raises it in the master once the other tasks are done.
+    If a worker dies, map raises RuntimeError rather than waiting for its results."""
+    def __init__(self, nprocs, initializer=None, initargs=(), poll_time=1.):
+        self.nprocs = nprocs
+        self.poll_time = poll_time
+        self._tasks = multiprocessing.Queue()
+        self._results = multiprocessing.Queue()
+        self._workers = [multiprocessing.Process(target=_local_mpi_worker, args=(self._tasks, self._results, initializer, initargs), daemon=True) for _ in range(nprocs)]
+        for ww in self._workers:
+            ww.start()
+
+    def is_master(self):
+        """Only the master process ever holds the pool."""
+        return True
+
+    def map(self, func, iterable):
+        """Evaluate func on each item, returning the results in order."""
+        nn = 0
+        for nn, arg in enumerate(iterable, 1):
+            self._tasks.put((nn-1, func, arg))
+        results = [None]*nn
+        error = None
+        received = 0
+        while received < nn:
+            try:
+                (index, result) = self._results.get(timeout=self.poll_time)
+            except queue.Empty:
+                dead = [ww.exitcode for ww in self._workers if not ww.is_alive()]
+                if dead:
+                    raise RuntimeError("LocalMPIPool worker exited with code "+str(dead[0])+" while tasks were pending")
+                continue
+            received += 1
+            if isinstance(result, _TaskError):
+                error = error or result.exc
+            results[index] = result
+        if error is not None:
+            raise error
+        return results
+
+    def close(self):
+        """Tell the workers to stop once they have finished their tasks."""
+        for ww in self._workers:
+            if ww.is_alive():
+                self._tasks.put(None)
+
+    def join(self):
+        """Wait for the workers to stop. close must be called first."""
+        for ww in self._workers:
+            ww.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        self.join()
+
+def get_pool(nprocs, pool_type="process", initializer=None, initargs=()):
+    """Get a pool of nprocs worker processes, each initialised once.
+       pool_type - 'process' for a multiprocessing.Pool, 'mpi' for a LocalMPIPool."""
+    if pool_type == "process":
+        return multiprocessing.Pool(nprocs, initializer=initializer, initargs=initargs)
+    if pool_type == "mpi":
+        return LocalMPIPool(nprocs, initializer=initializer, initargs=initargs)
+    raise ValueError("Pool type not recognised: "+str(pool_type))
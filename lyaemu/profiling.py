@@ -0,0 +1,112 @@
+"""Lightweight instrumentation for the likelihood pipeline.
+Named timers and counters are accumulated in this module while profiling is enabled.
+When it is disabled (the default) each hook costs a single flag check.
+Timers accumulated in worker processes (for parallel sampling) stay in those processes.
+
+Usage:
+    profiling.enable()
+    with profiling.timed("name"):
+        ...
+    profiling.save_profile("profile.json")
+"""
+import time
+import json
+import functools
+
+_ENABLED = False
+#name -> [number of calls, total time, maximum time]
+_TIMERS = {}
+_COUNTERS = {}
+
+def enable():
+    """Turn profiling on."""
+    global _ENABLED
+    _ENABLED = True
+
+def disable():
+    """Turn profiling off. Accumulated timers are kept."""
+    global _ENABLED
+    _ENABLED = False
+
+def is_enabled():
+    """Is profiling on?"""
+    return _ENABLED
+
+def reset():
+    """Clear all timers and counters."""
+    _TIMERS.clear()
+    _COUNTERS.clear()
+
+def add_time(name, elapsed):
+    """Add a time interval to a named timer."""
+    timer = _TIMERS.get(name)
+    if timer is None:
+        _TIMERS[name] = [1, elapsed, elapsed]
+    else:
+        timer[0] += 1
+        timer[1] += elapsed
+        timer[2] = max(timer[2], elapsed)
+
+def count(name, num=1):
+    """Increment a named counter."""
+    if _ENABLED:
+        _COUNTERS[name] = _COUNTERS.get(name, 0) + num
+
+class _Timer:
+    """Context manager adding the time spent inside it to a named timer."""
+    __slots__ = ("name", "start")
+    def __init__(self, name):
+        self.name = name
+        self.start = 0.
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        add_time(self.name, time.perf_counter() - self.start)
+
+class _NullTimer:
+    """Context manager which does nothing, used when profiling is off."""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return None
+
+_NULL_TIMER = _NullTimer()
+
+def timed(name):
+    """Context manager timing a block of code under a name."""
+    if _ENABLED:
+        return _Timer(name)
+    return _NULL_TIMER
+
+def profiled(name):
+    """Decorator timing every call to a function under a name."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _ENABLED:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                add_time(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+def get_profile():
+    """Get the timers and counters as a dictionary."""
+    timers = {name: {"calls": tt[0], "total": tt[1], "mean": tt[1]/tt[0], "max": tt[2]} for name, tt in _TIMERS.items()}
+    return {"timers": timers, "counters": dict(_COUNTERS)}
+
+def save_profile(filename, **metadata):
+    """Save the profile to a json file. Any keyword arguments are saved with it."""
+    profile = get_profile()
+    profile["metadata"] = metadata
+    profile["time"] = time.time()
+    with open(filename, 'w') as jsout:
+        json.dump(profile, jsout, indent=1)
+    return profile
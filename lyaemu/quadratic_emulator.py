@@ -7,10 +7,13 @@ Fits the change in the flux power spectrum with a quadratic function.
 """
 
 import math
+import os.path
 import numpy as np
 from .coarse_grid import Emulator
+from .flux_vector_store import simulation_identity, mean_flux_identity
 from .gpemulator import SkLearnGP
 from . import flux_power
+from . import profiling
 
 def Hubble(zz, om, H0):
     """ Hubble parameter. Hubble(Redshift) """
@@ -38,23 +41,26 @@ class QuadraticPoly(SkLearnGP):
         self.bestpar = self.params[self.bfnum,:]
         for pp in range(np.shape(self.params)[1]):
             self.tables[pp] = self._calc_coeffs(flux_vectors,self.params[:,pp], pp)
+        #Coefficients of dp**2 and dp as (nparams, nk) matrices, for prediction
+        self.quad_coeffs = np.array([self.tables[pp][:,0] for pp in range(np.shape(self.params)[1])])
+        self.lin_coeffs = np.array([self.tables[pp][:,1] for pp in range(np.shape(self.params)[1])])
 
     def predict(self, params):
-        """Get the interpolated quantity by evaluating the quadratic fit"""
-        #Interpolate onto desired bins
+        """Get the interpolated quantity by evaluating the quadratic fit.
+        params has shape (N, nparams) and the result has shape (N, nk)."""
         #Do parameter correction
-        newq = np.ones_like(self.bestfv)
-        assert np.shape(params) == (1,np.shape(self.bestpar)[0])
-        dpp = params[0] - self.bestpar
-        for pp,dp in enumerate(dpp):
-            newq += self.tables[pp][:,0]*dp**2 +self.tables[pp][:,1]*dp
+        params = np.array(params, ndmin=2)
+        assert np.shape(params)[1] == np.shape(self.bestpar)[0]
+        dpp = params - self.bestpar
+        newq = 1 + np.dot(dpp**2, self.quad_coeffs) + np.dot(dpp, self.lin_coeffs)
         mean = newq * self.bestfv
         std = 1e-30*np.ones_like(mean)
         return mean, std
 
     def _flux_deriv(self, PFdif, pdif):
-        """Calculate the flux-derivative for a single parameter change"""
-        assert np.size(pdif) == np.size(PFdif)
+        """Calculate the flux-derivative for a single parameter change.
+        PFdif may have a second axis (of k bins), which are all fit at once as they share the design matrix."""
+        assert np.size(pdif) == np.shape(PFdif)[0]
         mat=np.vstack([pdif**2, pdif] ).T
         (derivs, _,_, _)=np.linalg.lstsq(mat, PFdif, rcond=None)
         return derivs
@@ -79,10 +85,10 @@ class QuadraticPoly(SkLearnGP):
         """
         #Get the change in the interpoaltion value with parameter
         (dfv, dparams) = self._get_changes(flux_vectors, params,pind)
-        #Pass each k value to flux_deriv in turn.
+        #Fit every k value at once.
         # Format of returned data from flux_derivs is (a,b) where it fits to:
         # dto_interp = a params**2 + b params
-        results = np.array([self._flux_deriv(dfv[:,k], dparams) for k in range(np.shape(dfv)[1])])
+        results = self._flux_deriv(dfv, dparams).T
         #So results should have shape
         assert np.shape(results) == (np.size(self.bestfv), 2)
         return results
@@ -123,9 +129,11 @@ class QuadraticEmulator(Emulator):
         gp = self._get_custom_emulator(emuobj=QuadraticPoly, max_z=max_z)
         return gp
 
+    @profiling.profiled("QuadraticEmulator.get_flux_vectors")
     def get_flux_vectors(self, max_z=4.2, kfunits="kms"):
         """Get the desired flux vectors and their parameters.
-        This is subclassed so that we only change the mean flux parameters around the best fit, central, model."""
+        This is subclassed so that we only change the mean flux parameters around the best fit, central, model.
+        As in Emulator.get_flux_vectors, only missing or stale flux vectors are extracted from disc."""
         pvals = self.get_parameters()
         nparams = np.shape(pvals)[1]
         assert nparams == len(self.param_names)
@@ -145,25 +153,14 @@ class QuadraticEmulator(Emulator):
             aparams += [np.concatenate([dp, pvals[0]]) for dp in dpvals[nmfind]]
             aparams += [np.concatenate([dpvals[mfind], pv]) for pv in pvals[1:]]
             aparams = np.array(aparams)
-        try:
-            kfmpc, kfkms, flux_vectors = self.load_flux_vectors(aparams, savefile="quadratic_flux_vectors.hdf5")
-        except (AssertionError, OSError):
-            powers = [self._get_fv(pp, myspec) for pp in pvals]
-            #First we want the best-fit
-            flux_vectors = [powers[0].get_power_native_binning(mean_fluxes = medmf),]
-            #Now best fit parameters, with varying mean flux values.
-            flux_vectors += [powers[0].get_power_native_binning(mean_fluxes = mef) for mef in mean_fluxes]
-            #Now the rest
-            flux_vectors += [ps.get_power_native_binning(mean_fluxes = medmf) for ps in powers[1:]]
-            flux_vectors = np.array(flux_vectors)
-            #'natively' binned k values in km/s units as a function of redshift
-            kfkms = [powers[0].get_kf_kms(),]
-            kfkms += [powers[0].get_kf_kms() for mef in mean_fluxes]
-            kfkms += [ps.get_kf_kms() for ps in powers[1:]]
-            #Same in all boxes
-            kfmpc = powers[0].kf
-            assert np.all(np.abs(powers[0].kf/ powers[-1].kf-1) < 1e-6)
-            self.save_flux_vectors(aparams, kfmpc, kfkms, flux_vectors, savefile="quadratic_flux_vectors.hdf5")
+        #Identity of each flux vector, so that we notice if a simulation has changed.
+        ident = lambda pp, mef: simulation_identity(os.path.join(self.basedir, self._get_simdir(pp)), spectra_file=myspec.savefile)+":"+mean_flux_identity(mef, myspec.zout)
+        identities = [ident(pvals[0], medmf),] + [ident(pvals[0], mef) for mef in mean_fluxes] + [ident(pv, medmf) for pv in pvals[1:]]
+        #The best-fit simulation with each mean flux, then the rest with the best-fit mean flux.
+        rowsims = [0,]*(1+len(mean_fluxes)) + list(range(1, np.shape(pvals)[0]))
+        rowmf = [medmf,] + list(mean_fluxes) + [medmf,]*(np.shape(pvals)[0]-1)
+        store = self._get_store(savefile="quadratic_flux_vectors.hdf5")
+        kfmpc, kfkms, flux_vectors = self._read_store_rows(store, pvals, myspec, aparams, rowsims, rowmf, identities)
         assert np.shape(flux_vectors)[0] == np.shape(aparams)[0]
         if kfunits == "kms":
             kf = kfkms
@@ -0,0 +1,159 @@
+"""Share a trained emulator between processes without copying it.
+The numeric state of a MultiBinGP (for each redshift: the training inputs, the GP posterior
+woodbury vector and Cholesky factor, the kernel hyperparameters and the flux normalisation)
+and the data covariance matrices are published into a single block of shared memory.
+Worker processes attach read-only numpy views of that block and predict with a pure numpy
+implementation of the GP posterior mean and variance, so their memory use does not depend on
+the size of the emulator. If the training set has been updated (add_to_training_set),
+the updated GPs are published as well.
+Only GPs built by gpemulator.SkLearnGP (a linear plus RBF kernel with Gaussian noise) are supported."""
+from multiprocessing import shared_memory
+import numpy as np
+import scipy.linalg
+from .latin_hypercube import map_to_unit_cube_list
+
+def _gp_state(skgp, gp=None):
+    """Extract the numeric state of an SkLearnGP needed to predict, by default from its original GP."""
+    if gp is None:
+        gp = skgp.gp
+    names = [part.name for part in gp.kern.parts]
+    if names != ["linear", "rbf"] or gp.normalizer is not None:
+        raise ValueError("Only linear + RBF kernels without normalizers can be shared, not: "+str(names))
+    return {"X": np.array(gp.X),
+            "woodbury_vector": np.array(gp.posterior.woodbury_vector),
+            "woodbury_chol": np.array(gp.posterior.woodbury_chol),
+            "scalefactors": np.array(skgp.scalefactors),
+            "param_limits": np.array(skgp.param_limits),
+            "linear_variances": np.array(gp.kern.linear.variances.values),
+            "rbf_variance": np.array(gp.kern.rbf.variance.values),
+            "rbf_lengthscale": np.array(gp.kern.rbf.lengthscale.values),
+            "noise_variance": np.array(gp.likelihood.variance.values)}
+
+class SharedArrays:
+    """A set of named float64 arrays in one block of shared memory, owned by this process.
+    descriptor is a small picklable object which other processes pass to attach_arrays."""
+    def __init__(self, arrays, meta=None):
+        layout = {}
+        offset = 0
+        for key, arr in arrays.items():
+            layout[key] = (offset, np.shape(arr))
+            offset += np.size(arr) * 8
+        self.shm = shared_memory.SharedMemory(create=True, size=max(offset, 8))
+        for key, arr in arrays.items():
+            (off, shape) = layout[key]
+            view = np.ndarray(shape, dtype=np.float64, buffer=self.shm.buf, offset=off)
+            view[...] = arr
+        self.descriptor = {"name": self.shm.name, "layout": layout, "meta": meta}
+
+    def close(self):
+        """Release and remove the shared memory. Attached processes should have finished with it."""
+        self.shm.close()
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def attach_arrays(descriptor):
+    """Attach to shared arrays from their descriptor. Returns the shared memory object,
+    which must be kept alive while the arrays are used, and a dictionary of read-only arrays."""
+    shm = shared_memory.SharedMemory(name=descriptor["name"])
+    arrays = {}
+    for key, (off, shape) in descriptor["layout"].items():
+        arrays[key] = np.ndarray(shape, dtype=np.float64, buffer=shm.buf, offset=off)
+        arrays[key].flags.writeable = False
+    return shm, arrays
+
+def publish_emulator(gpemu, covariances=None):
+    """Publish the state of a trained MultiBinGP, and optionally a list of data covariance matrices
+    (one per redshift bin), into shared memory. Returns a SharedArrays, whose descriptor
+    should be passed to attach_emulator in each worker, and which should be closed when the workers are done."""
+    arrays = {"kf": np.array(gpemu.kf)}
+    updated = all(skgp.gp_updated is not None for skgp in gpemu.gps)
+    for i, skgp in enumerate(gpemu.gps):
+        for key, arr in _gp_state(skgp).items():
+            arrays["gp%d_%s" % (i, key)] = arr
+        if updated:
+            for key, arr in _gp_state(skgp, gp=skgp.gp_updated).items():
+                arrays["updated%d_%s" % (i, key)] = arr
+    ncovar = 0
+    if covariances is not None:
+        for i, covar in enumerate(covariances):
+            arrays["covar%d" % i] = covar
+        ncovar = len(covariances)
+    return SharedArrays(arrays, meta={"nz": gpemu.nz, "ncovar": ncovar, "updated": updated,
+                                           "training_set_version": getattr(gpemu, "training_set_version", 0)})
+
+class SharedGP:
+    """Predict from the shared state of one SkLearnGP, as GPy's GPRegression.predict does."""
+    def __init__(self, state):
+        self.state = state
+
+    def _kernel(self, x1, x2):
+        """Linear plus RBF kernel."""
+        st = self.state
+        linear = np.dot(x1 * st["linear_variances"], x2.T)
+        sqdist = np.sum((x1[:, np.newaxis, :] - x2[np.newaxis, :, :])**2 / st["rbf_lengthscale"]**2, axis=2)
+        return linear + st["rbf_variance"] * np.exp(-0.5 * sqdist)
+
+    def predict(self, params):
+        """Get the predicted flux power spectrum (and error) at a list of parameter values."""
+        st = self.state
+        params_cube = map_to_unit_cube_list(params, st["param_limits"])
+        kx = self._kernel(params_cube, st["X"])
+        flux_predict = np.dot(kx, st["woodbury_vector"])
+        kdiag = np.sum(params_cube**2 * st["linear_variances"], axis=1) + st["rbf_variance"]
+        #Solve with the Cholesky factor, as GPy does, for stability
+        tmp = scipy.linalg.solve_triangular(st["woodbury_chol"], kx.T, lower=True)
+        var = (kdiag - np.sum(tmp**2, axis=0) + st["noise_variance"])[:, np.newaxis]
+        mean = (flux_predict+1)*st["scalefactors"]
+        std = np.sqrt(var) * st["scalefactors"]
+        return mean, std
+
+def _prefixed(arrays, prefix):
+    """The arrays whose names start with prefix, with it removed."""
+    return {key[len(prefix):]: arr for key, arr in arrays.items() if key.startswith(prefix)}
+
+class SharedMultiBinGP:
+    """A read-only MultiBinGP attached to shared memory, with the same predict method.
+    The data covariance matrices, if published, are in covariances.
+    gps_updated holds the GPs for the updated training set, or is None if it was not updated."""
+    def __init__(self, descriptor):
+        (self._shm, arrays) = attach_arrays(descriptor)
+        self.nz = descriptor["meta"]["nz"]
+        self.kf = arrays["kf"]
+        self.nk = np.size(self.kf)
+        self.training_set_version = descriptor["meta"]["training_set_version"]
+        self.gps = [SharedGP(_prefixed(arrays, "gp%d_" % i)) for i in range(self.nz)]
+        self.gps_updated = None
+        if descriptor["meta"]["updated"]:
+            self.gps_updated = [SharedGP(_prefixed(arrays, "updated%d_" % i)) for i in range(self.nz)]
+        self.covariances = [arrays["covar%d" % i] for i in range(descriptor["meta"]["ncovar"])]
+
+    def predict(self, params, tau0_factors=None, use_updated_training_set=False):
+        """Get the predicted flux at a list of parameter values. See MultiBinGP.predict."""
+        gps = self.gps
+        if use_updated_training_set:
+            if self.gps_updated is None:
+                raise ValueError("The training set of the shared emulator was not updated")
+            gps = self.gps_updated
+        params = np.array(params, ndmin=2)
+        nsamp = np.shape(params)[0]
+        std = np.zeros([nsamp,self.nk*self.nz])
+        means = np.zeros([nsamp,self.nk*self.nz])
+        if tau0_factors is not None:
+            tau0_factors = np.array(tau0_factors, ndmin=2)
+        for i, gp in enumerate(gps):
+            zparams = np.array(params)
+            if tau0_factors is not None:
+                zparams[:,0] *= tau0_factors[:,i]
+            (m, s) = gp.predict(zparams)
+            means[:,i*self.nk:(i+1)*self.nk] = m
+            std[:,i*self.nk:(i+1)*self.nk] = s
+        return means, std
+
+def attach_emulator(descriptor):
+    """Attach to an emulator published by publish_emulator."""
+    return SharedMultiBinGP(descriptor)
@@ -1,15 +1,19 @@
-"""File to make a temperature density plot, weighted by HI fraction"""
+"""File to make a temperature density plot, weighted by HI fraction.
+Run as a module, from the directory containing lyaemu: python -m lyaemu.tempdens"""
 
 import os.path
+import glob
+import argparse
+import multiprocessing
 import numpy as np
+import h5py
 from scipy.optimize import leastsq
-import matplotlib
 from fake_spectra import abstractsnapshot as absn
 from fake_spectra import unitsystem as units
 from fake_spectra.gas_properties import GasProperties
 from fake_spectra.ratenetworkspectra import RateNetworkGas
-matplotlib.use("PDF")
-import matplotlib.pyplot as plt
+from .flux_power import MySpectra, get_snapshot_manifest
+from .flux_vector_store import simulation_identity
 
 def mean_density(hub, redshift, omegab=0.0465):
     """Get mean gas density at some redshift."""
@@ -45,49 +49,114 @@ def fit_temp_dens_relation(logoverden, logT):
         print(res[3])
     return 10**params[0], params[1] + 1
 
-def fit_td_rel_plot(num, base, nhi=True, nbins=500, gas="raw", plot=True):
-    """Make a temperature density plot of neutral hydrogen or gas.
-    Also fit a temperature-density relation for the total gas (not HI).
-    Arguments:
-        num - snapshot number
-        base - snapshot base directory
-        nbins - number of bins to use for the T-rho histogram
-        gas - if "raw" use snapshot values for temperature and neutral fraction. Otherwise use rate network values.
-        nhi - if True, plot neutral hydrogen, otherwise plot total gas density
-        plot - if True, make a plot, otherwise just do the fit
-    """
-    snap = absn.AbstractSnapshotFactory(num, base)
+class TempDensAccumulator:
+    """Accumulate a temperature density relation from chunks of particles.
+    Keeps a weighted 2D histogram of log density and log temperature on a fixed grid,
+    and the sums needed for a least squares power law fit of log T against log overdensity,
+    so that memory use does not depend on the number of particles.
+    Accumulators for different chunks may be merged, and the fit is the same as fit_temp_dens_relation
+    on all particles at once."""
+    def __init__(self, log_mean_dens, nbins=500, drange=(-8., 0.), trange=(2., 8.)):
+        self.log_mean_dens = log_mean_dens
+        self.dedges = np.linspace(drange[0], drange[1], nbins+1)
+        self.tedges = np.linspace(trange[0], trange[1], nbins+1)
+        self.hist = np.zeros((nbins, nbins))
+        #Number, sum of x, y, xy, x^2 for the particles in the fit.
+        self.sums = np.zeros(5)
+
+    def add(self, logdens, logT, weights):
+        """Add a chunk of particles."""
+        hist, _, _ = np.histogram2d(logdens, logT, bins=[self.dedges, self.tedges], weights=weights)
+        self.hist += hist
+        logoverden = logdens - self.log_mean_dens
+        ind = np.where((logoverden <  1.0) * (logT < 5.0))
+        xx = logoverden[ind]
+        yy = logT[ind]
+        self.sums += np.array([np.size(xx), np.sum(xx), np.sum(yy), np.sum(xx*yy), np.sum(xx*xx)])
+
+    def merge(self, other):
+        """Add the particles from another accumulator with the same grid."""
+        assert np.all(self.dedges == other.dedges) and np.all(self.tedges == other.tedges)
+        self.hist += other.hist
+        self.sums += other.sums
+
+    def fit(self):
+        """Fit the temperature density relation in closed form. Returns T0, gamma."""
+        (nn, sx, sy, sxy, sxx) = self.sums
+        gammam1 = (nn * sxy - sx * sy) / (nn * sxx - sx**2)
+        logT0 = (sy - gammam1 * sx) / nn
+        return 10**logT0, gammam1 + 1
 
+    def density(self):
+        """The histogram normalised as a probability density, as histogram2d(density=True)."""
+        area = np.outer(np.diff(self.dedges), np.diff(self.tedges))
+        return self.hist / np.sum(self.hist) / area
+
+def accumulate_td_rel(num, base, nhi=True, nbins=500, gas="raw", drange=(-8., 0.), trange=(2., 8.)):
+    """Read a snapshot one segment at a time, accumulating its temperature density relation.
+    Arguments are as for fit_td_rel_plot. Returns the redshift and a TempDensAccumulator."""
+    snap = absn.AbstractSnapshotFactory(num, base)
     redshift = 1./snap.get_header_attr("Time") - 1
     hubble = snap.get_header_attr("HubbleParam")
     if gas == "raw":
         rates = GasProperties(redshift, snap, hubble)
     else:
         rates = RateNetworkGas(redshift, snap, hubble)
+    mean_dens = mean_density(hubble, redshift, omegab=snap.get_omega_baryon())
+    acc = TempDensAccumulator(np.log10(mean_dens), nbins=nbins, drange=drange, trange=trange)
+    for segment in range(snap.get_n_segments()):
+        temp = rates.get_temp(0, segment)
+        dens = rates.get_code_rhoH(0, segment)
+        if nhi:
+            weights = rates.get_reproc_HI(0, segment)
+        else:
+            weights = dens
+        acc.add(np.log10(dens), np.log10(temp), weights)
+    return redshift, acc
 
-    dens = snap.get_data(0, "Density", -1)
-
-    temp = rates.get_temp(0, -1)
-
-    dens = rates.get_code_rhoH(0, -1)
+def _accumulate_one(args):
+    """Helper for fit_td_rel_snapshots, to be called in a worker process."""
+    (num, base, kwargs) = args
+    return accumulate_td_rel(num, base, **kwargs)
 
-    if nhi:
-        nhi = rates.get_reproc_HI(0, -1)
+def fit_td_rel_snapshots(nums, base, nprocs=1, **kwargs):
+    """Fit the temperature density relation for several snapshots, in parallel over nprocs processes.
+    Keyword arguments are passed to accumulate_td_rel.
+    Returns arrays of redshift, T0 and gamma, and the list of accumulators."""
+    tasks = [(num, base, kwargs) for num in nums]
+    if nprocs > 1:
+        with multiprocessing.Pool(nprocs) as pool:
+            results = pool.map(_accumulate_one, tasks)
     else:
-        nhi = dens
+        results = [_accumulate_one(task) for task in tasks]
+    fits = np.array([acc.fit() for (_, acc) in results])
+    return np.array([zz for (zz, _) in results]), fits[:,0], fits[:,1], [acc for (_, acc) in results]
 
-    logdens = np.log10(dens)
-    logT = np.log10(temp)
-    mean_dens = mean_density(hubble, redshift, omegab=snap.get_omega_baryon())
-    (T0, gamma) = fit_temp_dens_relation(logdens - np.log10(mean_dens), logT)
+def fit_td_rel_plot(num, base, nhi=True, nbins=500, gas="raw", plot=True):
+    """Make a temperature density plot of neutral hydrogen or gas.
+    Also fit a temperature-density relation for the total gas (not HI).
+    The snapshot is read one segment at a time, so memory use does not grow with the snapshot size.
+    Arguments:
+        num - snapshot number
+        base - snapshot base directory
+        nbins - number of bins to use for the T-rho histogram
+        gas - if "raw" use snapshot values for temperature and neutral fraction. Otherwise use rate network values.
+        nhi - if True, plot neutral hydrogen, otherwise plot total gas density
+        plot - if True, make a plot, otherwise just do the fit
+    """
+    (redshift, acc) = accumulate_td_rel(num, base, nhi=nhi, nbins=nbins, gas=gas)
+    (T0, gamma) = acc.fit()
     print("z=%f T0(K) = %f, gamma = %g" % (redshift, T0, gamma))
 
     if plot:
-        hist, dedges, tedges = np.histogram2d(logdens, logT, bins=nbins, weights=nhi, density=True)
+        #Only needed for plotting, which is not done in batch extraction.
+        import matplotlib.pyplot as plt
+        hist = acc.density()
+        (dedges, tedges) = (acc.dedges, acc.tedges)
 
-        plt.imshow(hist.T, interpolation='nearest', origin='low', extent=[dedges[0], dedges[-1], tedges[0], tedges[-1]], cmap=plt.cm.cubehelix_r, vmax=0.75, vmin=0.01)
+        plt.imshow(hist.T, interpolation='nearest', origin='lower', extent=[dedges[0], dedges[-1], tedges[0], tedges[-1]], cmap=plt.cm.cubehelix_r, vmax=0.75, vmin=0.01)
 
-        plt.plot(np.log10(mean_dens), np.log10(T0), '*', markersize=10, color="gold")
+        plt.plot(acc.log_mean_dens, np.log10(T0), '*', markersize=10, color="gold")
         dd = np.array([-6,-5,-4,-3])
         plt.xticks(dd, [r"$10^{%d}$" % d for d in dd])
         tt = np.array([2000, 3000, 5000, 10000, 20000, 30000, 50000, 100000])
@@ -101,10 +170,117 @@ def fit_td_rel_plot(num, base, nhi=True, nbins=500, gas="raw", plot=True):
         plt.tight_layout()
     return T0, gamma
 
+def _fit_snapshot(args):
+    """Helper for get_thermal_history: fit one snapshot, in a worker process.
+    Returns NaN if the snapshot cannot be read."""
+    (num, base, gas) = args
+    try:
+        (_, acc) = accumulate_td_rel(num, base, nhi=False, nbins=10, gas=gas)
+    except (IOError, KeyError, ValueError):
+        return np.nan, np.nan
+    return acc.fit()
+
+def _snapshot_mtime(outdir, snap):
+    """Latest modification time of the particle data of a snapshot (its directory and the files in it),
+    or 0 if there is none."""
+    mtime = 0.
+    for prefix in ("PART_", "snapdir_", "snap_"):
+        for path in glob.glob(os.path.join(outdir, prefix+str(snap).rjust(3,'0')+"*")):
+            mtime = max(mtime, os.path.getmtime(path))
+            if os.path.isdir(path):
+                with os.scandir(path) as entries:
+                    mtime = max([mtime,]+[entry.stat().st_mtime for entry in entries])
+    return mtime
+
+def _thermal_identity(simdir, snaps, gas):
+    """Identity of a row of the thermal history table: the hash of the simulation ICs,
+    the snapshots used and the modification times of their particle data, and the source of the gas temperatures."""
+    outdir = os.path.join(simdir, "output")
+    snapids = ",".join("%d@%.6f" % (sn, _snapshot_mtime(outdir, sn) if sn >= 0 else 0.) for sn in snaps)
+    return simulation_identity(simdir).split(":")[0] + ":" + snapids + ":" + gas
+
+def get_thermal_history(emulator, max_z=4.2, nprocs=1, gas="raw", savefile="thermal_history.hdf5"):
+    """Get T0 and gamma at each output redshift of MySpectra, for every simulation in an emulator.
+    The snapshots are fitted in parallel over nprocs processes. Results are saved to savefile
+    in the emulator directory, next to the flux vectors, and only simulations which are new
+    (or whose ICs or snapshots have changed) are fitted again.
+    Missing snapshots have NaN for T0 and gamma. Rows fitted with a different gas option are fitted again.
+    Returns the simulation parameters, the redshifts, and T0 and gamma, of shape (nsims, nz)."""
+    pvals = emulator.get_parameters()
+    zout = MySpectra(max_z=max_z, max_k=emulator.maxk).zout
+    simdirs = [emulator._get_simdir(pp) for pp in pvals]
+    fsave = os.path.join(emulator.basedir, savefile)
+    stored = {}
+    try:
+        with h5py.File(fsave, 'r') as load:
+            if np.shape(load["zout"]) == np.shape(zout) and np.allclose(load["zout"], zout):
+                for i, sd in enumerate(load["simdirs"].asstr()):
+                    stored[sd] = (load["identities"].asstr()[i], load["T0"][i], load["gamma"][i])
+    except (OSError, KeyError):
+        pass
+    #Snapshot closest to each output redshift, from the manifest, or -1 if there is none.
+    snaps = np.zeros((len(simdirs), np.size(zout)), dtype=int) - 1
+    identities = []
+    for i, sd in enumerate(simdirs):
+        outdir = os.path.join(emulator.basedir, sd, "output")
+        for entry in get_snapshot_manifest(outdir):
+            if entry["redshift"] is None:
+                continue
+            jj = np.argmin(np.abs(entry["redshift"] - zout))
+            if np.abs(entry["redshift"] - zout[jj]) < 0.01 and snaps[i, jj] < 0:
+                snaps[i, jj] = entry["snap"]
+        identities.append(_thermal_identity(os.path.join(emulator.basedir, sd), snaps[i], gas))
+    T0 = np.nan * np.ones(np.shape(snaps))
+    gamma = np.nan * np.ones(np.shape(snaps))
+    redo = []
+    for i, sd in enumerate(simdirs):
+        if sd in stored and stored[sd][0] == identities[i]:
+            (T0[i], gamma[i]) = stored[sd][1:]
+        else:
+            redo.append(i)
+    tasks = [(i, jj) for i in redo for jj in range(np.size(zout)) if snaps[i, jj] >= 0]
+    if tasks:
+        print("Fitting", len(tasks), "snapshots from", len(redo), "simulations")
+        args = [(snaps[i, jj], os.path.join(emulator.basedir, simdirs[i], "output"), gas) for (i, jj) in tasks]
+        if nprocs > 1:
+            with multiprocessing.Pool(nprocs) as pool:
+                fits = pool.map(_fit_snapshot, args)
+        else:
+            fits = [_fit_snapshot(arg) for arg in args]
+        for (i, jj), (tt, gg) in zip(tasks, fits):
+            T0[i, jj] = tt
+            gamma[i, jj] = gg
+    if redo or len(stored) != len(simdirs):
+        with h5py.File(fsave, 'w') as save:
+            save["zout"] = zout
+            save["params"] = pvals
+            save["simdirs"] = np.array(simdirs, dtype=h5py.string_dtype())
+            save["identities"] = np.array(identities, dtype=h5py.string_dtype())
+            save["T0"] = T0
+            save["gamma"] = gamma
+    return pvals, zout, T0, gamma
+
 if __name__ == "__main__":
-    (T0, gamma) = fit_td_rel_plot(10, os.path.expanduser("~/data/Lya_Boss/hires_s8_test/ns0.97As2.2e-09heat_slope0.083heat_amp0.92hub0.69/output/"), nhi=True)
-    plt.savefig("plots/tempdens.pdf")
-    plt.clf()
-    (T0, gamma) = fit_td_rel_plot(7, os.path.expanduser("~/data/Lya_Boss/hires_s8_test/ns0.97As2.2e-09heat_slope0.083heat_amp0.92hub0.69/output/"), nhi=True)
-    plt.savefig("plots/tempdens3.pdf")
-    plt.clf()
+    import matplotlib
+    matplotlib.use("PDF")
+    import matplotlib.pyplot as plt
+    #Run with python -m lyaemu.tempdens, as this module uses package-relative imports.
+    parser = argparse.ArgumentParser(description="Fit temperature density relations. Run as python -m lyaemu.tempdens.")
+    parser.add_argument('base', type=str, help='Emulator directory, or a snapshot output directory if --snapshots is given')
+    parser.add_argument('--snapshots', type=int, nargs='+', help='Plot these snapshots instead of fitting a whole emulator')
+    parser.add_argument('--plotdir', type=str, default="plots", help='Directory for plots')
+    parser.add_argument('--nprocs', type=int, default=1, help='Number of processes')
+    parser.add_argument('--max-z', type=float, default=4.2, help='Highest output redshift')
+    args = parser.parse_args()
+    if args.snapshots is None:
+        from .coarse_grid import Emulator
+        emu = Emulator(args.base)
+        emu.load()
+        (_, zout, T0, gamma) = get_thermal_history(emu, max_z=args.max_z, nprocs=args.nprocs)
+        for (zz, tt, gg) in zip(zout, T0.T, gamma.T):
+            print("z=%.1f T0(K) = %s gamma = %s" % (zz, tt, gg))
+    else:
+        for snap in args.snapshots:
+            (T0, gamma) = fit_td_rel_plot(snap, args.base, nhi=True)
+            plt.savefig(os.path.join(args.plotdir, "tempdens_%03d.pdf" % snap))
+            plt.clf()
@@ -0,0 +1,81 @@
+"""Test the simulation campaign manager with a fake scheduler."""
+
+import os
+import os.path
+import h5py
+import numpy as np
+from lyaemu import coarse_grid
+from lyaemu.campaign import SimulationCampaign, BatchScheduler
+
+class FakeEmulator(coarse_grid.Emulator):
+    """Emulator which makes a directory instead of generating ICs,
+    and fails for the simulations in fail_names."""
+    fail_names = []
+    def _do_ic_generation(self, ev, npart, box):
+        """Fake IC generation."""
+        name = self.build_dirname(ev)
+        if name in self.fail_names:
+            return False
+        os.makedirs(os.path.join(self.basedir, name, "output"))
+        return True
+
+class FakeScheduler:
+    """Scheduler which runs nothing, but lets the test decide when jobs finish."""
+    def __init__(self):
+        self.jobs = {}
+
+    def submit(self, simdir):
+        """Record a job"""
+        jobid = str(len(self.jobs))
+        self.jobs[jobid] = [simdir, "queued"]
+        return jobid
+
+    def status(self, jobid):
+        """Job status"""
+        return self.jobs[jobid][1]
+
+def _fake_spectra(simdir, zout):
+    """Write spectra savefiles for all the output redshifts."""
+    for i, zz in enumerate(zout):
+        sdir = os.path.join(simdir, "output", "SPECTRA_"+str(i).rjust(3,'0'))
+        os.makedirs(sdir)
+        with h5py.File(os.path.join(sdir, "lya_forest_spectra.hdf5"), 'w') as ff:
+            ff.create_group("Header").attrs["redshift"] = zz
+
+def test_campaign(tmp_path):
+    """Run a campaign through every state, with a failure and a resume."""
+    emu = FakeEmulator(str(tmp_path))
+    emu.sample_params = emu.build_params(4)
+    names = sorted(emu.build_dirname(ev) for ev in emu.sample_params)
+    FakeEmulator.fail_names = names[:1]
+    scheduler = FakeScheduler()
+    campaign = emu.gen_simulations(4, scheduler=scheduler, nworkers=2)
+    assert campaign.status()["failed"] == 1
+    assert campaign.status()["submitted"] == 3
+    #Resume from disc and retry the failure
+    FakeEmulator.fail_names = []
+    campaign = SimulationCampaign(emu, scheduler=scheduler)
+    assert campaign.get_names("failed") == names[:1]
+    campaign.generate_ics(retry_failed=True)
+    campaign.submit()
+    assert campaign.status()["submitted"] == 4
+    assert len(scheduler.jobs) == 4
+    #Finish two jobs, and extract spectra for one of them.
+    for jobid in ("0", "1"):
+        scheduler.jobs[jobid][1] = "finished"
+    _fake_spectra(scheduler.jobs["0"][0], campaign.zout)
+    status = campaign.update()
+    assert status["extracted"] == 1 and status["finished"] == 1 and status["submitted"] == 2
+    #State was saved
+    assert SimulationCampaign(emu).status() == status
+    assert np.shape(emu.sample_params) == (4, 5)
+
+def test_batch_scheduler_status():
+    """Check job states are mapped correctly, using echo in place of sacct."""
+    scheduler = BatchScheduler(query_command="echo {jobid}")
+    for (state, status) in (("RUNNING", "queued"), ("PENDING", "queued"), ("COMPLETED", "finished"),
+                            ("FAILED", "failed"), ("CANCELLED+", "failed"), ("TIMEOUT", "failed"), ("NODE_FAIL", "failed")):
+        assert scheduler.status(state) == status
+    #A job the accounting does not know is treated as finished, so its output is checked
+    assert BatchScheduler(query_command="true {jobid}").status("1") == "finished"
+    assert BatchScheduler(query_command="false {jobid}").status("1") == "finished"
@@ -0,0 +1,48 @@
+"""Tests for the emulator validation engine."""
+import os.path
+import h5py
+import numpy as np
+from lyaemu import coarse_grid_plot
+
+class RatioGP:
+    """Mock emulator predicting each test flux vector times a known factor, with a known error."""
+    def __init__(self, exact, factor, sigma):
+        self.exact = exact
+        self.factor = factor
+        self.sigma = sigma
+
+    def predict(self, params):
+        """Batched prediction: params are the row indices of the test points."""
+        rows = np.array(params, ndmin=2)[:, 0].astype(int)
+        return self.exact[rows] * self.factor[rows], self.sigma * self.exact[rows]
+
+def test_validate_emulator(tmp_path):
+    """Check the error statistics, the saved file and the plots."""
+    rng = np.random.default_rng(3)
+    (ntest, nz, nk) = (4, 3, 5)
+    exact = 1 + rng.random((ntest, nz*nk))
+    factor = 1 + 0.01 * rng.normal(size=(ntest, nz*nk))
+    gp = RatioGP(exact, factor, 0.01)
+    params = np.column_stack([np.arange(ntest), rng.random(ntest)])
+    res = coarse_grid_plot.validate_emulator(gp, params, exact, nz, nbins=20)
+    assert np.allclose(res["ratio"], factor)
+    assert np.allclose(res["err_norm"], (factor - 1) / 0.01)
+    frac = np.abs(factor - 1).reshape(ntest, nz, nk)
+    assert np.allclose(res["max_frac_err"], np.max(frac, axis=2))
+    assert np.allclose(res["max_frac_err_z"], np.max(frac, axis=(0, 2)))
+    for zz in range(nz):
+        hist, _ = np.histogram(res["err_norm"].reshape(ntest, nz, nk)[:, zz], bins=res["hist_edges"], density=True)
+        assert np.allclose(res["hist_z"][zz], hist)
+    hist, _ = np.histogram(res["err_norm"], bins=res["hist_edges"], density=True)
+    assert np.allclose(res["hist"], hist)
+    savedir = str(tmp_path)
+    names = ["test%d.pdf" % i for i in range(ntest)]
+    coarse_grid_plot.save_validation(os.path.join(savedir, "validation.hdf5"), res, params=params, names=names)
+    with h5py.File(os.path.join(savedir, "validation.hdf5"), 'r') as load:
+        assert np.all(load["max_frac_err"][:] == res["max_frac_err"])
+        assert list(load["names"].asstr()) == names
+    kf = np.tile(np.logspace(-3, -1.3, nk), (ntest, nz, 1))
+    coarse_grid_plot.plot_validation(savedir, names, kf, exact, res, [4.2, 4.0, 3.8], nprocs=2)
+    for name in names:
+        assert os.path.exists(os.path.join(savedir, name))
+        assert os.path.exists(os.path.join(savedir, "errhist_"+name))
@@ -0,0 +1,51 @@
+"""Tests for the emulator parameter bookkeeping in coarse_grid."""
+
+import os
+import os.path
+import json
+import numpy as np
+from lyaemu import coarse_grid
+
+def _write_ics(simdir, ns, slope=-0.2, amp=1., hub=0.7, scalar_amp=2e-9):
+    """Write a minimal SimulationICs.json file."""
+    os.makedirs(simdir, exist_ok=True)
+    sics = {"ns": ns, "rescale_slope": slope, "rescale_amp": amp, "hubble": hub, "scalar_amp": scalar_amp}
+    with open(os.path.join(simdir, "SimulationICs.json"), 'w') as jsout:
+        json.dump(sics, jsout)
+
+class CountingEmulator(coarse_grid.Emulator):
+    """Emulator which counts how many json files it parses."""
+    nparsed = 0
+    def _recon_one(self, pdir):
+        """Count calls"""
+        self.nparsed += 1
+        return super()._recon_one(pdir)
+
+def test_reconstruct(tmp_path):
+    """Check that reconstruct is sorted, ignores non-simulations and re-reads only changed simulations."""
+    basedir = str(tmp_path)
+    nss = [0.95, 0.85, 0.9]
+    for i, ns in enumerate(nss):
+        _write_ics(os.path.join(basedir, "sim"+str(2-i)), ns)
+    #Not a simulation
+    with open(os.path.join(basedir, "emulator_params.json"), 'w') as jsout:
+        jsout.write("{}")
+    emu = CountingEmulator(basedir)
+    emu.reconstruct(nthreads=2)
+    assert emu.nparsed == 3
+    assert np.shape(emu.sample_params) == (3, 5)
+    assert np.all(emu.sample_params[:, emu.param_names['ns']] == np.array(nss[::-1]))
+    assert np.all(emu.sample_params[:, emu.param_names['hub']] == 0.7)
+    #Second call uses the index
+    emu.reconstruct(nthreads=2)
+    assert emu.nparsed == 3
+    #Change one simulation: make sure the mtime moves.
+    _write_ics(os.path.join(basedir, "sim0"), 0.97)
+    ff = os.path.join(basedir, "sim0", "SimulationICs.json")
+    os.utime(ff, (os.path.getatime(ff), os.path.getmtime(ff)+10))
+    emu.reconstruct(nthreads=2)
+    assert emu.nparsed == 4
+    assert emu.sample_params[0, emu.param_names['ns']] == 0.97
+    #An index which cannot be written (as in a read-only directory) is not an error
+    emu.reconstruct(nthreads=2, indexfile=os.path.join("nodir", "reconstruct_index.json"))
+    assert emu.sample_params[0, emu.param_names['ns']] == 0.97
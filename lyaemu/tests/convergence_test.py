@@ -0,0 +1,36 @@
+"""Tests for the online convergence monitor and the HDF5 chain file."""
+
+import os.path
+import numpy as np
+from lyaemu.convergence import OnlineConvergence, HDF5ChainBackend
+from lyaemu.likelihood import gelman_rubin
+
+def _ar1_chain(nwalkers, nsteps, ndim, phi):
+    """An AR(1) chain, with integrated autocorrelation time (1+phi)/(1-phi)."""
+    chain = np.zeros((nwalkers, nsteps, ndim))
+    noise = np.random.normal(size=(nwalkers, nsteps, ndim))
+    for i in range(1, nsteps):
+        chain[:, i] = phi * chain[:, i-1] + noise[:, i]
+    return chain
+
+def test_online_convergence(tmp_path):
+    """Check the streaming statistics match those from the full chain, and the chain file."""
+    np.random.seed(23)
+    chain = _ar1_chain(16, 20000, 2, 0.5)
+    monitor = OnlineConvergence(16, 2, batch_size=100)
+    backend = HDF5ChainBackend(os.path.join(str(tmp_path), "chain.hdf5"), 16, 2)
+    for start in range(0, 20000, 3000):
+        chunk = chain[:, start:start+3000]
+        monitor.update(chunk)
+        backend.append(chunk, np.zeros(np.shape(chunk)[:2]))
+    assert monitor.nsteps == 20000
+    assert np.allclose(monitor.gelman_rubin(), gelman_rubin(chain))
+    assert np.allclose(monitor.moments.mean, np.mean(chain, axis=1))
+    assert np.allclose(monitor.moments.var(), np.var(chain, axis=1, ddof=1))
+    assert np.all(np.abs(monitor.autocorr_time() / 3. - 1) < 0.15)
+    assert monitor.converged()
+    assert np.all(backend.get_flatchain() == np.reshape(chain, (-1, 2)))
+    #A short chain is not converged
+    monitor = OnlineConvergence(16, 2, batch_size=100)
+    monitor.update(chain[:, :150])
+    assert not monitor.converged()
@@ -0,0 +1,67 @@
+"""Tests for the snapshot manifest used to find spectra."""
+
+import os
+import os.path
+import h5py
+from lyaemu import flux_power
+
+def _make_spectra(base, snap, redshift, prefix="SPECTRA_", savefile="lya_forest_spectra.hdf5"):
+    """Make a directory with a minimal spectra savefile."""
+    sdir = os.path.join(base, prefix+str(snap).rjust(3,'0'))
+    os.makedirs(sdir)
+    with h5py.File(os.path.join(sdir, savefile), 'w') as ff:
+        grp = ff.create_group("Header")
+        grp.attrs["redshift"] = redshift
+
+def test_snapshot_manifest(tmp_path, monkeypatch):
+    """Check the manifest finds the snapshots and their redshifts, and is reused without opening any files."""
+    base = str(tmp_path)
+    for snap, red in ((3, 2.2), (1, 3.0), (2, 2.6)):
+        _make_spectra(base, snap, red)
+    #A snapshot we cannot read should have no redshift
+    os.makedirs(os.path.join(base, "PART_004"))
+    os.makedirs(os.path.join(base, "other_005"))
+    manifest = flux_power.get_snapshot_manifest(base)
+    assert [mm["snap"] for mm in manifest] == [1, 2, 3, 4]
+    assert [mm["redshift"] for mm in manifest[:3]] == [3.0, 2.6, 2.2]
+    assert manifest[3]["redshift"] is None and not manifest[3]["savefile"]
+    assert manifest[0]["path"] == "SPECTRA_001" and manifest[0]["savefile"]
+    #Now the manifest should be read from disc: only the snapshot without a redshift is checked again.
+    reread = []
+    def _record(_, snap, __):
+        reread.append(snap)
+    monkeypatch.setattr(flux_power, "_read_snapshot_redshift", _record)
+    assert flux_power.get_snapshot_manifest(base) == manifest
+    assert reread == [4]
+    #A new snapshot changes the directory, so the manifest is rebuilt.
+    monkeypatch.undo()
+    _make_spectra(base, 0, 3.4)
+    assert [mm["snap"] for mm in flux_power.get_snapshot_manifest(base)] == [0, 1, 2, 3, 4]
+
+def test_snapshot_manifest_savefile(tmp_path):
+    """Check spectra savefiles written into existing snapshot directories are noticed,
+    even if the output directory itself has not changed."""
+    base = str(tmp_path)
+    _make_spectra(base, 1, 3.0)
+    sdir = os.path.join(base, "SPECTRA_002")
+    os.makedirs(sdir)
+    manifest = flux_power.get_snapshot_manifest(base)
+    assert manifest[1]["redshift"] is None and not manifest[1]["savefile"]
+    basetimes = (os.stat(base).st_atime, os.stat(base).st_mtime)
+    #Savefile written after the manifest was made
+    with h5py.File(os.path.join(sdir, "lya_forest_spectra.hdf5"), 'w') as ff:
+        ff.create_group("Header").attrs["redshift"] = 2.6
+    os.utime(base, basetimes)
+    manifest = flux_power.get_snapshot_manifest(base)
+    assert manifest[1]["redshift"] == 2.6 and manifest[1]["savefile"]
+    #Savefile rewritten in place, without changing either directory
+    sfile = os.path.join(base, "SPECTRA_001", "lya_forest_spectra.hdf5")
+    sdirtimes = (os.stat(os.path.dirname(sfile)).st_atime, os.stat(os.path.dirname(sfile)).st_mtime)
+    sfiletimes = (os.stat(sfile).st_atime, os.stat(sfile).st_mtime)
+    basetimes = (os.stat(base).st_atime, os.stat(base).st_mtime)
+    with h5py.File(sfile, 'w') as ff:
+        ff.create_group("Header").attrs["redshift"] = 3.2
+    os.utime(sfile, (sfiletimes[0] + 1, sfiletimes[1] + 1))
+    os.utime(os.path.dirname(sfile), sdirtimes)
+    os.utime(base, basetimes)
+    assert flux_power.get_snapshot_manifest(base)[0]["redshift"] == 3.2
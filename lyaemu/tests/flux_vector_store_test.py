@@ -0,0 +1,134 @@
+"""Tests for the resizable flux vector store and its use by the emulator."""
+
+import os.path
+import json
+import numpy as np
+from lyaemu import coarse_grid
+from lyaemu import mean_flux
+from lyaemu import quadratic_emulator
+from lyaemu.flux_vector_store import FluxVectorStore
+
+def test_store_append(tmp_path):
+    """Check that rows can be appended, found and read back in any order."""
+    store = FluxVectorStore(os.path.join(str(tmp_path), "fv.hdf5"), classname="Emulator")
+    kfmpc = np.linspace(0.1, 5, 10)
+    params = np.random.random_sample((4, 3))
+    fvs = np.random.random_sample((4, 20))
+    kfkms = np.random.random_sample((4, 2, 10))
+    sims = ["a", "b", "c", "d"]
+    store.append(sims[:2], params[:2], kfmpc, kfkms[:2], fvs[:2])
+    (rows, stale) = store.find_rows(sims, params)
+    assert np.all(rows == np.array([0, 1, -1, -1]))
+    assert not np.any(stale)
+    new = store.append(sims[2:], params[2:], kfmpc, kfkms[2:], fvs[2:])
+    assert np.all(new == np.array([2, 3]))
+    assert store.nrows() == 4
+    #Same simulation, different parameters is a different row
+    assert store.find_rows(["a"], params[1:2])[0][0] == -1
+    order = [3, 0, 2, 0]
+    (rows, _) = store.find_rows([sims[i] for i in order], params[order])
+    (kk, kkms, ff) = store.read_rows(rows)
+    assert np.all(kk == kfmpc)
+    assert np.all(ff == fvs[order])
+    assert np.all(kkms == kfkms[order])
+    #Rows with a different identity are stale
+    store.update([1], ["new"], kfkms[:1], fvs[:1])
+    (rows, stale) = store.find_rows(sims[:2], params[:2], identities=["", "old"])
+    assert np.all(rows == np.array([0, 1])) and np.all(stale == np.array([False, True]))
+    assert np.all(store.read_rows([1])[2] == fvs[:1])
+    #Different k binning invalidates the store
+    store.append(["e"], params[:1], 2*kfmpc, kfkms[:1], fvs[:1])
+    assert store.nrows() == 1
+
+class MockPower:
+    """Mock flux power object, with the interface of flux_power.FluxPower."""
+    def __init__(self, params, nz=3):
+        self.params = params
+        self.kf = np.linspace(0.1, 5, 10)
+        self.nz = nz
+
+    def get_power_native_binning(self, mean_fluxes):
+        """Flux power depending on the parameters."""
+        _ = mean_fluxes
+        return np.tile(self.kf * np.sum(self.params), self.nz)
+
+    def get_kf_kms(self):
+        """k in km/s units"""
+        return np.array([self.kf/100.,]*self.nz)
+
+class MockEmulator(coarse_grid.Emulator):
+    """Emulator which counts how many simulations it reads from disc."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.nread = 0
+
+    def _get_fv(self, pp, myspec):
+        """Get a mock flux power spectrum."""
+        self.nread += 1
+        return MockPower(pp)
+
+    def make_sims(self, samples):
+        """Make (empty) simulation directories for some new samples."""
+        for pp in samples:
+            simdir = os.path.join(self.basedir, self.build_dirname(pp))
+            os.makedirs(os.path.join(simdir, "output"))
+            with open(os.path.join(simdir, "SimulationICs.json"), 'w') as jsout:
+                json.dump({"ns": pp[0]}, jsout)
+        if len(self.sample_params) == 0:
+            self.sample_params = samples
+        else:
+            self.sample_params = np.vstack([self.sample_params, samples])
+
+def test_incremental_flux_vectors(tmp_path):
+    """Check that adding simulations only extracts flux vectors for the new ones."""
+    emu = MockEmulator(str(tmp_path))
+    emu.make_sims(emu.build_params(5))
+    (aparams, _, fvs) = emu.get_flux_vectors(kfunits="mpc")
+    assert emu.nread == 5
+    assert np.shape(fvs) == (5, 30)
+    #Reloading reads nothing
+    (aparams2, _, fvs2) = emu.get_flux_vectors(kfunits="mpc")
+    assert emu.nread == 5
+    assert np.all(fvs2 == fvs) and np.all(aparams2 == aparams)
+    #Adding two simulations reads only those two.
+    emu.make_sims(emu.build_params(2))
+    (aparams3, _, fvs3) = emu.get_flux_vectors(kfunits="mpc")
+    assert emu.nread == 7
+    assert np.shape(fvs3) == (7, 30)
+    assert np.all(fvs3[:5] == fvs)
+    expected = np.array([MockPower(pp).get_power_native_binning(None) for pp in aparams3])
+    assert np.all(fvs3 == expected)
+
+def test_stale_flux_vectors(tmp_path):
+    """Check that changing one simulation only recomputes that simulation."""
+    emu = MockEmulator(str(tmp_path))
+    emu.make_sims(emu.build_params(4))
+    emu.get_flux_vectors(kfunits="mpc")
+    assert emu.nread == 4
+    pp = emu.sample_params[2]
+    with open(os.path.join(emu.basedir, emu.build_dirname(pp), "SimulationICs.json"), 'w') as jsout:
+        json.dump({"ns": pp[0], "changed": True}, jsout)
+    (_, _, fvs) = emu.get_flux_vectors(kfunits="mpc")
+    assert emu.nread == 5
+    assert np.shape(fvs) == (4, 30)
+    #The store did not grow
+    assert emu._get_store(mfc="cc").nrows() == 4
+
+class MockQuadraticEmulator(MockEmulator, quadratic_emulator.QuadraticEmulator):
+    """Quadratic emulator which counts how many simulations it reads from disc."""
+
+def test_stale_quadratic_flux_vectors(tmp_path):
+    """Check that changing one simulation only recomputes that simulation in the quadratic emulator."""
+    emu = MockQuadraticEmulator(str(tmp_path), mf=mean_flux.MeanFluxFactor(dense_samples=3))
+    emu.make_sims(emu.build_params(11))
+    (aparams, _, fvs) = emu.get_flux_vectors(kfunits="mpc")
+    assert emu.nread == 11
+    nrows = np.shape(fvs)[0]
+    assert nrows == np.shape(aparams)[0] == 13
+    pp = emu.sample_params[0]
+    with open(os.path.join(emu.basedir, emu.build_dirname(pp), "SimulationICs.json"), 'w') as jsout:
+        json.dump({"ns": pp[0], "changed": True}, jsout)
+    (_, _, fvs2) = emu.get_flux_vectors(kfunits="mpc")
+    assert emu.nread == 12
+    assert np.all(fvs2 == fvs)
+    assert emu._get_store(savefile="quadratic_flux_vectors.hdf5").nrows() == nrows
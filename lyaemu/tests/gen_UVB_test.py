@@ -0,0 +1,40 @@
+"""Tests for the UVB (TREECOOL) generator."""
+import os.path
+import shutil
+import numpy as np
+from lyaemu import gen_UVB
+
+def test_fintarray():
+    """Check the cumulative integrals against integrating each tail separately."""
+    zz = np.linspace(0, 10, 200)**1.3
+    yy = np.exp(-zz) * np.sin(zz)**2
+    tails = gen_UVB.fintarray(zz, yy)
+    assert np.allclose(tails, [np.trapezoid(yy[i:], zz[i:]) for i in range(np.size(zz))])
+    assert np.isclose(gen_UVB.fint(zz, yy), tails[0])
+
+def test_treecool_io(tmp_path):
+    """Check UVB tables are loaded and cached, and TREECOOL files are written in the usual format."""
+    fname = os.path.join(str(tmp_path), "TREECOOL_test.txt")
+    shutil.copy(os.path.join(gen_UVB.UVB_DATADIR, gen_UVB.UVB_FILES["P18"]), fname)
+    data = gen_UVB.loadUVB(fname)
+    assert np.all(data == np.loadtxt(fname))
+    assert os.path.exists(os.path.join(str(tmp_path), "TREECOOL_test.npy"))
+    assert np.all(gen_UVB.loadUVB(fname) == data)
+    photo = data[:5, 1:].T
+    dtdz = (np.arange(5.), np.arange(5.)*2)
+    fout = os.path.join(str(tmp_path), "TREECOOL_out.txt")
+    gen_UVB.write_TREECOOL(fout, data[:5, 0], photo, QDeltaT=dtdz)
+    expected = "".join(["%f %e %e %e %e %e %e %e %e\n" % (tuple(data[i]) + (dtdz[0][i], dtdz[1][i])) for i in range(5)])
+    with open(fout) as fin:
+        assert fin.read() == expected
+
+def test_batch():
+    """Check the batch generator gives the same rates as generating each history."""
+    zz = np.arange(0., 18., 0.02)
+    cosmo = [0.6686, 0.0495, 0.32, 0.68, 0.75]
+    (_, photo) = gen_UVB.genQ2G_DeltaT_batch(zz, [7.65, 9.4], [3., 3.5], 2e4, [1.5e4, 1e4], model="P18", cosmo=cosmo)
+    assert np.shape(photo) == (2, 6, np.size(zz))
+    QHII = gen_UVB.myfQHII_2(zz, 9.4)
+    (_, single) = gen_UVB.genQ2G_DeltaT(zz, QHII, gen_UVB.fzendHII(zz, QHII), gen_UVB.myfQHeIII(zz, 3.5), 3.5, 2e4, 1e4, model="P18", cosmo=cosmo)
+    assert np.all(single == photo[1])
+    assert np.all(photo >= 0)
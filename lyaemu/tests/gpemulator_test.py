@@ -1,6 +1,7 @@
 """Test the gaussian process emulator classes using simple models
 for the data."""
 
+import copy
 import numpy as np
 from lyaemu import gpemulator
 
@@ -65,3 +66,33 @@ def test_emu_multi_param():
     gp = gpemulator.MultiBinGP(params=params, kf=kf, powers = powers, param_limits = plimits)
     predict,_ = gp.predict(np.reshape(np.array([0.5,0.288]),(1,-1)))
     assert np.max(np.abs(predict - (0.5+0.288**2) * 100*kf)/predict) < 1e-4
+
+def test_cross_validate():
+    """Check the closed form cross-validation against re-fitting the GP without each fold,
+    with the hyperparameters fixed."""
+    kf = np.array([ 0.00141,  0.00178,  0.00224])
+    rng = np.random.default_rng(7)
+    #10 simulations, each with two mean flux values, which come first
+    sims = rng.random((10, 2)) * np.array([1.5, 0.9]) + np.array([0.25, 0.1])
+    sims[:2] = [[0.25, 0.1], [1.75, 1.]]
+    params = np.array([np.concatenate([[tau], ss]) for tau in (0.8, 1.2) for ss in sims])
+    params[:, 0] += 0.01 * np.tile(np.arange(10), 2)
+    powers = np.array([MultiPower(par[1:]).get_power(kf=kf) * par[0] * (1 + 0.3*np.sin(3*par[1])) for par in params])
+    plimits = np.array(((0.8, 1.3), (0.25,1.75),(0.1,1)))
+    #One k bin per redshift, so column zz is redshift bin zz
+    gp = gpemulator.MultiBinGP(params=params, kf=kf[:1], powers = powers, param_limits = plimits, ndense=1)
+    assert np.all(gp.simulation_folds[:10] == gp.simulation_folds[10:])
+    assert np.size(np.unique(gp.simulation_folds)) == 10
+    for (folds, labels) in (("simulation", np.tile(np.arange(10), 2)), (None, np.arange(20)), (5, np.arange(20) % 5)):
+        (mean, std, err) = gp.cross_validate(folds=folds)
+        assert np.shape(mean) == np.shape(powers)
+        for zz, skgp in enumerate(gp.gps):
+            zsl = slice(zz, zz+1)
+            for label in (0, 3):
+                ind = labels == label
+                refit = copy.deepcopy(skgp.gp)
+                refit.set_XY(X=skgp.gp.X[~ind], Y=skgp.gp.Y[~ind])
+                (rmean, rvar) = refit.predict(skgp.gp.X[ind])
+                assert np.allclose(mean[ind, zsl], (rmean+1)*skgp.scalefactors, rtol=1e-5)
+                assert np.allclose(std[ind, zsl], np.sqrt(rvar)*skgp.scalefactors, rtol=1e-4)
+        assert np.allclose(err, (mean - powers)/std)
@@ -0,0 +1,17 @@
+"""Check that importing lyaemu does not pull in heavy optional dependencies."""
+
+import sys
+import subprocess
+
+def _modules_loaded_by(module, candidates):
+    """Import a module in a fresh interpreter and return which of candidates were loaded."""
+    code = "import sys; import %s; print(','.join(m for m in %s if m in sys.modules))" % (module, candidates)
+    out = subprocess.check_output([sys.executable, "-c", code])
+    return [mm for mm in out.decode().strip().split(",") if mm]
+
+def test_lazy_imports():
+    """The likelihood module should not import GPy, emcee, mpmath,
+    fake_spectra, camb or the SimulationRunner until they are used."""
+    heavy = ["GPy", "emcee", "mpmath", "fake_spectra", "camb", "matplotlib", "lyaemu.SimulationRunner"]
+    assert _modules_loaded_by("lyaemu.likelihood", heavy) == []
+    assert _modules_loaded_by("lyaemu.gpemulator", heavy) == []
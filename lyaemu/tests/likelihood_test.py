@@ -0,0 +1,170 @@
+"""Tests for the likelihood, using a mock emulator so no simulations are needed."""
+
+import os.path
+import warnings
+import numpy as np
+from lyaemu import coarse_grid
+from lyaemu import flux_power
+from lyaemu import likelihood
+
+class MockMultiBinGP:
+    """Mock of gpemulator.MultiBinGP with a smooth flux power and error."""
+    def __init__(self, nz, nk=50):
+        self.kf = np.linspace(0.05, 5, nk)
+        self.nz = nz
+        self.nk = nk
+
+    def predict(self, params, tau0_factors=None, use_updated_training_set=False):
+        """Flux power which depends on all the parameters, for a batch of parameters."""
+        _ = use_updated_training_set
+        params = np.array(params, ndmin=2)
+        tau = np.ones((1, self.nz)) if tau0_factors is None else np.array(tau0_factors, ndmin=2)
+        zfac = np.repeat(tau, self.nk, axis=1) * params[:, 0:1]
+        means = 0.1 * np.tile(np.exp(-self.kf * params[:, 1:2]), self.nz) * zfac * (1 + np.sum(params[:, 2:], axis=1))[:, np.newaxis]
+        return means, 0.05 * means
+
+def make_likelihood(tmp_path, debug=False):
+    """Make a LikelihoodClass with a mock emulator."""
+    coarse_grid.Emulator(str(tmp_path)).dump()
+    like = likelihood.LikelihoodClass(str(tmp_path), optimise_GP=False, debug=debug)
+    like.gpemu = MockMultiBinGP(np.size(like.zout))
+    return like
+
+def _reference_likelihood(like, params, data_power, include_emu=True):
+    """The likelihood as it was computed before the fast path, with explicit inverses."""
+    okf, predicted, std = like.get_predicted(params)
+    nkf = int(np.size(like.kf))
+    chi2 = 0
+    for bb in range(np.shape(predicted)[0]):
+        idp = np.where(like.kf >= okf[bb][0])
+        diff_bin = predicted[bb] - data_power[nkf*bb:nkf*(bb+1)][idp]
+        bindx = np.min(idp)
+        covar_bin = np.array(like.get_BOSS_error(bb)[bindx:,bindx:])
+        if include_emu:
+            covar_bin += np.outer(std[bb], std[bb])
+        (_, cdet) = np.linalg.slogdet(covar_bin)
+        chi2 += - np.dot(diff_bin, np.dot(np.linalg.inv(covar_bin), diff_bin),)/2. -0.5* cdet
+    return chi2
+
+def test_likelihood(tmp_path):
+    """Check the fast likelihood matches the reference computation, in debug mode and not."""
+    like = make_likelihood(tmp_path)
+    params = np.mean(like.param_limits, axis=1)
+    okf, predicted, _ = like.get_predicted(params)
+    data = np.concatenate([np.interp(like.kf, okf[bb], predicted[bb]) for bb in range(len(okf))]) * 1.02
+    for include_emu in (True, False):
+        ref = _reference_likelihood(like, params, data, include_emu=include_emu)
+        assert np.isclose(like.likelihood(params, include_emu=include_emu, data_power=data), ref, rtol=1e-10)
+    like.debug = True
+    assert np.isclose(like.likelihood(params, data_power=data), _reference_likelihood(like, params, data), rtol=1e-10)
+    #The cached covariance was not changed
+    assert np.all(like.get_BOSS_error(0) == like.sdss.get_covar(like.zout[0]))
+    #Outside the prior
+    assert like.likelihood(like.param_limits[:,1], data_power=data) == -np.inf
+    #A covariance which is not positive definite does not raise
+    like.debug = False
+    indefinite = np.array(like.get_BOSS_error(0))
+    indefinite[-1,-1] *= -1
+    like._BOSS_covar[0] = indefinite
+    for include_emu in (True, False):
+        ref = _reference_likelihood(like, params, data, include_emu=include_emu)
+        assert np.isclose(like.likelihood(params, include_emu=include_emu, data_power=data), ref, rtol=1e-10)
+    like._BOSS_covar[0] = np.zeros_like(indefinite)
+    assert like.likelihood(params, include_emu=False, data_power=data) == -np.inf
+
+def test_prediction_cache(tmp_path):
+    """Check repeated predictions are cached, and the cache is bounded."""
+    like = make_likelihood(tmp_path)
+    like.prediction_cache_size = 3
+    params = np.mean(like.param_limits, axis=1)
+    (okf, pred, std) = like.get_predicted(params)
+    (okf2, pred2, std2) = like.get_predicted(params.copy())
+    assert pred2 is pred and std2 is std and okf2 is okf
+    assert like.prediction_cache_stats()["hits"] == 1
+    #Updated training set predictions are separate
+    like.get_predicted(params, use_updated_training_set=True)
+    assert like.prediction_cache_stats()["misses"] == 2
+    for i in range(4):
+        like.get_predicted(params * (1 + 1e-3 * (i+1)))
+    stats = like.prediction_cache_stats()
+    assert stats["size"] == 3 and stats["misses"] == 6 and stats["hit_rate"] == 1/7
+    #Evicted
+    (_, pred3, _) = like.get_predicted(params)
+    assert pred3 is not pred
+    assert np.all(pred3[0] == pred[0])
+    like.clear_prediction_cache()
+    assert like.prediction_cache_stats()["size"] == 0
+    #Adding to the updated training set invalidates only its predictions
+    like.get_predicted(params)
+    like.get_predicted(params, use_updated_training_set=True)
+    like.gpemu.training_set_version = 1
+    like.get_predicted(params)
+    like.get_predicted(params, use_updated_training_set=True)
+    assert like.prediction_cache_stats()["misses"] == 3
+    #Replacing the emulator invalidates all predictions, even if the new one has the same id
+    old = like.gpemu
+    like.gpemu = MockMultiBinGP(np.size(like.zout), nk=old.nk)
+    like.gpemu.kf = old.kf * 1.1
+    del old
+    assert like.prediction_cache_stats()["size"] == 0
+    (_, pred4, _) = like.get_predicted(params)
+    assert not np.allclose(pred4[0], pred[0])
+
+def test_refine_metric_batch(tmp_path):
+    """Check the batched refinement metric against determinants of the full covariance matrices."""
+    like = make_likelihood(tmp_path)
+    nsamp = 20
+    np.random.seed(11)
+    params = np.random.rand(nsamp, like.ndim)*(like.param_limits[:,1]-like.param_limits[:,0]) + like.param_limits[:,0]
+    params[3] = like.param_limits[:,1]
+    with warnings.catch_warnings():
+        #Points outside the prior should not produce invalid floating point operations
+        warnings.simplefilter("error", RuntimeWarning)
+        batch = like.refine_metric_batch(params, chunk_size=7)
+        assert np.isnan(like.refine_metric(params[3]))
+    assert np.isnan(batch[3])
+    for nn in (0, 1, 5, 19):
+        okf, _, std = like.get_predicted(params[nn])
+        logdet = 0
+        datalogdet = 0
+        for bb in range(np.size(like.zout)):
+            bindx = np.size(like.kf) - np.size(okf[bb])
+            covar = np.array(like.get_BOSS_error(bb))
+            datalogdet += np.linalg.slogdet(covar)[1]
+            covar[bindx:,bindx:] += np.outer(std[bb], std[bb])
+            logdet += np.linalg.slogdet(covar)[1]
+        assert np.isclose(like.get_covar_det(params[nn], True), logdet, rtol=1e-10)
+        assert np.isclose(like.get_covar_det(params[nn], False), datalogdet, rtol=1e-10)
+        assert np.isclose(batch[nn], np.exp(logdet - datalogdet), rtol=1e-8)
+        assert np.isclose(like.refine_metric(params[nn]), batch[nn], rtol=1e-8)
+    assert np.allclose(like.get_covar_det(params, True, chunk_size=5)[:3], [like.get_covar_det(pp, True) for pp in params[:3]])
+    assert like.get_covar_det(params[3], True) == -np.inf
+    #Batched rebinning matches the single rebinning
+    omega_m = np.array([0.25, 0.3])
+    fps = np.random.rand(2, np.size(like.zout)*like.gpemu.nk)
+    (bindx, rebinned) = flux_power.rebin_power_to_kms_batch(like.kf, like.gpemu.kf, fps, like.zout, omega_m)
+    for nn in range(2):
+        (okf, single) = flux_power.rebin_power_to_kms(like.kf, like.gpemu.kf, fps[nn], like.zout, omega_m[nn])
+        for bb in range(np.size(like.zout)):
+            assert bindx[nn, bb] == np.size(like.kf) - np.size(okf[bb])
+            assert np.allclose(rebinned[nn, bb, bindx[nn, bb]:], single[bb])
+    grid = like.make_err_grid(2, 3, samples=200, chunk_size=64)
+    assert np.shape(grid) == (200, 200)
+
+def _gauss_lnlike(params):
+    """Gaussian log-likelihood for testing the sampler loop."""
+    return -np.sum(params**2)/2.
+
+def test_run_chains(tmp_path):
+    """Check the result of sampling holds the whole chain, not just the last chunk."""
+    import emcee
+    like = make_likelihood(tmp_path)
+    nwalkers = 2*like.ndim+2
+    sampler = emcee.EnsembleSampler(nwalkers, like.ndim, _gauss_lnlike)
+    p0 = np.random.normal(size=(nwalkers, like.ndim))
+    savefile = os.path.join(str(tmp_path), "chain.txt")
+    result = like._run_chains(sampler, savefile, p0, 10, 20, 3, True, 1e6, [("p%d" % i, "") for i in range(like.ndim)])
+    assert result is like.cur_results
+    assert np.shape(result.chain) == (nwalkers, 60, like.ndim)
+    assert np.shape(result.lnprobability) == (nwalkers, 60)
+    assert np.all(result.flatchain == np.loadtxt(savefile))
@@ -0,0 +1,70 @@
+"""Test the caching and rescaling of linear theory matter power spectra."""
+
+import numpy as np
+from lyaemu import linear_theory
+
+class FakeCAMB:
+    """Stands in for CAMB: a power law primordial power times a fixed transfer function. Counts calls."""
+    def __init__(self):
+        self.ncalls = 0
+
+    def __call__(self, *, hub, omega_b, omega_c, ns, As, zz):
+        self.ncalls += 1
+        kh = np.logspace(-2, 1, 200)
+        transfer = 1/(1 + (kh/(omega_b + omega_c))**2)
+        pk = np.array([As * (kh*hub/0.05)**(ns-1) * kh * transfer**2 / (1+z)**2 for z in zz])
+        return kh, pk
+
+def test_matter_power_cache(tmp_path, monkeypatch):
+    """Check CAMB is run once per background cosmology and the rescaled power is correct."""
+    fake = FakeCAMB()
+    monkeypatch.setattr(linear_theory, "_camb_matter_power", fake)
+    linear_theory._MATTER_POWER_CACHE.clear()
+    zz = [2.2, 3.]
+    for (ns, As) in ((0.965, 2.41e-9), (0.9, 1.5e-9), (1.05, 3e-9)):
+        (kh, pk) = linear_theory.matter_power(ns=ns, As=As, zz=zz, cachedir=str(tmp_path))
+        (_, expected) = fake(hub=0.7, omega_b=0.049, omega_c=0.25, ns=ns, As=As, zz=zz)
+        assert np.allclose(pk, expected, rtol=1e-12)
+    assert fake.ncalls == 4
+    #A different background cosmology needs CAMB
+    linear_theory.matter_power(hub=0.65, zz=zz, cachedir=str(tmp_path))
+    assert fake.ncalls == 5
+    #Loaded from disc when not in memory
+    linear_theory._MATTER_POWER_CACHE.clear()
+    (_, pk2) = linear_theory.matter_power(ns=1.05, As=3e-9, zz=zz, cachedir=str(tmp_path))
+    assert fake.ncalls == 5
+    assert np.allclose(pk2, pk, rtol=1e-12)
+    linear_theory._MATTER_POWER_CACHE.clear()
+
+def test_matter_power_no_disc_cache(tmp_path, monkeypatch):
+    """Check nothing is written to disc unless a cache directory is given."""
+    monkeypatch.setattr(linear_theory, "_camb_matter_power", FakeCAMB())
+    monkeypatch.setattr(linear_theory, "CACHE_DIR", None)
+    monkeypatch.setenv("HOME", str(tmp_path))
+    monkeypatch.chdir(tmp_path)
+    linear_theory._MATTER_POWER_CACHE.clear()
+    linear_theory.matter_power(zz=[3.])
+    assert not list(tmp_path.iterdir())
+    #The module level cache directory is used if set
+    linear_theory._MATTER_POWER_CACHE.clear()
+    monkeypatch.setattr(linear_theory, "CACHE_DIR", str(tmp_path / "camb"))
+    linear_theory.matter_power(zz=[3.])
+    assert len(list((tmp_path / "camb").iterdir())) == 1
+    linear_theory._MATTER_POWER_CACHE.clear()
+
+def test_flux_power_1d():
+    """Check the cumulative projection against direct integrals for each k."""
+    kvals = np.logspace(-2, 1, 150)
+    matpow = np.array([1e3 * kvals / (1 + (kvals/0.1)**3), 5e2 * kvals / (1 + (kvals/0.2)**3)])
+    bias = np.array([-0.14, -0.2])
+    (_, pf) = linear_theory.flux_power_1d(matpow, kvals, bias_flux=bias, beta_flux=-0.2)
+    (_, pfmu) = linear_theory.flux_power_1d(matpow, kvals, bias_flux=bias, beta_flux=-0.2, mu_dependent=True)
+    for j in range(2):
+        (_, single) = linear_theory.flux_power_1d(matpow[j], kvals, bias_flux=bias[j], beta_flux=-0.2)
+        assert np.allclose(single, pf[j])
+        for i in (0, 40, 149):
+            p3d = linear_theory.flux_power_3d(matpow[j, i:], 1, bias_flux=bias[j], beta_flux=-0.2)
+            assert np.isclose(pf[j, i], np.trapezoid(p3d*kvals[i:], kvals[i:])/2/np.pi)
+            p3dmu = linear_theory.flux_power_3d(matpow[j, i:], kvals[i]/kvals[i:], bias_flux=bias[j], beta_flux=-0.2)
+            assert np.isclose(pfmu[j, i], np.trapezoid(p3dmu*kvals[i:], kvals[i:])/2/np.pi)
+    assert pf[0, -1] == 0
@@ -0,0 +1,78 @@
+"""Tests for reading and rebinning the matter power spectrum from simulations."""
+import os
+import numpy as np
+from lyaemu import matter_power
+
+def _folded_power_loop(adata, bins):
+    """The original bin merging, one input bin at a time."""
+    K_A = adata[:,0]
+    ModeCount_A = adata[:,4]
+    PowConv = adata[:,6]*adata[:,9]
+    logK_A=np.log10(K_A)
+    MinDlogK = (np.max(logK_A) - np.min(logK_A))/200
+    istart = iend = 0
+    count = 0
+    k_list, pk_list = [], []
+    targetlogK=MinDlogK+logK_A[istart]
+    while iend < bins:
+        count+=ModeCount_A[iend]
+        iend+=1
+        if count >= 50 and logK_A[iend-1] >= targetlogK:
+            pk_list.append(np.sum(ModeCount_A[istart:iend]*PowConv[istart:iend])/count)
+            k_list.append(np.sum(ModeCount_A[istart:iend]*K_A[istart:iend])/count)
+            istart=iend
+            if istart < bins:
+                targetlogK=logK_A[istart]+MinDlogK
+            count=0
+    return np.array(k_list), np.array(pk_list)
+
+def _fake_bins(nbins, kmin, kmax, rng):
+    """Columns of a folded power spectrum table: k, mode count, power and conversion factor."""
+    adata = np.zeros((nbins, 10))
+    adata[:,0] = np.logspace(np.log10(kmin), np.log10(kmax), nbins)
+    adata[:,4] = rng.integers(0, 40, nbins)
+    adata[:,6] = 1e3*rng.random(nbins)
+    adata[:,9] = adata[:,0]**3
+    return adata
+
+def _write_powerspec(fname, time, adata, bdata):
+    """Write a file in the format of the Gadget folded power spectrum estimator."""
+    with open(fname, 'w') as out:
+        for data in (adata, bdata):
+            out.write("%g\n%d\n%d\n%d\n" % (time, np.shape(data)[0], 0, 0))
+            np.savetxt(out, data)
+
+def test_folded_power():
+    """Check the vectorised bin merging against the original loop."""
+    rng = np.random.default_rng(23)
+    for nbins in (10, 300, 2000):
+        adata = _fake_bins(nbins, 1e-3, 1, rng)
+        (kk, pk) = matter_power.GetFoldedPower(adata, nbins)
+        (kkl, pkl) = _folded_power_loop(adata, nbins)
+        assert np.shape(kk) == np.shape(kkl)
+        assert np.allclose(kk, kkl, rtol=1e-10)
+        assert np.allclose(pk, pkl, rtol=1e-10)
+
+def test_get_matter_power(tmp_path):
+    """Check snapshots are found by redshift and parsed files are cached."""
+    tmpdir = str(tmp_path)
+    rng = np.random.default_rng(5)
+    for snap, zz in enumerate((4., 3., 2.)):
+        _write_powerspec(os.path.join(tmpdir, "powerspec_%03d.txt" % snap), 1/(1+zz), _fake_bins(500, 1e-4, 1e-2, rng), _fake_bins(500, 1e-3, 0.1, rng))
+    (files, redshifts) = matter_power.snapshot_redshifts(tmpdir)
+    assert [os.path.basename(ff) for ff in files] == ["powerspec_000.txt", "powerspec_001.txt", "powerspec_002.txt"]
+    assert np.allclose(redshifts, [4, 3, 2])
+    assert os.path.exists(os.path.join(tmpdir, "powerspec_index.json"))
+    (time, kk, pk) = matter_power.get_folded_power(files[1])
+    assert os.path.exists(os.path.join(tmpdir, "powerspec_001_folded.npz"))
+    (ctime, ckk, cpk) = matter_power.get_folded_power(files[1])
+    assert ctime == time and np.all(ckk == kk) and np.all(cpk == pk)
+    (_, ukk, upk) = matter_power.get_folded_power(files[1], cache=False)
+    assert np.all(ukk == kk) and np.all(upk == pk)
+    kout = np.linspace(kk[1], kk[-2], 5)
+    assert np.allclose(matter_power.get_matter_power(tmpdir, kout, redshift=3.), np.interp(kout, kk, pk))
+    try:
+        matter_power.get_matter_power(tmpdir, kout, redshift=5.)
+        assert False
+    except IOError:
+        pass
@@ -0,0 +1,60 @@
+"""Test the parallel likelihood pools."""
+
+import os
+import pytest
+import numpy as np
+import emcee
+from lyaemu import likelihood
+from lyaemu import pools
+
+class GaussLike:
+    """Stand-in for LikelihoodClass with a Gaussian likelihood."""
+    def __init__(self, ndim):
+        self.icov = np.diag(np.arange(1, ndim+1))
+
+    def likelihood(self, params, include_emu=True):
+        """Gaussian log-likelihood, which depends on include_emu."""
+        chi2 = -np.dot(params, np.dot(self.icov, params))/2.
+        if include_emu:
+            chi2 -= 1
+        return chi2
+
+def test_pools():
+    """Check both pools give the same likelihoods as serial evaluation, and run emcee."""
+    like = GaussLike(3)
+    params = list(np.random.normal(size=(20, 3)))
+    serial = [like.likelihood(pp, include_emu=False) for pp in params]
+    for pool_type in ("process", "mpi"):
+        pool = pools.get_pool(2, pool_type=pool_type, initializer=likelihood._init_pool_worker, initargs=(like, False))
+        try:
+            assert np.allclose(pool.map(likelihood._pool_likelihood, params), serial)
+            sampler = emcee.EnsembleSampler(8, 3, likelihood._pool_likelihood, pool=pool)
+            sampler.run_mcmc(np.random.normal(size=(8, 3)), 20)
+            assert np.shape(sampler.chain) == (8, 20, 3)
+        finally:
+            pool.close()
+            pool.join()
+
+def _fail_on_negative(value):
+    """Task which raises for negative input."""
+    if value < 0:
+        raise ValueError("negative")
+    return value
+
+def _exit_worker(value):
+    """Task which kills its worker process."""
+    os._exit(value)
+
+def test_local_mpi_pool_errors():
+    """Check exceptions in a task are raised in the master, and a dead worker does not hang map."""
+    with pools.LocalMPIPool(2, poll_time=0.1) as pool:
+        assert pool.map(_fail_on_negative, [1, 2, 3]) == [1, 2, 3]
+        with pytest.raises(ValueError):
+            pool.map(_fail_on_negative, [1, -2, 3])
+        #The pool is still usable
+        assert pool.map(_fail_on_negative, [4]) == [4]
+    pool = pools.LocalMPIPool(1, poll_time=0.1)
+    with pytest.raises(RuntimeError):
+        pool.map(_exit_worker, [3])
+    pool.close()
+    pool.join()
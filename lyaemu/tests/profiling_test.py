@@ -0,0 +1,34 @@
+"""Tests for the profiling hooks."""
+
+import os.path
+import json
+import numpy as np
+from lyaemu import profiling
+from lyaemu.tests.likelihood_test import make_likelihood
+
+def test_profiling(tmp_path):
+    """Check timers and counters are only recorded while enabled, and the likelihood is instrumented."""
+    profiling.reset()
+    with profiling.timed("off"):
+        profiling.count("off")
+    assert profiling.get_profile() == {"timers": {}, "counters": {}}
+    like = make_likelihood(tmp_path)
+    #Predictions would otherwise be cached
+    like.prediction_cache_size = 0
+    params = np.mean(like.param_limits, axis=1)
+    data = np.ones(np.size(like.kf)*np.size(like.zout))
+    profiling.enable()
+    try:
+        for _ in range(3):
+            like.likelihood(params, data_power=data)
+        profile = profiling.save_profile(os.path.join(str(tmp_path), "profile.json"), run="test")
+    finally:
+        profiling.disable()
+    assert profile["counters"]["likelihood.calls"] == 3
+    assert profile["timers"]["rebin_power_to_kms"]["calls"] == 6
+    assert profile["timers"]["likelihood.linalg"]["calls"] == 3*np.size(like.zout)
+    for name in ("likelihood.tau0_factors", "likelihood.covariance"):
+        assert profile["timers"][name]["total"] > 0
+    with open(os.path.join(str(tmp_path), "profile.json")) as jsin:
+        assert json.load(jsin)["metadata"] == {"run": "test"}
+    profiling.reset()
@@ -0,0 +1,34 @@
+"""Test the quadratic emulator with an exactly quadratic model."""
+
+import numpy as np
+from lyaemu.quadratic_emulator import QuadraticPoly
+
+def test_quadratic_poly():
+    """Fit to a flux power which is exactly quadratic in each parameter, and check batched prediction."""
+    nk = 20
+    kf = np.linspace(0.1, 2, nk)
+    bestpar = np.array([1., 0.5])
+    coeffs = {0: (0.3 * kf, -0.2 * kf**2), 1: (0.1 * np.ones(nk), 0.5 * kf)}
+    bestfv = np.exp(-kf)
+    def model(pp):
+        """Exactly quadratic flux power"""
+        dp = pp - bestpar
+        return bestfv * (1 + sum(coeffs[i][0] * dp[i]**2 + coeffs[i][1] * dp[i] for i in range(2)))
+    #Best fit, then 9 variations of the first parameter and 4 of the second.
+    params = [bestpar]
+    for i, dps in ((0, [-0.2, -0.15, -0.1, -0.05, 0.05, 0.1, 0.15, 0.2, 0.25]), (1, [-0.2, -0.1, 0.1, 0.2])):
+        for dd in dps:
+            pp = np.array(bestpar)
+            pp[i] += dd
+            params.append(pp)
+    params = np.array(params)
+    assert np.shape(params) == (14, 2)
+    fvs = np.array([model(pp) for pp in params])
+    quad = QuadraticPoly(params=params, powers=fvs, param_limits=np.array([[0.7, 1.3], [0.2, 0.8]]))
+    for i in range(2):
+        assert np.allclose(quad.tables[i][:, 0], coeffs[i][0]) and np.allclose(quad.tables[i][:, 1], coeffs[i][1])
+    test = np.array([[0.9, 0.6], [1.1, 0.45], [1., 0.5]])
+    (mean, std) = quad.predict(test)
+    assert np.shape(mean) == (3, nk) and np.shape(std) == (3, nk)
+    assert np.allclose(mean, [model(pp) for pp in test])
+    assert np.allclose(quad.predict(test[1:2])[0], mean[1])
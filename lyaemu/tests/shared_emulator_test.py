@@ -0,0 +1,71 @@
+"""Test publishing an emulator into shared memory."""
+
+import multiprocessing
+import numpy as np
+from lyaemu import gpemulator
+from lyaemu import likelihood
+from lyaemu import shared_emulator
+from lyaemu.tests.gpemulator_test import MultiPower
+from lyaemu.tests.likelihood_test import make_likelihood
+
+def _predict_in_worker(descriptor, params, tau0):
+    """Attach to the shared emulator in another process and predict."""
+    gpemu = shared_emulator.attach_emulator(descriptor)
+    return gpemu.predict(params, tau0_factors=tau0), np.array(gpemu.covariances[1])
+
+def test_shared_emulator():
+    """Check the shared emulator predicts as the GPy emulator, in this process and another."""
+    kf = np.array([0.00141, 0.00178, 0.00224, 0.00282])
+    p1 = np.linspace(0.25, 1.75, 10)
+    p2 = np.linspace(0.1, 1., 10)
+    params = np.vstack([np.repeat(p1, 10), np.tile(p2, 10)]).T
+    powers = np.array([np.concatenate([MultiPower(par).get_power(kf=kf), 2*MultiPower(par).get_power(kf=kf)]) for par in params])
+    plimits = np.array([[0.25, 1.75], [0.1, 1.]])
+    gp = gpemulator.MultiBinGP(params=params, kf=kf, powers=powers, param_limits=plimits)
+    covars = [np.eye(4), 2*np.eye(4)]
+    test = np.array([[0.5, 0.3], [1.2, 0.75], [1.5, 0.4]])
+    tau0 = np.array([1.1, 0.9])
+    (means, std) = gp.predict(test, tau0_factors=tau0)
+    with shared_emulator.publish_emulator(gp, covariances=covars) as shared:
+        local = shared_emulator.attach_emulator(shared.descriptor)
+        (smeans, sstd) = local.predict(test, tau0_factors=tau0)
+        assert np.allclose(smeans, means, rtol=1e-6)
+        assert np.allclose(sstd, std, rtol=1e-6)
+        assert not local.gps[0].state["X"].flags.writeable
+        with multiprocessing.Pool(1) as pool:
+            ((wmeans, _), wcovar) = pool.apply(_predict_in_worker, (shared.descriptor, test, tau0))
+        assert np.allclose(wmeans, means, rtol=1e-6)
+        assert np.all(wcovar == covars[1])
+        assert local.gps_updated is None
+    #The updated training set is shared too
+    gp.add_to_training_set(np.array([[0.5]]))
+    (umeans, ustd) = gp.predict(test, tau0_factors=tau0, use_updated_training_set=True)
+    with shared_emulator.publish_emulator(gp) as shared:
+        local = shared_emulator.attach_emulator(shared.descriptor)
+        assert local.training_set_version == 1
+        (smeans, sstd) = local.predict(test, tau0_factors=tau0, use_updated_training_set=True)
+        assert np.allclose(smeans, umeans, rtol=1e-6)
+        assert np.allclose(sstd, ustd, rtol=1e-6)
+        (smeans, _) = local.predict(test, tau0_factors=tau0)
+        assert np.allclose(smeans, means, rtol=1e-6)
+
+def test_shared_likelihood(tmp_path):
+    """Check a worker copy of the likelihood using the shared emulator gives the same likelihood."""
+    like = make_likelihood(tmp_path)
+    plimits = like.emulator.get_param_limits(include_dense=True)
+    np.random.seed(5)
+    params = np.random.rand(15, np.shape(plimits)[0]) * (plimits[:,1] - plimits[:,0]) + plimits[:,0]
+    params[0] = plimits[:,0]
+    params[1] = plimits[:,1]
+    mock = like.gpemu
+    kf = mock.kf[::5]
+    powers = np.array([mock.predict(pp)[0][0].reshape(mock.nz, -1)[:, ::5].ravel() for pp in params])
+    like.gpemu = gpemulator.MultiBinGP(params=params, kf=kf, powers=powers, param_limits=plimits)
+    test = np.mean(like.param_limits, axis=1)
+    like.data_fluxpower = np.ones(np.size(like.kf)*np.size(like.zout))
+    expected = like.likelihood(test)
+    with like.share_emulator() as shared:
+        likelihood._init_pool_worker_shared(like._worker_copy(), shared.descriptor, True)
+        assert likelihood._POOL_LIKE.gpemu is not like.gpemu
+        assert np.isclose(likelihood._pool_likelihood(test), expected, rtol=1e-6)
+        likelihood._init_pool_worker(None, True)
@@ -0,0 +1,76 @@
+"""Tests for the streaming temperature density relation."""
+import os.path
+import h5py
+import numpy as np
+from lyaemu import coarse_grid
+from lyaemu import tempdens
+
+def test_accumulator():
+    """Check a chunked fit and histogram match fitting all the particles at once."""
+    rng = np.random.default_rng(11)
+    npart = 20000
+    logmean = -5.
+    logdens = logmean + rng.normal(0, 0.7, npart)
+    logT = 4.1 + 0.55 * (logdens - logmean) + rng.normal(0, 0.05, npart)
+    weights = rng.random(npart)
+    accs = [tempdens.TempDensAccumulator(logmean, nbins=50) for _ in range(2)]
+    for chunk in np.array_split(np.arange(npart), 7):
+        accs[chunk[0] % 2].add(logdens[chunk], logT[chunk], weights[chunk])
+    accs[0].merge(accs[1])
+    (T0, gamma) = accs[0].fit()
+    (T0ref, gammaref) = tempdens.fit_temp_dens_relation(logdens - logmean, logT)
+    assert np.isclose(T0, T0ref, rtol=1e-6)
+    assert np.isclose(gamma, gammaref, rtol=1e-6)
+    assert np.abs(gamma - 1.55) < 0.01
+    hist, _, _ = np.histogram2d(logdens, logT, bins=[accs[0].dedges, accs[0].tedges], weights=weights, density=True)
+    assert np.allclose(accs[0].density(), hist)
+
+def test_thermal_history(tmp_path, monkeypatch):
+    """Check T0 and gamma are extracted for every simulation and snapshot, and reused when unchanged."""
+    emu = coarse_grid.Emulator(str(tmp_path))
+    emu.sample_params = emu.build_params(3)
+    zout = np.arange(4.2, 2.1, -0.2)
+    for ii, pp in enumerate(emu.sample_params):
+        #The last simulation is missing its lowest redshift
+        for jj, zz in enumerate(zout[:np.size(zout) - (ii == 2)]):
+            sdir = os.path.join(str(tmp_path), emu._get_simdir(pp), "output", "SPECTRA_%03d" % jj)
+            os.makedirs(sdir)
+            with h5py.File(os.path.join(sdir, "lya_forest_spectra.hdf5"), 'w') as ff:
+                ff.create_group("Header").attrs["redshift"] = zz
+    outdirs = [os.path.join(str(tmp_path), emu._get_simdir(pp), "output") for pp in emu.sample_params]
+    calls = []
+    def fake_accumulate(num, base, **kwargs):
+        """Fake a snapshot with T0 depending on the snapshot number and gamma on the simulation."""
+        calls.append((num, base))
+        acc = tempdens.TempDensAccumulator(-5.)
+        logoverden = np.linspace(-1, 0.9, 20)
+        gamma = 1.3 + 0.1 * emu.sample_params[outdirs.index(base), 0]
+        acc.add(logoverden - 5, 4 + 0.01 * num + (gamma - 1) * logoverden, np.ones(20))
+        return 1/(1+zout[num]), acc
+    monkeypatch.setattr(tempdens, "accumulate_td_rel", fake_accumulate)
+    (params, zz, T0, gamma) = tempdens.get_thermal_history(emu)
+    assert np.allclose(zz, zout)
+    assert np.shape(T0) == (3, np.size(zout))
+    assert len(calls) == 3 * np.size(zout) - 1
+    assert np.isnan(T0[2, -1]) and np.isnan(gamma[2, -1])
+    assert np.allclose(np.log10(T0[:2]), 4 + 0.01 * np.arange(np.size(zout)))
+    assert np.allclose(gamma[:, :-1], 1.3 + 0.1 * params[:, 0:1])
+    assert os.path.exists(os.path.join(str(tmp_path), "thermal_history.hdf5"))
+    #Nothing is fitted again
+    (_, _, T0b, gammab) = tempdens.get_thermal_history(emu)
+    assert len(calls) == 3 * np.size(zout) - 1
+    assert np.allclose(T0b, T0, equal_nan=True) and np.allclose(gammab, gamma, equal_nan=True)
+    #Rate network temperatures are a different fit
+    tempdens.get_thermal_history(emu, gas="rate")
+    assert len(calls) == 2 * (3 * np.size(zout) - 1)
+    #Rewriting a snapshot of the first simulation refits only that simulation
+    pdir = os.path.join(outdirs[0], "PART_001")
+    os.makedirs(pdir)
+    with open(os.path.join(pdir, "0.hdf5"), 'w') as ff:
+        ff.write("x")
+    tempdens.get_thermal_history(emu, gas="rate")
+    assert len(calls) == 2 * (3 * np.size(zout) - 1) + np.size(zout)
+    stime = os.stat(os.path.join(pdir, "0.hdf5"))
+    os.utime(os.path.join(pdir, "0.hdf5"), (stime.st_atime + 1, stime.st_mtime + 1))
+    tempdens.get_thermal_history(emu, gas="rate")
+    assert len(calls) == 2 * (3 * np.size(zout) - 1) + 2 * np.size(zout)